@@ -14,11 +14,30 @@ DB_PARAMS = {
     "password": os.getenv("DB_PASSWORD", "1234")
 }
 
+DB_POOL_CONFIG = {
+    "min_size": int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+    "max_size": int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+    "acquire_timeout": float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 5)),
+    "command_timeout": float(os.getenv("DB_COMMAND_TIMEOUT", 10)),
+    "max_inactive_connection_lifetime": float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", 300)),
+    "health_check_interval": int(os.getenv("DB_HEALTH_CHECK_INTERVAL", 30)),
+    "notify_enabled": bool(os.getenv("DB_NOTIFY_ENABLED", "true").lower() == "true"),
+    "notify_reconnect_seconds": int(os.getenv("DB_NOTIFY_RECONNECT", 5))
+}
+
 BAKAI_CONFIG = {
     "api_base_url": os.getenv("BAKAI_API_URL", "https://openbanking-api.bakai.kg"),
     "token": os.getenv("BAKAI_TOKEN", ""),
     "merchant_account": os.getenv("BAKAI_MERCHANT_ACCOUNT", "1240040002323627"),
     "timeout": int(os.getenv("BAKAI_TIMEOUT", 15)),
+    "connect_timeout": float(os.getenv("BAKAI_CONNECT_TIMEOUT", 3)),
+    "retry_attempts": int(os.getenv("BAKAI_RETRY_ATTEMPTS", 3)),
+    "qr_deadline_seconds": float(os.getenv("BAKAI_QR_DEADLINE", 15)),
+    "status_deadline_seconds": float(os.getenv("BAKAI_STATUS_DEADLINE", 5)),
+    "status_poll_fast_seconds": float(os.getenv("PAYMENT_POLL_FAST_INTERVAL", 1)),
+    "status_poll_fast_period_seconds": float(os.getenv("PAYMENT_POLL_FAST_PERIOD", 30)),
+    "status_poll_max_seconds": float(os.getenv("PAYMENT_POLL_MAX_INTERVAL", 10)),
+    "status_poll_idle_seconds": float(os.getenv("PAYMENT_POLL_IDLE", 60)),
     "success_redirect_base": os.getenv("SUCCESS_REDIRECT_URL", "https://217.76.63.75:8000"),
     "qr_service": "https://api.qrserver.com/v1/create-qr-code/",
     "enable_payment_flow": bool(os.getenv("ENABLE_PAYMENT_FLOW", "true").lower() == "true")
@@ -51,29 +70,52 @@ PARKING_CONFIG = {
     "max_hours": int(os.getenv("MAX_HOURS", 24)),
     "night_rate": float(os.getenv("NIGHT_RATE", 30.0)),
     "session_timeout_hours": int(os.getenv("SESSION_TIMEOUT", 12)),
+    "expiry_check_interval_seconds": int(os.getenv("EXPIRY_CHECK_INTERVAL", 60)),
+    "expiry_batch_size": int(os.getenv("EXPIRY_BATCH_SIZE", 500)),
+    "tariff_cache_ttl_seconds": int(os.getenv("TARIFF_CACHE_TTL", 300)),
     "min_detection_interval_seconds": int(os.getenv("MIN_DETECTION_INTERVAL", 10)),
+    "barrier_timeout_seconds": float(os.getenv("BARRIER_TIMEOUT", 3)),
+    "barrier_connect_timeout_seconds": float(os.getenv("BARRIER_CONNECT_TIMEOUT", 1)),
+    "barrier_coalesce_seconds": float(os.getenv("BARRIER_COALESCE_WINDOW", 2)),
+    "barrier_retry_attempts": int(os.getenv("BARRIER_RETRY_ATTEMPTS", 3)),
+    "barrier_retry_backoff_seconds": float(os.getenv("BARRIER_RETRY_BACKOFF", 0.2)),
+    "barrier_breaker_threshold": int(os.getenv("BARRIER_BREAKER_THRESHOLD", 5)),
+    "barrier_breaker_reset_seconds": float(os.getenv("BARRIER_BREAKER_RESET", 30)),
+    "barrier_state_poll_seconds": float(os.getenv("BARRIER_STATE_POLL_INTERVAL", 2)),
+    "event_budget_seconds": float(os.getenv("EVENT_BUDGET", 15)),
     "min_plate_length": int(os.getenv("MIN_PLATE_LENGTH", 4)),
     "require_plate_for_barrier": True,
     "force_barrier_on_any_event": False,
     "mode": load_parking_mode() or os.getenv("PARKING_MODE", "paid")
 }
 
-PARKING_CAMERAS = {
-    "192.0.0.12": {
+# Полосы по умолчанию (если нет LANES_FILE), см. services/lanes.py
+DEFAULT_LANES = [
+    {
+        "name": "entry_1",
         "role": "entry",
-        "barrier": True,
-        "name": "Въезд 1"
+        "camera_ip": PARKING_CONFIG["entry_camera_ip"],
+        "public_ips": ["212.112.126.251"],
+        "barrier": "entry_barrier",
+        "payment_flow": False,
+        "screen_channel": "entry_1",
+        "title": "Въезд 1"
     },
-    "192.0.0.11": {
+    {
+        "name": "exit_1",
         "role": "exit",
-        "barrier": True,
-        "name": "Выезд 1"
-    },
-    "46.251.204.46": {
-        "role": "entry",
-        "barrier": True,
-        "name": "Въезд 2 (реальный IP)"
+        "camera_ip": PARKING_CONFIG["exit_camera_ip"],
+        "public_ips": ["212.112.126.252", "46.251.204.46"],
+        "barrier": "exit_barrier",
+        "payment_flow": True,
+        "screen_channel": "exit_1",
+        "title": "Выезд 1"
     }
+]
+
+LANES_CONFIG = {
+    "file": os.getenv("LANES_FILE", "lanes.json"),
+    "reload_interval_seconds": int(os.getenv("LANES_RELOAD_INTERVAL", 10))
 }
 
 CAMERA_CONFIG = {
@@ -82,7 +124,53 @@ CAMERA_CONFIG = {
     "timeout": int(os.getenv("CAMERA_TIMEOUT", 5)),
     "images_dir": os.getenv("IMAGES_DIR", "alarm_images"),
     "max_retry_attempts": int(os.getenv("MAX_RETRY_ATTEMPTS", 3)),
-    "retry_delay_seconds": int(os.getenv("RETRY_DELAY", 1))
+    "retry_delay_seconds": int(os.getenv("RETRY_DELAY", 1)),
+    "dedup_hash_window_seconds": int(os.getenv("DEDUP_HASH_WINDOW", 30)),
+    "events_log_enabled": bool(os.getenv("EVENTS_LOG_ENABLED", "true").lower() == "true"),
+    "events_log_batch_size": int(os.getenv("EVENTS_LOG_BATCH_SIZE", 200)),
+    "events_log_flush_seconds": float(os.getenv("EVENTS_LOG_FLUSH", 2)),
+    "events_log_queue_size": int(os.getenv("EVENTS_LOG_QUEUE_SIZE", 10000)),
+    "events_log_retention_days": int(os.getenv("EVENTS_LOG_RETENTION_DAYS", 30))
+}
+
+SHARED_STATE_CONFIG = {
+    "backend": os.getenv("SHARED_STATE_BACKEND", "memory"),
+    "memory_max_keys": int(os.getenv("SHARED_STATE_MAX_KEYS", 10000)),
+    "cleanup_interval_seconds": int(os.getenv("SHARED_STATE_CLEANUP_INTERVAL", 300)),
+    "unknown_event_delay_seconds": float(os.getenv("UNKNOWN_EVENT_DELAY", 3))
+}
+
+INGEST_CONFIG = {
+    "queue_size": int(os.getenv("INGEST_QUEUE_SIZE", 50)),
+    "drop_policy": os.getenv("INGEST_DROP_POLICY", "drop_oldest"),
+    "lane_concurrency": int(os.getenv("INGEST_LANE_CONCURRENCY", 1)),
+    "max_lanes": int(os.getenv("INGEST_MAX_LANES", 32)),
+    "wait_for_result": bool(os.getenv("INGEST_WAIT_FOR_RESULT", "true").lower() == "true"),
+    "response_timeout_seconds": float(os.getenv("INGEST_RESPONSE_TIMEOUT", 15))
+}
+
+SCREEN_WS_CONFIG = {
+    "queue_size": int(os.getenv("SCREEN_WS_QUEUE_SIZE", 32)),
+    "send_timeout_seconds": float(os.getenv("SCREEN_WS_SEND_TIMEOUT", 5)),
+    "heartbeat_seconds": float(os.getenv("SCREEN_WS_HEARTBEAT", 20))
+}
+
+ADMIN_FEED_CONFIG = {
+    "retention_hours": float(os.getenv("ADMIN_FEED_RETENTION_HOURS", 24)),
+    "trim_interval_seconds": int(os.getenv("ADMIN_FEED_TRIM_INTERVAL", 600))
+}
+
+RESPONSE_CACHE_CONFIG = {
+    "enabled": bool(os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"),
+    "max_entries": int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 256)),
+    # Путь (или префикс, оканчивающийся на "/") -> срок жизни и версии данных ответа
+    "routes": {
+        "/tariffs/active": {"ttl_seconds": 60, "versions": ["tariffs"]},
+        "/tariffs/list": {"ttl_seconds": 60, "versions": ["tariffs"]},
+        "/system/config": {"ttl_seconds": 30, "versions": ["config"]},
+        "/admin/whitelist": {"ttl_seconds": 60, "versions": ["whitelist"]},
+        "/admin/analytics/": {"ttl_seconds": 30, "versions": ["visits", "payments", "tariffs"]}
+    }
 }
 
 BARRIER_CONFIG = {
@@ -1,14 +1,152 @@
 """
-Модуль подключения к базе данных (asyncpg + psycopg2 для совместимости)
+Модуль подключения к базе данных (общий пул asyncpg на процесс)
 """
-import psycopg2
+import asyncio
+import logging
+from datetime import datetime
 import asyncpg
-from .config import DB_PARAMS
+from .config import DB_PARAMS, DB_POOL_CONFIG, KYRGYZSTAN_TZ
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+_listeners = {}
+_listener_tasks = set()
+
+db_health = {
+    "status": "not_initialized",
+    "last_check": None,
+    "error": None
+}
+
+
+async def init_db_pool():
+    """Создает общий пул соединений (вызывается один раз из lifespan)"""
+    global _pool
+    if _pool is not None:
+        return _pool
+    _pool = await asyncpg.create_pool(
+        host=DB_PARAMS["host"],
+        port=DB_PARAMS["port"],
+        database=DB_PARAMS["dbname"],
+        user=DB_PARAMS["user"],
+        password=DB_PARAMS["password"],
+        min_size=DB_POOL_CONFIG["min_size"],
+        max_size=DB_POOL_CONFIG["max_size"],
+        command_timeout=DB_POOL_CONFIG["command_timeout"],
+        max_inactive_connection_lifetime=DB_POOL_CONFIG["max_inactive_connection_lifetime"]
+    )
+    print(f"✅ DB pool created (min={DB_POOL_CONFIG['min_size']}, max={DB_POOL_CONFIG['max_size']})")
+    return _pool
+
+
+async def close_db_pool():
+    """Закрывает пул соединений при остановке приложения"""
+    global _pool
+    if _pool is None:
+        return
+    await _pool.close()
+    _pool = None
+    db_health["status"] = "closed"
+
+
+def get_db_pool():
+    """Возвращает общий пул соединений"""
+    if _pool is None:
+        raise RuntimeError("DB pool is not initialized")
+    return _pool
+
 
 def get_db_connection():
-    """Создает синхронное соединение с базой данных (legacy, для совместимости)"""
-    return psycopg2.connect(**DB_PARAMS)
+    """
+    Берет соединение из пула с таймаутом ожидания.
+    Использование: async with get_db_connection() as conn: ...
+    """
+    return get_db_pool().acquire(timeout=DB_POOL_CONFIG["acquire_timeout"])
+
+
+async def check_db_health() -> dict:
+    """Проверяет доступность БД через пул (SELECT 1) и обновляет db_health"""
+    try:
+        async with get_db_connection() as conn:
+            await conn.fetchval("SELECT 1", timeout=DB_POOL_CONFIG["acquire_timeout"])
+        db_health["status"] = "ok"
+        db_health["error"] = None
+    except Exception as e:
+        db_health["status"] = "error"
+        db_health["error"] = str(e)
+        logger.error(f"DB health check failed: {e}")
+    db_health["last_check"] = datetime.now(KYRGYZSTAN_TZ).isoformat()
+    return get_db_pool_stats()
+
+
+def get_db_pool_stats() -> dict:
+    """Текущее состояние пула для /system/health"""
+    stats = dict(db_health)
+    if _pool is not None:
+        stats.update({
+            "size": _pool.get_size(),
+            "idle": _pool.get_idle_size(),
+            "min_size": _pool.get_min_size(),
+            "max_size": _pool.get_max_size()
+        })
+    return stats
+
+
+async def db_health_check_task():
+    """Фоновая периодическая проверка соединений пула"""
+    while True:
+        await check_db_health()
+        await asyncio.sleep(DB_POOL_CONFIG["health_check_interval"])
+
+
+def add_db_listener(channel: str, callback):
+    """
+    Подписка на Postgres NOTIFY канала. callback(payload) - обычная или async функция.
+    После (пере)подключения слушателя callback вызывается с payload=None:
+    уведомления за время разрыва потеряны, подписчик должен перечитать данные.
+    """
+    _listeners.setdefault(channel, []).append(callback)
+
+
+def _dispatch_notification(channel: str, payload):
+    for callback in _listeners.get(channel, []):
+        try:
+            result = callback(payload)
+            if asyncio.iscoroutine(result):
+                task = asyncio.create_task(result)
+                _listener_tasks.add(task)
+                task.add_done_callback(_listener_tasks.discard)
+        except Exception as e:
+            logger.error(f"DB listener {channel} failed: {e}")
+
 
-async def get_async_db_connection():
-    """Создает асинхронное соединение с базой данных (asyncpg)"""
-    return await asyncpg.connect(**DB_PARAMS)
+async def db_listener_task():
+    """Отдельное соединение (вне пула) под LISTEN всех зарегистрированных каналов"""
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(
+                host=DB_PARAMS["host"],
+                port=DB_PARAMS["port"],
+                database=DB_PARAMS["dbname"],
+                user=DB_PARAMS["user"],
+                password=DB_PARAMS["password"]
+            )
+            disconnected = asyncio.Event()
+            conn.add_termination_listener(lambda c: disconnected.set())
+            for channel in _listeners:
+                await conn.add_listener(channel, lambda c, pid, ch, payload: _dispatch_notification(ch, payload))
+                _dispatch_notification(channel, None)
+            print(f"👂 DB LISTEN: {', '.join(_listeners) or '-'}")
+            await disconnected.wait()
+            logger.warning("DB listener connection lost, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"DB listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(DB_POOL_CONFIG["notify_reconnect_seconds"])
@@ -10,16 +10,27 @@ import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi import WebSocket, WebSocketDisconnect
-import psycopg2
 import os
-from typing import List
-from app.ws_manager import screen_ws_manager
+from typing import List, Optional
+from app.ws_manager import screen_ws_manager, barrier_ws_manager, admin_ws_manager
+from .db import init_db_pool, close_db_pool, db_health_check_task, db_listener_task, add_db_listener, get_db_connection
 from .models import init_database
 from .services.images import init_images_directory
-from .services.parking import close_expired_sessions
-from .config import PARKING_CONFIG, CAMERA_CONFIG, BAKAI_CONFIG
+from .services.parking import expired_sessions_task
+from .services.whitelist import whitelist_index
+from .services.tariffs import tariff_cache
+from .services.camera import events_log_writer
+from .services.shared_state import shared_state_cleanup_task
+from .services.ingest import ingest_manager
+from .services.barrier import close_barrier_controllers, barrier_state_poller, warn_if_event_budget_short
+from .services.lanes import lanes_reload_task
+from .services.payment import bakai_client
+from .services.payment_status import payment_status_poller, payment_status_hub, read_payment_status
+from .services.admin_feed import admin_feed, admin_feed_trim_task
+from .services.response_cache import response_cache, data_versions
+from .config import PARKING_CONFIG, CAMERA_CONFIG, BAKAI_CONFIG, DB_POOL_CONFIG, RESPONSE_CACHE_CONFIG
 
 from .routers import (
     camera_router, parking_router, image_router,
@@ -32,7 +43,23 @@ from fastapi.templating import Jinja2Templates
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
-    init_database()
+    await init_db_pool()
+    await init_database()
+    db_health_task = asyncio.create_task(db_health_check_task())
+    try:
+        await whitelist_index.load()
+    except Exception as e:
+        print(f"❌ Failed to load whitelist index: {e}")
+    listener_task = None
+    if DB_POOL_CONFIG["notify_enabled"]:
+        add_db_listener("parking_whitelist", whitelist_index.on_notify)
+        add_db_listener("parking_tariffs", tariff_cache.on_notify)
+        add_db_listener("parking_payments", payment_status_hub.on_notify)
+        add_db_listener("admin_changes", admin_feed.on_notify)
+        add_db_listener("admin_changes", data_versions.on_admin_change)
+        add_db_listener("parking_whitelist", data_versions.notify_handler("whitelist"))
+        add_db_listener("parking_tariffs", data_versions.notify_handler("tariffs"))
+        listener_task = asyncio.create_task(db_listener_task())
     init_images_directory()
 
     try:
@@ -42,9 +69,17 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"❌ Failed to start camera snapshot thread: {e}")
    
-    expired_count = close_expired_sessions()
-    if expired_count > 0:
-        print(f"⏰ Closed {expired_count} expired sessions on startup")
+    expiry_task = asyncio.create_task(expired_sessions_task())
+    events_log_task = asyncio.create_task(events_log_writer.run())
+    shared_state_task = asyncio.create_task(shared_state_cleanup_task())
+    lanes_task = asyncio.create_task(lanes_reload_task())
+    admin_feed_task = asyncio.create_task(admin_feed_trim_task())
+    barrier_poll_task = None
+    if PARKING_CONFIG["barrier_state_poll_seconds"] > 0:
+        barrier_poll_task = asyncio.create_task(barrier_state_poller.run())
+        print(f"🚧 Barrier state poll every {PARKING_CONFIG['barrier_state_poll_seconds']}s")
+    warn_if_event_budget_short(PARKING_CONFIG["event_budget_seconds"])
+    print(f"⏰ Expired sessions check every {PARKING_CONFIG['expiry_check_interval_seconds']}s")
    
     print("🚀 Smart Parking System v2.5 - QR PAYMENT INTEGRATION started!")
     print("✨ NEW QR PAYMENT FEATURES:")
@@ -66,15 +101,34 @@ async def lifespan(app: FastAPI):
     yield
    
     print("🔄 Shutting down QR payment system...")
+    expiry_task.cancel()
+    events_log_task.cancel()
+    shared_state_task.cancel()
+    ingest_manager.stop()
+    lanes_task.cancel()
+    admin_feed_task.cancel()
+    payment_status_poller.stop()
+    if barrier_poll_task:
+        barrier_poll_task.cancel()
+    if listener_task:
+        listener_task.cancel()
+    db_health_task.cancel()
+    await close_barrier_controllers()
+    await bakai_client.aclose()
+    await close_db_pool()
     print("✅ Shutdown complete")
 
 app = FastAPI(
     title="Smart Parking System",
     description="Система управления парковкой с QR-оплатой через Bakai OpenBanking v2.5",
     version="2.5",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+if RESPONSE_CACHE_CONFIG["enabled"]:
+    app.middleware("http")(response_cache.middleware)
+
 from fastapi.staticfiles import StaticFiles
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -92,61 +146,106 @@ app.include_router(admin_router.router)
 
 from app.ws_manager import screen_ws_manager
 @app.get("/screen/next-payment")
-async def get_next_payment_plate():
+async def get_next_payment_plate(channel: Optional[str] = None):
     """
-    Возвращает plate для последней ожидающей оплаты (или null)
+    Возвращает plate для последней ожидающей оплаты (или null);
+    channel - канал экрана полосы
     """
-    return {"plate": screen_ws_manager.last_payment_plate}
+    return {"plate": await screen_ws_manager.get_last_payment_plate(channel)}
 
 @app.post("/screen/clear-payment")
-async def clear_next_payment_plate():
+async def clear_next_payment_plate(channel: Optional[str] = None):
     """
     Сбросить plate для оплаты (например, после успешной оплаты)
     """
-    screen_ws_manager.last_payment_plate = None
+    await screen_ws_manager.set_last_payment_plate(None, channel)
     return {"ok": True}
 
 @app.websocket("/ws/screen")
-async def screen_control_ws(websocket: WebSocket):
-    await screen_ws_manager.connect(websocket)
-    try:
-        while True:
-            await asyncio.sleep(60)
-    except WebSocketDisconnect:
-        screen_ws_manager.disconnect(websocket)
-    except Exception:
-        screen_ws_manager.disconnect(websocket)
+async def screen_control_ws(websocket: WebSocket, channel: Optional[str] = None):
+    """Экран полосы (?channel=<screen_channel>) или общий экран (без канала - все сообщения)"""
+    await screen_ws_manager.serve(websocket, channel)
+
+@app.websocket("/ws/barrier-state")
+async def barrier_state_ws(websocket: WebSocket):
+    """Изменения состояния шлагбаумов (при подключении - текущие значения из кэша)"""
+    await barrier_ws_manager.serve(
+        websocket,
+        initial_messages=[{"type": "barrier_state", **state} for state in barrier_state_poller.states.values()]
+    )
+
+@app.websocket("/ws/admin-feed")
+async def admin_feed_ws(websocket: WebSocket):
+    """
+    Лента изменений админки: {"type": "change", "feed": visits|payments|whitelist|tariffs, ...}.
+    Первое сообщение - текущий курсор; live=false - NOTIFY выключен, клиент продолжает опрос.
+    """
+    async with get_db_connection() as conn:
+        cursor = await admin_feed.current_cursor(conn)
+    await admin_ws_manager.serve(
+        websocket,
+        initial_messages=[{"type": "hello", "cursor": cursor, "live": DB_POOL_CONFIG["notify_enabled"]}]
+    )
 
 @app.websocket("/ws/payment_status/{operation_id}")
 async def payment_status_ws(websocket: WebSocket, operation_id: str):
     await websocket.accept()
+    queue = None
+    receiver = asyncio.create_task(websocket.receive())
+
+    async def until_disconnect(awaitable):
+        """Ждет awaitable, параллельно слушая клиента: отключение - WebSocketDisconnect"""
+        nonlocal receiver
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task, receiver}, return_when=asyncio.FIRST_COMPLETED)
+                if task in done:
+                    return task.result()
+                if receiver.result()["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect()
+                receiver = asyncio.create_task(websocket.receive())
+        finally:
+            task.cancel()
+
     try:
-        import time
-        from .db import get_db_connection
         last_status = None
-        while True:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            try:
-                cur.execute(
-                    "SELECT payment_status FROM parking_payments WHERE transaction_id = %s OR bakai_operation_id = %s",
-                    (operation_id, operation_id)
-                )
-                row = cur.fetchone()
-                if row:
-                    status = row[0]
-                    if status != last_status:
-                        await websocket.send_json({"status": status})
-                        last_status = status
-                    if status == "paid":
-                        break
-                else:
+        if DB_POOL_CONFIG["notify_enabled"]:
+            # Подписка до чтения статуса - изменение между ними не потеряется
+            queue = payment_status_hub.subscribe(operation_id)
+            status = await read_payment_status(operation_id)
+            while True:
+                if status is None:
                     await websocket.send_json({"status": "not_found"})
                     break
-            finally:
-                cur.close()
-                conn.close()
-            await asyncio.sleep(1)
+                if status != last_status:
+                    await websocket.send_json({"status": status})
+                    last_status = status
+                if status == "paid":
+                    break
+                message = await until_disconnect(queue.get())
+                status = message["status"] if "status" in message else await read_payment_status(operation_id)
+        else:
+            version = 0
+            while True:
+                # Статус из общего поллера операции (см. services/payment_status.py)
+                version, result, error = await until_disconnect(
+                    payment_status_poller.wait_update(operation_id, version, timeout=30)
+                )
+                if error is not None:
+                    if getattr(error, "status_code", None) == 404:
+                        await websocket.send_json({"status": "not_found"})
+                    else:
+                        await websocket.send_json({"error": str(error)})
+                    break
+                if result is None:
+                    continue
+                status = result["payment_status"]
+                if status != last_status:
+                    await websocket.send_json({"status": status})
+                    last_status = status
+                if result.get("final"):
+                    break
     except WebSocketDisconnect:
         pass
     except Exception as e:
@@ -155,6 +254,9 @@ async def payment_status_ws(websocket: WebSocket, operation_id: str):
         except RuntimeError:
             pass
     finally:
+        receiver.cancel()
+        if queue is not None:
+            payment_status_hub.unsubscribe(operation_id, queue)
         try:
             await websocket.close()
         except RuntimeError:
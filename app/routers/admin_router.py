@@ -1,16 +1,18 @@
 from fastapi import APIRouter, Request, Form, Body, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
-from app.config import PARKING_CONFIG, save_parking_mode
+from app.config import PARKING_CONFIG, KYRGYZSTAN_TZ, save_parking_mode
 from app.models import (
     get_whitelist, add_to_whitelist, update_whitelist_entry, delete_whitelist_entry
 )
 from app.services.parking import get_parking_analytics, get_plate_analytics, get_payment_analytics
+from app.services.admin_feed import delta_response
+from app.services.response_cache import data_versions
 import requests
 from io import BytesIO
 from PIL import Image
-from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime
+from pydantic import BaseModel, field_validator, model_validator
+from typing import Optional, List, Tuple
+from datetime import datetime, date, timedelta
 
 router = APIRouter()
 
@@ -47,26 +49,34 @@ async def set_parking_mode(mode: str = Form(...)):
         return JSONResponse({"error": "Invalid mode"}, status_code=400)
     PARKING_CONFIG["mode"] = mode
     save_parking_mode(mode)
+    data_versions.bump("config")
     return RedirectResponse(url="/admin", status_code=303)
 
-@router.get("/admin/whitelist", response_model=List[dict])
-async def api_get_whitelist(limit: int = 100, offset: int = 0, active_only: bool = False):
-    """
-    Получить список номеров из белого списка
-    """
-    return get_whitelist(limit=limit, offset=offset, active_only=active_only)
+@router.get("/admin/whitelist")
+async def api_get_whitelist(limit: int = 100, offset: int = 0, active_only: bool = False, since: Optional[int] = None):
+    """
+    Получить список номеров из белого списка.
+    since=<курсор> - только изменения после курсора ленты админки (since=0 - полный список с курсором)
+    """
+    if since is not None:
+        return await delta_response(
+            "whitelist", since,
+            lambda ids: get_whitelist(limit=limit, offset=offset, active_only=active_only, ids=ids)
+        )
+    return await get_whitelist(limit=limit, offset=offset, active_only=active_only)
 
 @router.post("/admin/whitelist")
 async def api_add_to_whitelist(entry: WhitelistEntry):
     """
     Добавить номер в белый список
     """
-    whitelist_id = add_to_whitelist(
+    whitelist_id = await add_to_whitelist(
         plate_number=entry.plate_number,
         valid_from=entry.valid_from,
         valid_until=entry.valid_until,
         comment=entry.comment
     )
+    data_versions.bump("whitelist")
     if not whitelist_id:
         raise HTTPException(status_code=500, detail="Failed to add to whitelist")
     return {"status": "success", "id": whitelist_id}
@@ -76,13 +86,14 @@ async def api_update_whitelist_entry(entry_id: int, entry: WhitelistUpdate):
     """
     Обновить запись белого списка
     """
-    success = update_whitelist_entry(
+    success = await update_whitelist_entry(
         entry_id,
         plate_number=entry.plate_number,
         valid_from=entry.valid_from,
         valid_until=entry.valid_until,
         comment=entry.comment
     )
+    data_versions.bump("whitelist")
     if not success:
         raise HTTPException(status_code=500, detail="Failed to update whitelist entry")
     return {"status": "success"}
@@ -92,7 +103,8 @@ async def api_delete_whitelist_entry(entry_id: int):
     """
     Удалить запись из белого списка
     """
-    success = delete_whitelist_entry(entry_id)
+    success = await delete_whitelist_entry(entry_id)
+    data_versions.bump("whitelist")
     if not success:
         raise HTTPException(status_code=500, detail="Failed to delete whitelist entry")
     return {"status": "success"}
@@ -158,55 +170,59 @@ async def api_parking_analytics(days: int = 7):
     """
     Общая аналитика по парковке за последние days дней
     """
-    return get_parking_analytics(days=days)
+    return await get_parking_analytics(days=days)
 
 @router.get("/admin/analytics/payments")
 async def api_payment_analytics(day: str = None):
     """
     Аналитика по оплатам за выбранный день (по умолчанию сегодня)
     """
-    return get_payment_analytics(day=day)
+    return await get_payment_analytics(day=day)
 
 @router.get("/admin/analytics/plates")
 async def api_plate_analytics(days: int = 7):
     """
     Аналитика по номерам за последние days дней
     """
-    return get_plate_analytics(days=days)
+    return await get_plate_analytics(days=days)
 
-from app.services.barrier import open_barrier, close_barrier, get_barrier_state
+from app.services.barrier import open_barrier, close_barrier, get_barrier_state, barrier_state_poller
+from app.services.lanes import lane_registry
 from app.config import PARKING_CONFIG
 
 @router.get("/admin/active-visits")
 async def api_active_visits(
     plate: str = Query(None, description="Поиск по номеру (частичное совпадение)"),
-    sort: str = Query("desc", description="Сортировка: desc (новые сверху) или asc (старые сверху)")
+    sort: str = Query("desc", description="Сортировка: desc (новые сверху) или asc (старые сверху)"),
+    since: Optional[int] = Query(None, description="Курсор ленты админки: только изменения после него")
 ):
     """
     Получить список активных машин на парковке (visit_status='active'), 
     с фильтрацией по номеру и сортировкой
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
+    async def fetch_items(ids=None):
         query = """
             SELECT id, plate_number, entry_time, entry_camera_ip
             FROM parking_visits
             WHERE visit_status = 'active'
         """
         params = []
-        
+
         if plate:
-            query += " AND plate_number ILIKE %s"
             params.append(f"%{plate}%")
-        
+            query += f" AND plate_number ILIKE ${len(params)}"
+
+        if ids is not None:
+            params.append(list(ids))
+            query += f" AND id = ANY(${len(params)}::int[])"
+
         if sort and sort.lower() == "asc":
             query += " ORDER BY entry_time ASC"
         else:
             query += " ORDER BY entry_time DESC"
-            
-        cur.execute(query, tuple(params))
-        rows = cur.fetchall()
+
+        async with get_db_connection() as conn:
+            rows = await conn.fetch(query, *params)
         result = []
         for row in rows:
             result.append({
@@ -216,19 +232,24 @@ async def api_active_visits(
                 "entry_camera_ip": row[3]
             })
         return result
-    finally:
-        cur.close()
-        conn.close()
+
+    if since is not None:
+        return await delta_response("visits", since, fetch_items)
+    return await fetch_items()
 
 from fastapi import Body
 
 @router.get("/admin/barrier-state")
 async def api_barrier_state(camera_ip: str = Query(..., description="IP камеры (въезд/выезд)")):
     """
-    Получить состояние шлагбаума (open/closed/unknown/unreachable)
+    Получить состояние шлагбаума (open/closed/unknown/unreachable).
+    Значение из кэша фонового опроса со временем замера; без замера - прямой запрос.
     """
-    state = get_barrier_state(camera_ip)
-    return {"state": state}
+    cached = barrier_state_poller.get(camera_ip)
+    if cached:
+        return cached
+    state = await get_barrier_state(camera_ip)
+    return {"state": state, "sampled_at": datetime.now(KYRGYZSTAN_TZ).isoformat()}
 
 @router.post("/admin/barrier-open")
 async def api_barrier_open(data: dict = Body(...)):
@@ -238,7 +259,7 @@ async def api_barrier_open(data: dict = Body(...)):
     camera_ip = data.get("camera_ip")
     if not camera_ip:
         raise HTTPException(status_code=400, detail="camera_ip required")
-    success = open_barrier(camera_ip)
+    success = await open_barrier(camera_ip)
     return {"success": success}
 
 @router.post("/admin/barrier-open-default")
@@ -246,10 +267,10 @@ async def api_barrier_open_default():
     """
     Открыть шлагбаум по умолчанию (въезд)
     """
-    camera_ip = PARKING_CONFIG.get("entry_camera_ip")
-    if not camera_ip:
-        raise HTTPException(status_code=500, detail="entry_camera_ip not configured")
-    success = open_barrier(camera_ip)
+    entry_lanes = lane_registry.by_role("entry")
+    if not entry_lanes:
+        raise HTTPException(status_code=500, detail="entry lane not configured")
+    success = await open_barrier(entry_lanes[0].camera_ip)
     return {"success": success}
 
 @router.post("/admin/barrier-close")
@@ -260,7 +281,7 @@ async def api_barrier_close(data: dict = Body(...)):
     camera_ip = data.get("camera_ip")
     if not camera_ip:
         raise HTTPException(status_code=400, detail="camera_ip required")
-    success = close_barrier(camera_ip)
+    success = await close_barrier(camera_ip)
     return {"success": success}
 
 @router.get("/admin/server-errors")
@@ -293,47 +314,50 @@ async def api_visits_by_date(
     entry_from: str = Query(None, description="Въезд с (Y-m-d H:i)"),
     entry_to: str = Query(None, description="Въезд по (Y-m-d H:i)"),
     plate: str = Query(None, description="Поиск по номеру (частичное совпадение)"),
-    sort: str = Query("desc", description="Сортировка: desc (новые сверху) или asc (старые сверху)")
+    sort: str = Query("desc", description="Сортировка: desc (новые сверху) или asc (старые сверху)"),
+    since: Optional[int] = Query(None, description="Курсор ленты админки: только изменения после него")
 ):
     """
     Получить список всех визитов за выбранный день с расширенной фильтрацией и поиском
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        if not day:
-            day = date.today().isoformat()
-            
+    if not day:
+        day = date.today().isoformat()
+        
+    async def fetch_items(ids=None):
         query = """
             SELECT id, plate_number, entry_time, exit_time, visit_status
             FROM parking_visits
-            WHERE DATE(entry_time) = %s
+            WHERE DATE(entry_time) = $1::text::date
         """
         params = [day]
-        
+    
         if status:
-            query += " AND visit_status = %s"
             params.append(status)
-            
+            query += f" AND visit_status = ${len(params)}"
+        
         if entry_from:
-            query += " AND entry_time >= %s"
             params.append(entry_from)
-            
+            query += f" AND entry_time >= ${len(params)}::text::timestamptz"
+        
         if entry_to:
-            query += " AND entry_time <= %s"
             params.append(entry_to)
-            
+            query += f" AND entry_time <= ${len(params)}::text::timestamptz"
+        
         if plate:
-            query += " AND plate_number ILIKE %s"
             params.append(f"%{plate}%")
-            
+            query += f" AND plate_number ILIKE ${len(params)}"
+        
+        if ids is not None:
+            params.append(list(ids))
+            query += f" AND id = ANY(${len(params)}::int[])"
+
         if sort and sort.lower() == "asc":
             query += " ORDER BY entry_time ASC"
         else:
             query += " ORDER BY entry_time DESC"
-            
-        cur.execute(query, tuple(params))
-        rows = cur.fetchall()
+        
+        async with get_db_connection() as conn:
+            rows = await conn.fetch(query, *params)
         result = []
         for row in rows:
             result.append({
@@ -344,6 +368,122 @@ async def api_visits_by_date(
                 "visit_status": row[4]
             })
         return result
-    finally:
-        cur.close()
-        conn.close()
+
+    if since is not None:
+        return await delta_response("visits", since, fetch_items)
+    return await fetch_items()
+
+import json
+from app.services.tariffs import tariff_cache, load_tariff_table
+
+class TariffSimulation(BaseModel):
+    tariff_id: Optional[int] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    visits: Optional[List[Tuple[datetime, datetime]]] = None
+
+    @model_validator(mode="after")
+    def check_dates(self):
+        """Неверные даты - 422 до начала потока (после заголовков 200 ошибку уже не вернуть)"""
+        if self.date_from and self.date_to and self.date_from > self.date_to:
+            raise ValueError("date_from позже date_to")
+        return self
+
+    @field_validator("visits")
+    @classmethod
+    def check_visits(cls, visits):
+        """Время без часового пояса - по Бишкеку; выезд не раньше въезда (иначе 422)"""
+        if visits is None:
+            return None
+        result = []
+        for n, (entry_time, exit_time) in enumerate(visits):
+            if entry_time.tzinfo is None:
+                entry_time = entry_time.replace(tzinfo=KYRGYZSTAN_TZ)
+            if exit_time.tzinfo is None:
+                exit_time = exit_time.replace(tzinfo=KYRGYZSTAN_TZ)
+            if exit_time < entry_time:
+                raise ValueError(f"visits[{n}]: exit_time раньше entry_time")
+            result.append((entry_time, exit_time))
+        return result
+
+SIMULATION_CHUNK_SIZE = 1000
+
+@router.post("/admin/tariffs/simulate")
+async def api_tariff_simulate(data: TariffSimulation):
+    """
+    Пересчет стоимости визитов по тарифу tariff_id (по умолчанию - активному):
+    переданные пары visits=[[entry_time, exit_time], ...] или все завершенные
+    визиты с въездом в date_from..date_to. Ответ - поток NDJSON: строка на визит
+    и итоговая строка {"summary": ...}
+    """
+    if data.tariff_id is not None:
+        async with get_db_connection() as conn:
+            table = await load_tariff_table(conn, data.tariff_id)
+        if table is None:
+            raise HTTPException(status_code=404, detail="Tariff not found")
+    else:
+        table = await tariff_cache.get_table()
+
+    if data.visits is None and not (data.date_from and data.date_to):
+        raise HTTPException(status_code=400, detail="visits or date_from/date_to required")
+
+    async def visit_batches():
+        if data.visits is not None:
+            for i in range(0, len(data.visits), SIMULATION_CHUNK_SIZE):
+                yield [(i + n, None, pair[0], pair[1], None) for n, pair in enumerate(data.visits[i:i + SIMULATION_CHUNK_SIZE])]
+            return
+        # Пачки по ключу (entry_time, id): соединение берется на один запрос и
+        # возвращается в пул до отправки пачки клиенту - медленный клиент не держит его
+        period_start = datetime.combine(data.date_from, datetime.min.time(), KYRGYZSTAN_TZ)
+        period_end = datetime.combine(data.date_to + timedelta(days=1), datetime.min.time(), KYRGYZSTAN_TZ)
+        last_entry_time, last_id = None, 0
+        while True:
+            async with get_db_connection() as conn:
+                rows = await conn.fetch("""
+                    SELECT id, plate_number, entry_time, exit_time, cost_amount
+                    FROM parking_visits
+                    WHERE exit_time IS NOT NULL
+                      AND entry_time >= $1
+                      AND entry_time < $2
+                      AND ($3::timestamptz IS NULL OR (entry_time, id) > ($3::timestamptz, $4))
+                    ORDER BY entry_time, id
+                    LIMIT $5
+                """, period_start, period_end, last_entry_time, last_id, SIMULATION_CHUNK_SIZE)
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+            if len(rows) < SIMULATION_CHUNK_SIZE:
+                return
+            last_entry_time, last_id = rows[-1][2], rows[-1][0]
+
+    async def stream():
+        count = 0
+        total = 0.0
+        actual_total = 0.0
+        async for batch in visit_batches():
+            costs = table.cost_many((entry_time, exit_time) for _, _, entry_time, exit_time, _ in batch)
+            lines = []
+            for (visit_id, plate, entry_time, exit_time, actual), (minutes, hours, cost) in zip(batch, costs):
+                count += 1
+                total += cost
+                if actual is not None:
+                    actual_total += float(actual)
+                lines.append(json.dumps({
+                    "id": visit_id,
+                    "plate_number": plate,
+                    "entry_time": entry_time.isoformat(),
+                    "exit_time": exit_time.isoformat(),
+                    "duration_minutes": minutes,
+                    "billable_hours": hours,
+                    "total_cost": cost,
+                    "actual_cost": float(actual) if actual is not None else None
+                }, ensure_ascii=False))
+            yield "\n".join(lines) + "\n"
+        yield json.dumps({"summary": {
+            "tariff": table.name,
+            "visits": count,
+            "total_cost": round(total, 2),
+            "actual_total": round(actual_total, 2)
+        }}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -6,28 +6,83 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from starlette.requests import ClientDisconnect
 from datetime import datetime
-from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG, BAKAI_CONFIG, CAMERA_CONFIG
+from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG, BAKAI_CONFIG, CAMERA_CONFIG, SHARED_STATE_CONFIG
 from ..models import save_event
-from ..services.camera import (
-    find_plate_number, find_event_type, find_picture_url,
-    is_duplicate_event, is_valid_plate
-)
-from ..services.parking import process_entry, process_exit, format_duration
+from ..services.camera import is_duplicate_event, is_valid_plate
+from ..services.anpr_parser import parse_anpr_event
+from ..services.shared_state import shared_state
+from ..services.ingest import ingest_manager, IngestQueueFull
+from ..services.lanes import lane_registry
+from ..services.payment import bakai_client, BakaiError
+from ..services.parking import process_entry, process_exit, format_duration, is_plate_in_whitelist, calculate_parking_cost
 from ..services.images import process_alarm_image
+from ..services.barrier import event_deadline, BARRIER_DEADLINE_MARGIN_SECONDS, warn_if_event_budget_short
 from ..db import get_db_connection
-import requests
 import uuid
 import logging
+import os
 from app.ws_manager import screen_ws_manager
 
 import asyncio
+import time
 
 pending_unknown_tasks = {}
+# Фоновые задачи событий (фото, экран, QR): ссылка держится до завершения, иначе задачу может собрать GC
+background_event_tasks = set()
+
+
+def _background_done(task):
+    background_event_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Фоновая задача события завершилась ошибкой: {task.exception()}")
+
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_event_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
 
 templates = Jinja2Templates(directory="templates")
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/camera", tags=["camera"])
 
+
+async def process_with_budget(handler, camera_ip: str, plate: str, event_id: int) -> dict:
+    """
+    Выполняет process_entry/process_exit с ограничением по времени
+    (PARKING_CONFIG["event_budget_seconds"]), чтобы зависший шлагбаум или БД
+    не держали обработку события дольше бюджета.
+    """
+    budget = PARKING_CONFIG["event_budget_seconds"]
+    warn_if_event_budget_short(budget)
+    # Команда шлагбауму укладывается в бюджет с запасом: к отмене по wait_for ее результат уже известен
+    token = event_deadline.set(time.monotonic() + budget - BARRIER_DEADLINE_MARGIN_SECONDS)
+    try:
+        return await asyncio.wait_for(handler(camera_ip, plate, event_id), timeout=budget)
+    except asyncio.TimeoutError:
+        logger.error(f"⏱️ Event budget {budget}s exceeded for {plate} on {camera_ip}")
+        return {
+            "error": "event_budget_exceeded",
+            "barrier_opened": False,
+            "message": f"Обработка {plate} превысила {budget} с - шлагбаум не открыт"
+        }
+    finally:
+        event_deadline.reset(token)
+
+
+def save_debug_event(raw_bytes: bytes) -> str:
+    """Сохраняет сырое событие на диск для диагностики"""
+    debug_dir = "/var/www/parking/parking/camera_debug"
+    os.makedirs(debug_dir, exist_ok=True)
+    debug_filename = os.path.join(
+        debug_dir,
+        f"event_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.bin"
+    )
+    with open(debug_filename, "wb") as f:
+        f.write(raw_bytes)
+    return debug_filename
+
 @router.post("/event")
 async def camera_event(req: Request, background_tasks: BackgroundTasks):
     """Обработка событий от камер с интеграцией QR-оплаты для выезда"""
@@ -38,13 +93,6 @@ async def camera_event(req: Request, background_tasks: BackgroundTasks):
         else:
             client_ip = req.client.host if req.client else "unknown"
 
-        CAMERA_IP_MAP = {
-            "212.112.126.251": "192.0.0.12",
-            "212.112.126.252": "192.0.0.11",
-            "46.251.204.46": "192.0.0.11",
-        }
-        client_ip_mapped = CAMERA_IP_MAP.get(client_ip, client_ip)
-
         raw_bytes = await req.body()
 
         from ..services.images import process_alarm_image
@@ -59,14 +107,15 @@ async def camera_event(req: Request, background_tasks: BackgroundTasks):
                 "INSTANT"
             )
             if image_result and image_result.get("success"):
+                instant_lane = lane_registry.resolve(client_ip)
                 await screen_ws_manager.broadcast({
                     "screen": "camera_instant",
                     "camera_ip": client_ip,
                     "image_url": f"/{CAMERA_CONFIG['images_dir']}/{image_result['filename']}",
                     "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat()
-                })
+                }, channel=instant_lane.screen_channel if instant_lane else None)
 
-        if client_ip in (PARKING_CONFIG["entry_camera_ip"], PARKING_CONFIG["exit_camera_ip"]):
+        if client_ip in lane_registry.camera_ips:
             background_tasks.add_task(instant_photo_and_ws)
             instant_camera_ip = req.headers.get("X-Forwarded-For")
             if instant_camera_ip:
@@ -74,8 +123,7 @@ async def camera_event(req: Request, background_tasks: BackgroundTasks):
             else:
                 instant_camera_ip = req.client.host if req.client else "unknown"
             print(f"📸 INSTANT SNAPSHOT (async): {instant_camera_ip}")
-            import asyncio
-            loop = asyncio.get_event_loop()
+            loop = asyncio.get_running_loop()
             from ..services.images import process_alarm_image
             loop.run_in_executor(
                 None,
@@ -87,125 +135,164 @@ async def camera_event(req: Request, background_tasks: BackgroundTasks):
                 "INSTANT"
             )
 
-        raw_text = ""
-        for encoding in ['utf-8', 'latin-1', 'ascii', 'cp1252']:
-            try:
-                raw_text = raw_bytes.decode(encoding, errors="ignore")
-                break
-            except:
-                continue
-        if not raw_text:
-            raw_text = str(raw_bytes, errors="ignore")
+        event = parse_anpr_event(raw_bytes, req.headers.get("content-type", ""))
 
         print("🔍" + "="*79)
         print("📥 EVENT RECEIVED - QR PAYMENT INTEGRATION v2.5")
-        print(f"📏 Data size: {len(raw_bytes)} bytes")
+        print(f"📏 Data size: {len(raw_bytes)} bytes, images: {len(event.images)}")
 
-        forwarded_for = req.headers.get("X-Forwarded-For")
-        if forwarded_for:
-            client_ip = forwarded_for.split(",")[0].strip()
-        else:
-            client_ip = req.client.host if req.client else "unknown"
-
-        import re
-        real_ip = None
-        ip_match = re.search(r"<ipAddress>([^<]+)</ipAddress>", raw_text)
-        if ip_match:
-            real_ip = ip_match.group(1).strip()
-        else:
-            import json
-            try:
-                data = json.loads(raw_text)
-                real_ip = data.get("ipAddress")
-            except Exception:
-                real_ip = None
-
-        if real_ip:
-            camera_ip = real_ip
+        if event.ip_address:
+            camera_ip = event.ip_address
         else:
             camera_ip = client_ip
 
-        camera_key = f"camera_{camera_ip}"
-        print(f"📍 Camera IP (from body): {camera_ip}")
+        # Полоса по IP из тела или по адресу отправителя (в т.ч. публичному)
+        lane = lane_registry.resolve(camera_ip) or lane_registry.resolve(client_ip)
+        if lane:
+            camera_ip = lane.camera_ip
+        print(f"📍 Camera IP (from body): {camera_ip}, lane: {lane.name if lane else None}")
 
-        plate = find_plate_number(raw_text)
-        event_type = find_event_type(raw_text)
-        picture_url = find_picture_url(raw_text)
+        if event.confidence is not None or event.direction or event.lane:
+            print(f"📋 ANPR: confidence={event.confidence}, direction={event.direction}, lane={event.lane}")
 
-        global pending_unknown_tasks
+        return await ingest_manager.submit(lane.name if lane else camera_ip, {
+            "client_ip": client_ip,
+            "camera_ip": camera_ip,
+            "lane": lane,
+            "event": event,
+            "raw_bytes": raw_bytes
+        })
 
-        def cancel_pending_unknown(camera_ip):
-            task = pending_unknown_tasks.get(camera_ip)
-            if task and not task.done():
-                task.cancel()
-                print(f"🛑 Cancelled pending UNKNOWN event for {camera_ip}")
-                del pending_unknown_tasks[camera_ip]
+    except IngestQueueFull:
+        print(f"🚧 Ingest queue full for {camera_ip}, event rejected")
+        return {
+            "status": "queue_full",
+            "message": "Очередь событий камеры переполнена - событие отклонено",
+            "plate": event.plate,
+            "camera_ip": camera_ip,
+            "barrier_opened": False,
+            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat()
+        }
+    except ClientDisconnect:
+        client_ip = req.client.host if req.client else "unknown"
+        logger.warning(f"Client disconnected before body could be read (IP: {client_ip})")
+        return {
+            "status": "client_disconnect",
+            "message": "Клиент закрыл соединение до передачи данных",
+            "plate": "",
+            "camera_ip": client_ip,
+            "barrier_opened": False,
+            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
+            "error_note": "Клиент отключился до передачи данных"
+        }
+    except Exception as e:
+        print(f"💥 CRITICAL ERROR: {e}")
+        import traceback
+        traceback.print_exc()
 
-        async def send_unknown_event(camera_ip, raw_text, event_type, picture_url):
-            print(f"⏳ Waiting before sending UNKNOWN event for {camera_ip}...")
-            try:
-                await asyncio.sleep(3)
-                print(f"🚨 Sending UNKNOWN event for {camera_ip}")
-                from ..models import save_event
-                unknown_plate = "UNKNOWN"
-                event_id = save_event(f"camera_{camera_ip}", event_type or "ANPR", unknown_plate, raw_text)
-                print(f"✅ UNKNOWN event saved for {camera_ip}, event_id={event_id}")
-            except asyncio.CancelledError:
-                print(f"🛑 UNKNOWN event task cancelled for {camera_ip}")
-            except Exception as e:
-                print(f"❌ Error in UNKNOWN event task for {camera_ip}: {e}")
+        client_ip = req.client.host if req.client else "unknown"
+        return {
+            "status": "error",
+            "message": str(e),
+            "plate": "",
+            "camera_ip": client_ip,
+            "barrier_opened": False,
+            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
+            "error_note": "Шлагбаум заблокирован из-за ошибки системы"
+        }
 
-        if plate and is_valid_plate(plate):
-            cancel_pending_unknown(camera_ip)
-        else:
-            cancel_pending_unknown(camera_ip)
-            task = asyncio.create_task(send_unknown_event(camera_ip, raw_text, event_type, picture_url))
-            pending_unknown_tasks[camera_ip] = task
 
-        if not plate or not is_valid_plate(plate):
-            print("⛔️ Ignoring event: empty or invalid plate")
-            return {
-                "status": "ignored",
-                "plate": plate or "",
-                "plate_valid": False,
-                "camera_ip": camera_ip,
-                "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
-                "message": "Событие проигнорировано: номер не распознан или невалиден"
-            }
-        debug_dir = "/var/www/parking/parking/camera_debug"
-        import os
-        os.makedirs(debug_dir, exist_ok=True)
-        debug_filename = os.path.join(
-            debug_dir,
-            f"event_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.bin"
+async def handle_camera_event(item: dict) -> dict:
+    """
+    Обработка разобранного события камеры: дедупликация, сохранение, въезд/выезд.
+    Выполняется воркером полосы ingest_manager - события одной камеры по порядку.
+    """
+    client_ip = item["client_ip"]
+    camera_ip = item["camera_ip"]
+    lane = item["lane"]
+    event = item["event"]
+    raw_bytes = item["raw_bytes"]
+    raw_text = event.text
+    camera_key = f"camera_{camera_ip}"
+    plate = event.plate
+    event_type = event.event_type
+    picture_url = event.picture_url
+
+    async def cancel_pending_unknown(camera_ip):
+        task = pending_unknown_tasks.pop(camera_ip, None)
+        if task and not task.done():
+            task.cancel()
+            print(f"🛑 Cancelled pending UNKNOWN event for {camera_ip}")
+        # Задача могла быть запланирована другим воркером - снимаем общий токен
+        await shared_state.delete(f"unknown:{camera_ip}")
+
+    async def send_unknown_event(camera_ip, raw_text, event_type, picture_url, token):
+        print(f"⏳ Waiting before sending UNKNOWN event for {camera_ip}...")
+        try:
+            await asyncio.sleep(SHARED_STATE_CONFIG["unknown_event_delay_seconds"])
+            if not await shared_state.pop_if_equals(f"unknown:{camera_ip}", token):
+                print(f"🛑 UNKNOWN event for {camera_ip} cancelled by a newer event")
+                return
+            print(f"🚨 Sending UNKNOWN event for {camera_ip}")
+            from ..models import save_event
+            unknown_plate = "UNKNOWN"
+            event_id = await save_event(f"camera_{camera_ip}", event_type or "ANPR", unknown_plate, raw_text)
+            print(f"✅ UNKNOWN event saved for {camera_ip}, event_id={event_id}")
+        except asyncio.CancelledError:
+            print(f"🛑 UNKNOWN event task cancelled for {camera_ip}")
+        except Exception as e:
+            print(f"❌ Error in UNKNOWN event task for {camera_ip}: {e}")
+        finally:
+            if pending_unknown_tasks.get(camera_ip) is asyncio.current_task():
+                del pending_unknown_tasks[camera_ip]
+
+    await cancel_pending_unknown(camera_ip)
+    if not plate or not is_valid_plate(plate):
+        token = uuid.uuid4().hex
+        await shared_state.set(
+            f"unknown:{camera_ip}", token,
+            ttl_seconds=SHARED_STATE_CONFIG["unknown_event_delay_seconds"] * 10
         )
-        with open(debug_filename, "wb") as f:
-            f.write(raw_bytes)
-        print(f"📝 Raw event saved to: {debug_filename}")
+        task = asyncio.create_task(send_unknown_event(camera_ip, raw_text, event_type, picture_url, token))
+        pending_unknown_tasks[camera_ip] = task
 
-        if event_type:
-            print(f"📋 Event type: '{event_type}'")
-        else:
-            print("⚠️ Event type not identified")
+    if not plate or not is_valid_plate(plate):
+        print("⛔️ Ignoring event: empty or invalid plate")
+        return {
+            "status": "ignored",
+            "plate": plate or "",
+            "plate_valid": False,
+            "camera_ip": camera_ip,
+            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
+            "message": "Событие проигнорировано: номер не распознан или невалиден"
+        }
+    debug_filename = await asyncio.to_thread(save_debug_event, raw_bytes)
+    print(f"📝 Raw event saved to: {debug_filename}")
 
-        if picture_url:
-            print(f"🖼️ Picture URL found: '{picture_url}'")
+    if event_type:
+        print(f"📋 Event type: '{event_type}'")
+    else:
+        print("⚠️ Event type not identified")
 
-        if plate and is_duplicate_event(client_ip, plate, raw_text):
-            print(f"⚠️ DUPLICATE EVENT IGNORED for {client_ip} plate {plate}")
-            return {
-                "status": "duplicate_ignored",
-                "plate": plate,
-                "camera_ip": client_ip,
-                "message": "Событие проигнорировано как дублирующееся"
-            }
+    if picture_url:
+        print(f"🖼️ Picture URL found: '{picture_url}'")
 
-        event_id = save_event(camera_key, event_type or "ANPR", plate or "", raw_text)
+    if plate and await is_duplicate_event(client_ip, plate, raw_text):
+        print(f"⚠️ DUPLICATE EVENT IGNORED for {client_ip} plate {plate}")
+        return {
+            "status": "duplicate_ignored",
+            "plate": plate,
+            "camera_ip": client_ip,
+            "message": "Событие проигнорировано как дублирующееся"
+        }
+
+    event_id = await save_event(camera_key, event_type or "ANPR", plate or "", raw_text)
 
-        image_result = None
-        if event_id and plate:
-            print("🖼️ Processing image for valid plate event (ASYNC, BEFORE BARRIER)...")
-            async def event_photo_and_ws():
+    image_result = None
+    if event_id and plate:
+        print("🖼️ Processing image for valid plate event (ASYNC, BEFORE BARRIER)...")
+        async def event_photo_and_ws():
+            try:
                 img_res = process_alarm_image(
                     event_id, camera_ip, picture_url, plate, event_type or "ANPR"
                 )
@@ -217,178 +304,149 @@ async def camera_event(req: Request, background_tasks: BackgroundTasks):
                         "plate": plate,
                         "image_url": f"/{CAMERA_CONFIG['images_dir']}/{img_res['filename']}",
                         "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat()
-                    })
-            background_tasks.add_task(event_photo_and_ws)
-        else:
-            print("ℹ️ Skipping image processing - no valid plate detected")
-
-        parking_result = {"status": "event_saved"}
-
-        if camera_ip == PARKING_CONFIG["exit_camera_ip"]:
-            print("🚪 EXIT CAMERA 11 - QR PAYMENT INTEGRATION!")
-            parking_result = process_exit(camera_ip, plate, event_id)
-            if PARKING_CONFIG.get("mode", "paid") == "free":
-                print("🟢 Парковка в режиме БЕЗ ОПЛАТЫ — экран не переключается, только idle")
-                result = {
-                    "status": "ok",
-                    "event_type": event_type or "ANPR",
-                    "plate": plate or "",
-                    "plate_valid": bool(plate and is_valid_plate(plate)),
-                    "camera_ip": camera_ip,
-                    "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
-                    "event_id": event_id,
-                    "picture_url": picture_url,
-                    **parking_result
-                }
-                if event_id and plate:
-                    result["image_processing_scheduled"] = True
-                else:
-                    result["image_processing_scheduled"] = False
-                    result["image_skip_reason"] = "No valid plate detected"
-                print(f"📤 FINAL RESPONSE: {result}")
-                print("="*80)
-                return result
-
-            from app.services.parking import is_plate_in_whitelist, calculate_parking_cost
-            show_free_pass = False
-            try:
-                if not plate or plate.strip().upper() == "UNKNOWN":
-                    show_free_pass = True
-                elif is_plate_in_whitelist(plate):
-                    show_free_pass = True
-                else:
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    cur.execute("""
-                        SELECT entry_time, exit_time FROM parking_visits
-                        WHERE plate_number = %s AND visit_status = 'completed'
-                        ORDER BY exit_time DESC LIMIT 1
-                    """, (plate.upper(),))
-                    row = cur.fetchone()
-                    if row and row[0] and row[1]:
-                        cost_info = calculate_parking_cost(row[0], row[1])
-                        if cost_info.get("free_time"):
-                            show_free_pass = True
-                    cur.close()
-                    conn.close()
+                    }, channel=lane.screen_channel if lane else None)
             except Exception as e:
-                logger.error(f"Ошибка при определении free_pass: {e}")
-
-            if show_free_pass or parking_result.get("action") in ("exit_without_entry", "exit_free_mode"):
-                try:
-                    logger.info(f"🔔 Sending free_pass screen event for plate {plate}")
-                    from app.ws_manager import screen_ws_manager
-                    screen_ws_manager.last_payment_plate = plate
-                    await screen_ws_manager.broadcast({
-                        "screen": "free_pass",
-                        "plate": plate
-                    })
-                except Exception as ws_ex:
-                    logger.error(f"WebSocket broadcast error: {ws_ex}")
-                parking_result["payment_required"] = False
-            elif (
-                parking_result.get("action") in ("exit", "exit_payment_required")
-                and parking_result.get("total_cost", 0) > 0
-                and plate
-                and BAKAI_CONFIG["enable_payment_flow"]
-            ):
-                print(f"💳 Generating QR payment for {plate}, cost: {parking_result['total_cost']}")
-                try:
-                    qr_result = await generate_qr_for_parking(
-                        session_id=parking_result["session_id"],
-                        plate=plate,
-                        cost=parking_result["total_cost"]
-                    )
-
-                    if qr_result:
-                        parking_result["qr_payment"] = qr_result
-                        parking_result["payment_required"] = True
-                        print(f"✅ QR generated successfully for {plate}")
-                        try:
-                            logger.info(f"🔔 Sending payment screen event to idle.html for plate {plate}, operation_id: {qr_result.get('operation_id')}")
-                            logger.info(f"WS BROADCAST: screen=payment, plate={plate}")
-                            from app.ws_manager import screen_ws_manager
-                            screen_ws_manager.last_payment_plate = plate
-                            await screen_ws_manager.broadcast({
-                                "screen": "payment",
-                                "plate": plate
-                            })
-                        except Exception as ws_ex:
-                            logger.error(f"WebSocket broadcast error: {ws_ex}")
-                    else:
-                        parking_result["qr_payment_error"] = "Failed to generate QR"
-                        parking_result["payment_required"] = False
-                        print(f"❌ QR generation failed for {plate}")
-
-                except Exception as qr_error:
-                    logger.error(f"QR generation error for {plate}: {qr_error}")
-                    parking_result["qr_payment_error"] = str(qr_error)
-                    parking_result["payment_required"] = False
+                logger.error(f"Ошибка обработки фото события {event_id}: {e}")
+        # Обработка идет в воркере полосы - фон не привязан к HTTP-ответу
+        spawn_background(event_photo_and_ws())
+    else:
+        print("ℹ️ Skipping image processing - no valid plate detected")
+
+    parking_result = {"status": "event_saved"}
+
+    if lane and lane.role == "exit":
+        print(f"🚪 EXIT LANE {lane.name} - QR PAYMENT INTEGRATION!")
+        parking_result = await process_with_budget(process_exit, camera_ip, plate, event_id)
+        if PARKING_CONFIG.get("mode", "paid") == "free":
+            print("🟢 Парковка в режиме БЕЗ ОПЛАТЫ — экран не переключается, только idle")
+            result = {
+                "status": "ok",
+                "event_type": event_type or "ANPR",
+                "plate": plate or "",
+                "plate_valid": bool(plate and is_valid_plate(plate)),
+                "camera_ip": camera_ip,
+                "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
+                "event_id": event_id,
+                "picture_url": picture_url,
+                **parking_result
+            }
+            if event_id and plate:
+                result["image_processing_scheduled"] = True
             else:
-                parking_result["payment_required"] = False
+                result["image_processing_scheduled"] = False
+                result["image_skip_reason"] = "No valid plate detected"
+            print(f"📤 FINAL RESPONSE: {result}")
+            print("="*80)
+            return result
+
+        # Экран оплаты и QR (запрос к Bakai - до qr_deadline_seconds) - в фоне:
+        # воркер полосы занят только БД и шлагбаумом и не держит очередь выездов
+        spawn_background(exit_screen_and_payment(lane, plate, parking_result))
+        parking_result["payment_flow_scheduled"] = True
+
+    elif lane and lane.role == "entry":
+        print(f"🚪 ENTRY LANE {lane.name} - STANDARD PROCESSING!")
+        parking_result = await process_with_budget(process_entry, camera_ip, plate, event_id)
+
+    else:
+        print(f"ℹ️ Unknown camera IP: {camera_ip} - no barrier control")
+        parking_result = {
+            "status": "unknown_camera",
+            "barrier_opened": False,
+            "message": f"Неизвестная камера {camera_ip} - шлагбаум не управляется"
+        }
 
-        elif camera_ip == PARKING_CONFIG["entry_camera_ip"]:
-            print("🚪 ENTRY CAMERA 12 - STANDARD PROCESSING!")
-            parking_result = process_entry(camera_ip, plate, event_id)
+    result = {
+        "status": "ok",
+        "event_type": event_type or "ANPR",
+        "plate": plate or "",
+        "plate_valid": bool(plate and is_valid_plate(plate)),
+        "camera_ip": camera_ip,
+        "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
+        "event_id": event_id,
+        "picture_url": picture_url,
+        **parking_result
+    }
 
-        else:
-            print(f"ℹ️ Unknown camera IP: {camera_ip} - no barrier control")
-            parking_result = {
-                "status": "unknown_camera",
-                "barrier_opened": False,
-                "message": f"Неизвестная камера {camera_ip} - шлагбаум не управляется"
-            }
+    if event_id and plate:
+        result["image_processing_scheduled"] = True
+    else:
+        result["image_processing_scheduled"] = False
+        result["image_skip_reason"] = "No valid plate detected"
 
-        result = {
-            "status": "ok",
-            "event_type": event_type or "ANPR",
-            "plate": plate or "",
-            "plate_valid": bool(plate and is_valid_plate(plate)),
-            "camera_ip": camera_ip,
-            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
-            "event_id": event_id,
-            "picture_url": picture_url,
-            **parking_result
-        }
+    print(f"📤 FINAL RESPONSE: {result}")
+    print("="*80)
 
-        if event_id and plate:
-            result["image_processing_scheduled"] = True
-        else:
-            result["image_processing_scheduled"] = False
-            result["image_skip_reason"] = "No valid plate detected"
+    return result
 
-        print(f"📤 FINAL RESPONSE: {result}")
-        print("="*80)
 
-        return result
+ingest_manager.set_handler(handle_camera_event)
 
-    except ClientDisconnect:
-        client_ip = req.client.host if req.client else "unknown"
-        logger.warning(f"Client disconnected before body could be read (IP: {client_ip})")
-        return {
-            "status": "client_disconnect",
-            "message": "Клиент закрыл соединение до передачи данных",
-            "plate": "",
-            "camera_ip": client_ip,
-            "barrier_opened": False,
-            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
-            "error_note": "Клиент отключился до передачи данных"
-        }
+async def exit_screen_and_payment(lane, plate: str, parking_result: dict):
+    """Фон выезда: экран free_pass или генерация QR и экран оплаты (parking_result - результат process_exit)"""
+    show_free_pass = False
+    try:
+        if not plate or plate.strip().upper() == "UNKNOWN":
+            show_free_pass = True
+        elif await is_plate_in_whitelist(plate):
+            # Индекс белого списка в памяти - соединение из пула не нужно
+            show_free_pass = True
+        else:
+            async with get_db_connection() as conn:
+                row = await conn.fetchrow("""
+                    SELECT entry_time, exit_time FROM parking_visits
+                    WHERE plate_number = $1 AND visit_status = 'completed'
+                    ORDER BY exit_time DESC LIMIT 1
+                """, plate.upper())
+            if row and row[0] and row[1]:
+                cost_info = await calculate_parking_cost(row[0], row[1])
+                if cost_info.get("free_time"):
+                    show_free_pass = True
     except Exception as e:
-        print(f"💥 CRITICAL ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Ошибка при определении free_pass: {e}")
+
+    if show_free_pass or parking_result.get("action") in ("exit_without_entry", "exit_free_mode"):
+        try:
+            logger.info(f"🔔 Sending free_pass screen event for plate {plate}")
+            await screen_ws_manager.set_last_payment_plate(plate, lane.screen_channel)
+            await screen_ws_manager.broadcast({
+                "screen": "free_pass",
+                "plate": plate
+            }, channel=lane.screen_channel)
+        except Exception as ws_ex:
+            logger.error(f"WebSocket broadcast error: {ws_ex}")
+    elif (
+        parking_result.get("action") in ("exit", "exit_payment_required")
+        and parking_result.get("total_cost", 0) > 0
+        and plate
+        and BAKAI_CONFIG["enable_payment_flow"]
+        and lane.payment_flow
+    ):
+        print(f"💳 Generating QR payment for {plate}, cost: {parking_result['total_cost']}")
+        try:
+            qr_result = await generate_qr_for_parking(
+                session_id=parking_result["session_id"],
+                plate=plate,
+                cost=parking_result["total_cost"]
+            )
 
-        client_ip = req.client.host if req.client else "unknown"
-        return {
-            "status": "error",
-            "message": str(e),
-            "plate": "",
-            "camera_ip": client_ip,
-            "barrier_opened": False,
-            "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
-            "error_note": "Шлагбаум заблокирован из-за ошибки системы"
-        }
+            if qr_result:
+                print(f"✅ QR generated successfully for {plate}")
+                try:
+                    logger.info(f"🔔 Sending payment screen event to idle.html for plate {plate}, operation_id: {qr_result.get('operation_id')}")
+                    logger.info(f"WS BROADCAST: screen=payment, plate={plate}")
+                    await screen_ws_manager.set_last_payment_plate(plate, lane.screen_channel)
+                    await screen_ws_manager.broadcast({
+                        "screen": "payment",
+                        "plate": plate
+                    }, channel=lane.screen_channel)
+                except Exception as ws_ex:
+                    logger.error(f"WebSocket broadcast error: {ws_ex}")
+            else:
+                print(f"❌ QR generation failed for {plate}")
+
+        except Exception as qr_error:
+            logger.error(f"QR generation error for {plate}: {qr_error}")
 
 
 async def generate_qr_for_parking(session_id: int, plate: str, cost: float) -> dict:
@@ -400,25 +458,22 @@ async def generate_qr_for_parking(session_id: int, plate: str, cost: float) -> d
         logger.error("Bakai configuration incomplete")
         return None
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     try:
-        cur.execute("""
-            SELECT id, transaction_id, bakai_operation_id, qr_image, amount, payment_status
-            FROM parking_payments
-            WHERE session_id = %s AND plate_number = %s AND payment_status = 'pending'
-            ORDER BY created_at DESC LIMIT 1
-        """, (session_id, plate))
-        existing = cur.fetchone()
-        if existing:
-            payment_id, transaction_id, bakai_operation_id, qr_image, amount, payment_status = existing
-            cur.execute("""
+        async with get_db_connection() as conn:
+            existing = await conn.fetchrow("""
+                SELECT id, transaction_id, bakai_operation_id, qr_image, amount, payment_status
+                FROM parking_payments
+                WHERE session_id = $1 AND plate_number = $2 AND payment_status = 'pending'
+                ORDER BY created_at DESC LIMIT 1
+            """, session_id, plate)
+            session_data = await conn.fetchrow("""
                 SELECT entry_time, exit_time, duration_minutes
                 FROM parking_visits 
-                WHERE id = %s
-            """, (session_id,))
-            session_data = cur.fetchone()
+                WHERE id = $1
+            """, session_id)
+
+        if existing:
+            payment_id, transaction_id, bakai_operation_id, qr_image, amount, payment_status = existing
             entry_time, exit_time, duration_minutes = session_data if session_data else (None, None, None)
             return {
                 "car_number": plate,
@@ -430,12 +485,6 @@ async def generate_qr_for_parking(session_id: int, plate: str, cost: float) -> d
                 "payment_id": payment_id
             }
 
-        cur.execute("""
-            SELECT entry_time, exit_time, duration_minutes
-            FROM parking_visits 
-            WHERE id = %s
-        """, (session_id,))
-        session_data = cur.fetchone()
         if not session_data:
             logger.error(f"Session {session_id} not found")
             return None
@@ -444,57 +493,27 @@ async def generate_qr_for_parking(session_id: int, plate: str, cost: float) -> d
 
         operation_id = str(uuid.uuid4())
 
-        qr_payload = {
-            "accountNo": BAKAI_CONFIG["merchant_account"],
-            "currencyId": 417,
-            "amount": float(cost),
-            "operationID": operation_id
-        }
-
-        headers = {
-            "Authorization": f"Bearer {BAKAI_CONFIG['token']}",
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(
-            f"{BAKAI_CONFIG['api_base_url']}/api/Qr/GenerateQR",
-            json=qr_payload,
-            headers=headers,
-            timeout=BAKAI_CONFIG["timeout"]
-        )
-
-        if response.status_code != 200:
-            logger.error(f"Bakai QR API error: {response.status_code} - {response.text}")
-            return None
-
-        qr_result = response.json()
-        qr_image = qr_result.get("qrImage")
-
-        if not qr_image:
-            logger.error("No QR image in Bakai response")
-            return None
-
-        bakai_operation_id = qr_result.get("operationID") or qr_result.get("operationId") or qr_result.get("transactionId") or operation_id
+        qr_result = await bakai_client.generate_qr(cost, operation_id)
+        qr_image = qr_result["qr_image"]
+        bakai_operation_id = qr_result["bakai_operation_id"]
 
         local_operation_id = str(uuid.uuid4())
-        cur.execute("""
-            INSERT INTO parking_payments 
-            (session_id, plate_number, amount, local_operation_id, bakai_operation_id, qr_image, transaction_id, payment_link, payment_status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-            RETURNING id
-        """, (
-            session_id, 
-            plate, 
-            cost, 
-            local_operation_id,
-            bakai_operation_id,
-            qr_image,
-            operation_id,
-            f"QR_PAYMENT_{operation_id}"
-        ))
-
-        payment_id = cur.fetchone()[0]
-        conn.commit()
+        async with get_db_connection() as conn:
+            payment_id = await conn.fetchval("""
+                INSERT INTO parking_payments 
+                (session_id, plate_number, amount, local_operation_id, bakai_operation_id, qr_image, transaction_id, payment_link, payment_status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, 'pending')
+                RETURNING id
+            """,
+                session_id, 
+                plate, 
+                cost, 
+                local_operation_id,
+                bakai_operation_id,
+                qr_image,
+                operation_id,
+                f"QR_PAYMENT_{operation_id}"
+            )
 
         return {
             "car_number": plate,
@@ -506,48 +525,42 @@ async def generate_qr_for_parking(session_id: int, plate: str, cost: float) -> d
             "payment_id": payment_id
         }
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error calling Bakai API: {e}")
+    except BakaiError as e:
+        logger.error(f"Error calling Bakai API: {e}")
         return None
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error generating QR: {e}")
         return None
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/payment-page/{plate_number}")
 async def get_payment_page_data(plate_number: str):
     """
     Получить данные для страницы оплаты по номеру автомобиля
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT pv.id, pv.entry_time, pv.exit_time, pv.duration_minutes, 
-                   pv.cost_amount, pp.transaction_id, pp.bakai_operation_id, pp.payment_status, pp.id as payment_id
-            FROM parking_visits pv
-            JOIN parking_payments pp ON pv.id = pp.session_id
-            WHERE pv.plate_number = %s 
-            AND pv.visit_status = 'completed'
-            AND pp.payment_status = 'pending'
-            ORDER BY pv.exit_time DESC
-            LIMIT 1
-        """, (plate_number.upper(),))
-        
-        result = cur.fetchone()
-        if not result:
-            cur.execute("""
-                SELECT id, entry_time, exit_time, duration_minutes, cost_amount
-                FROM parking_visits
-                WHERE plate_number = %s AND visit_status = 'completed'
-                ORDER BY exit_time DESC
+        async with get_db_connection() as conn:
+            result = await conn.fetchrow("""
+                SELECT pv.id, pv.entry_time, pv.exit_time, pv.duration_minutes, 
+                       pv.cost_amount, pp.transaction_id, pp.bakai_operation_id, pp.payment_status, pp.id as payment_id
+                FROM parking_visits pv
+                JOIN parking_payments pp ON pv.id = pp.session_id
+                WHERE pv.plate_number = $1 
+                AND pv.visit_status = 'completed'
+                AND pp.payment_status = 'pending'
+                ORDER BY pv.exit_time DESC
                 LIMIT 1
-            """, (plate_number.upper(),))
-            session = cur.fetchone()
+            """, plate_number.upper())
+            session = None
+            if not result:
+                session = await conn.fetchrow("""
+                    SELECT id, entry_time, exit_time, duration_minutes, cost_amount
+                    FROM parking_visits
+                    WHERE plate_number = $1 AND visit_status = 'completed'
+                    ORDER BY exit_time DESC
+                    LIMIT 1
+                """, plate_number.upper())
+
+        if not result:
             if not session:
                 raise HTTPException(status_code=404, detail="No completed session found for this vehicle")
             session_id, entry_time, exit_time, duration_minutes, cost_amount = session
@@ -595,80 +608,71 @@ async def get_payment_page_data(plate_number: str):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/free-pass/{plate_number}", response_class=HTMLResponse)
 async def free_pass_page(request: Request, plate_number: str):
     """
     Страница для бесплатного проезда, белого списка, unknown и т.д.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        if plate_number.lower() == "unknown":
-            reason = "Ваш номер не распознан — проезд бесплатный"
-            plate = "UNKNOWN"
-            plate_region = ""
-            plate_main = "UNKNOWN"
-            entry_time = "-"
-            exit_time = "-"
-            duration = "-"
-        else:
-            cur.execute("""
+    if plate_number.lower() == "unknown":
+        reason = "Ваш номер не распознан — проезд бесплатный"
+        plate = "UNKNOWN"
+        plate_region = ""
+        plate_main = "UNKNOWN"
+        entry_time = "-"
+        exit_time = "-"
+        duration = "-"
+    else:
+        async with get_db_connection() as conn:
+            session = await conn.fetchrow("""
                 SELECT entry_time, exit_time, duration_minutes, cost_amount, visit_status
                 FROM parking_visits
-                WHERE plate_number = %s
+                WHERE plate_number = $1
                 ORDER BY exit_time DESC
                 LIMIT 1
-            """, (plate_number.upper(),))
-            session = cur.fetchone()
-            if not session:
+            """, plate_number.upper())
+        if not session:
+            reason = "Данные не найдены"
+            plate = plate_number.upper()
+            plate_region = plate[:2] if len(plate) >= 2 else ""
+            plate_main = plate[2:] if len(plate) > 2 else plate
+            entry_time = "-"
+            exit_time = "-"
+            duration = "-"
+        else:
+            entry_time_db, exit_time_db, duration_minutes, cost_amount, visit_status = session
+            plate = plate_number.upper()
+            plate_region = plate[:2] if len(plate) >= 2 else ""
+            plate_main = plate[2:] if len(plate) > 2 else plate
+            if visit_status in ("exit_without_entry", "exit_whitelist"):
                 reason = "Данные не найдены"
-                plate = plate_number.upper()
-                plate_region = plate[:2] if len(plate) >= 2 else ""
-                plate_main = plate[2:] if len(plate) > 2 else plate
                 entry_time = "-"
-                exit_time = "-"
                 duration = "-"
-            else:
-                entry_time_db, exit_time_db, duration_minutes, cost_amount, visit_status = session
-                plate = plate_number.upper()
-                plate_region = plate[:2] if len(plate) >= 2 else ""
-                plate_main = plate[2:] if len(plate) > 2 else plate
-                if visit_status in ("exit_without_entry", "exit_whitelist"):
-                    reason = "Данные не найдены"
-                    entry_time = "-"
-                    duration = "-"
-                    exit_time = exit_time_db.isoformat() if exit_time_db else "-"
-                elif visit_status == "completed":
-                    if cost_amount is not None and cost_amount <= 0:
-                        reason = "Проезд бесплатный"
-                    else:
-                        reason = "Проезд разрешён"
-                    entry_time = entry_time_db.isoformat() if entry_time_db else "-"
-                    exit_time = exit_time_db.isoformat() if exit_time_db else "-"
-                    duration = format_duration(duration_minutes) if duration_minutes else "-"
+                exit_time = exit_time_db.isoformat() if exit_time_db else "-"
+            elif visit_status == "completed":
+                if cost_amount is not None and cost_amount <= 0:
+                    reason = "Проезд бесплатный"
                 else:
-                    reason = "Данные не найдены"
-                    entry_time = "-"
-                    duration = "-"
-                    exit_time = exit_time_db.isoformat() if exit_time_db else "-"
-
-        return templates.TemplateResponse(
-            "free_pass.html",
-            {
-                "request": request,
-                "car_number": plate,
-                "plate_region": plate_region,
-                "plate_main": plate_main,
-                "reason": reason,
-                "entry_time": entry_time,
-                "exit_time": exit_time,
-                "duration": duration
-            }
-        )
-    finally:
-        cur.close()
-        conn.close()
+                    reason = "Проезд разрешён"
+                entry_time = entry_time_db.isoformat() if entry_time_db else "-"
+                exit_time = exit_time_db.isoformat() if exit_time_db else "-"
+                duration = format_duration(duration_minutes) if duration_minutes else "-"
+            else:
+                reason = "Данные не найдены"
+                entry_time = "-"
+                duration = "-"
+                exit_time = exit_time_db.isoformat() if exit_time_db else "-"
+
+    return templates.TemplateResponse(
+        "free_pass.html",
+        {
+            "request": request,
+            "car_number": plate,
+            "plate_region": plate_region,
+            "plate_main": plate_main,
+            "reason": reason,
+            "entry_time": entry_time,
+            "exit_time": exit_time,
+            "duration": duration
+        }
+    )
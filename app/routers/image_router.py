@@ -12,22 +12,20 @@ router = APIRouter(prefix="/images", tags=["images"])
 @router.get("/list")
 async def list_images(limit: int = 50):
     """Получить список сохраненных изображений"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
-                   ai.plate_number, ai.camera_ip, ai.download_success,
-                   ai.created_at, c.event_type, c.event_time
-            FROM alarm_images ai
-            LEFT JOIN camera c ON ai.event_id = c.id
-            ORDER BY ai.created_at DESC
-            LIMIT %s
-        """, (limit,))
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
+                       ai.plate_number, ai.camera_ip, ai.download_success,
+                       ai.created_at, c.event_type, c.event_time
+                FROM alarm_images ai
+                LEFT JOIN camera c ON ai.event_id = c.id
+                ORDER BY ai.created_at DESC
+                LIMIT $1
+            """, limit)
         
         images = []
-        for row in cur.fetchall():
+        for row in rows:
             (img_id, filename, filepath, size, plate, camera_ip, success,
              created_at, event_type, event_time) = row
             
@@ -53,23 +51,17 @@ async def list_images(limit: int = 50):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/download/{image_id}")
 async def download_image(image_id: int):
     """Скачать изображение по ID"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT image_filename, image_path FROM alarm_images
-            WHERE id = %s AND download_success = true
-        """, (image_id,))
+        async with get_db_connection() as conn:
+            result = await conn.fetchrow("""
+                SELECT image_filename, image_path FROM alarm_images
+                WHERE id = $1 AND download_success = true
+            """, image_id)
         
-        result = cur.fetchone()
         if not result:
             raise HTTPException(status_code=404, detail="Image not found or download failed")
         
@@ -86,30 +78,25 @@ async def download_image(image_id: int):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/by-plate/{plate_number}")
 async def get_images_by_plate(plate_number: str, limit: int = 20):
     """Получить изображения для конкретного номера"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
-                   ai.plate_number, ai.camera_ip, ai.download_success,
-                   ai.created_at, c.event_type, c.event_time
-            FROM alarm_images ai
-            LEFT JOIN camera c ON ai.event_id = c.id
-            WHERE ai.plate_number = %s
-            ORDER BY ai.created_at DESC
-            LIMIT %s
-        """, (plate_number.upper(), limit))
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
+                       ai.plate_number, ai.camera_ip, ai.download_success,
+                       ai.created_at, c.event_type, c.event_time
+                FROM alarm_images ai
+                LEFT JOIN camera c ON ai.event_id = c.id
+                WHERE ai.plate_number = $1
+                ORDER BY ai.created_at DESC
+                LIMIT $2
+            """, plate_number.upper(), limit)
         
         images = []
-        for row in cur.fetchall():
+        for row in rows:
             (img_id, filename, filepath, size, plate, camera_ip, success,
              created_at, event_type, event_time) = row
             
@@ -135,30 +122,25 @@ async def get_images_by_plate(plate_number: str, limit: int = 20):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/by-camera/{camera_ip}")
 async def get_images_by_camera(camera_ip: str, limit: int = 50):
     """Получить изображения для конкретной камеры"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
-                   ai.plate_number, ai.camera_ip, ai.download_success,
-                   ai.created_at, c.event_type, c.event_time
-            FROM alarm_images ai
-            LEFT JOIN camera c ON ai.event_id = c.id
-            WHERE ai.camera_ip = %s
-            ORDER BY ai.created_at DESC
-            LIMIT %s
-        """, (camera_ip, limit))
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT ai.id, ai.image_filename, ai.image_path, ai.image_size,
+                       ai.plate_number, ai.camera_ip, ai.download_success,
+                       ai.created_at, c.event_type, c.event_time
+                FROM alarm_images ai
+                LEFT JOIN camera c ON ai.event_id = c.id
+                WHERE ai.camera_ip = $1
+                ORDER BY ai.created_at DESC
+                LIMIT $2
+            """, camera_ip, limit)
         
         images = []
-        for row in cur.fetchall():
+        for row in rows:
             (img_id, filename, filepath, size, plate, camera_ip, success,
              created_at, event_type, event_time) = row
             
@@ -184,23 +166,17 @@ async def get_images_by_camera(camera_ip: str, limit: int = 50):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.delete("/{image_id}")
 async def delete_image(image_id: int):
     """Удалить изображение"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT image_filename, image_path FROM alarm_images
-            WHERE id = %s
-        """, (image_id,))
+        async with get_db_connection() as conn:
+            result = await conn.fetchrow("""
+                SELECT image_filename, image_path FROM alarm_images
+                WHERE id = $1
+            """, image_id)
         
-        result = cur.fetchone()
         if not result:
             raise HTTPException(status_code=404, detail="Image not found")
         
@@ -212,8 +188,8 @@ async def delete_image(image_id: int):
         else:
             file_deleted = False
 
-        cur.execute("DELETE FROM alarm_images WHERE id = %s", (image_id,))
-        conn.commit()
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM alarm_images WHERE id = $1", image_id)
         
         return {
             "status": "success",
@@ -224,53 +200,41 @@ async def delete_image(image_id: int):
         }
         
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/stats")
 async def get_image_stats():
     """Статистика по изображениям"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT 
-                COUNT(*) as total_images,
-                COUNT(*) FILTER (WHERE download_success = true) as successful_downloads,
-                COUNT(*) FILTER (WHERE download_success = false) as failed_downloads,
-                SUM(image_size) as total_size_bytes
-            FROM alarm_images
-        """)
-        
-        total_stats = cur.fetchone()
+        async with get_db_connection() as conn:
+            total_stats = await conn.fetchrow("""
+                SELECT 
+                    COUNT(*) as total_images,
+                    COUNT(*) FILTER (WHERE download_success = true) as successful_downloads,
+                    COUNT(*) FILTER (WHERE download_success = false) as failed_downloads,
+                    SUM(image_size) as total_size_bytes
+                FROM alarm_images
+            """)
 
-        cur.execute("""
-            SELECT camera_ip, 
-                   COUNT(*) as image_count,
-                   COUNT(*) FILTER (WHERE download_success = true) as successful_count,
-                   SUM(image_size) as total_size
-            FROM alarm_images
-            GROUP BY camera_ip
-            ORDER BY image_count DESC
-        """)
-        
-        camera_stats = cur.fetchall()
-        
-        cur.execute("""
-            SELECT DATE(created_at) as date,
-                   COUNT(*) as image_count,
-                   COUNT(*) FILTER (WHERE download_success = true) as successful_count
-            FROM alarm_images
-            WHERE created_at >= CURRENT_DATE - INTERVAL '7 days'
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-        """)
-        
-        daily_stats = cur.fetchall()
+            camera_stats = await conn.fetch("""
+                SELECT camera_ip, 
+                       COUNT(*) as image_count,
+                       COUNT(*) FILTER (WHERE download_success = true) as successful_count,
+                       SUM(image_size) as total_size
+                FROM alarm_images
+                GROUP BY camera_ip
+                ORDER BY image_count DESC
+            """)
+
+            daily_stats = await conn.fetch("""
+                SELECT DATE(created_at) as date,
+                       COUNT(*) as image_count,
+                       COUNT(*) FILTER (WHERE download_success = true) as successful_count
+                FROM alarm_images
+                WHERE created_at >= CURRENT_DATE - INTERVAL '7 days'
+                GROUP BY DATE(created_at)
+                ORDER BY date DESC
+            """)
         
         return {
             "status": "success",
@@ -302,6 +266,4 @@ async def get_image_stats():
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
         conn.close()
\ No newline at end of file
@@ -7,7 +7,7 @@ from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from datetime import datetime
 from typing import Optional, Dict, Any
-import requests
+import asyncio
 import uuid
 import json
 import logging
@@ -15,6 +15,8 @@ from ..config import KYRGYZSTAN_TZ, BAKAI_CONFIG, PARKING_CONFIG
 from ..db import get_db_connection
 from ..services.barrier import open_barrier
 from ..services.parking import format_duration
+from ..services.payment import bakai_client, BakaiError, PAID_STATUSES
+from ..services.payment_status import payment_status_poller
 
 
 logger = logging.getLogger(__name__)
@@ -35,15 +37,6 @@ class QRResponse(BaseModel):
     operation_id: str
     payment_status: str = "pending"
 
-def get_bakai_headers():
-    """Получить заголовки для запросов к Bakai API"""
-    return {
-        "Authorization": f"Bearer {BAKAI_CONFIG['token']}",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-
-
 @router.post("/generate-qr")
 async def generate_payment_qr(request: QRPaymentRequest):
     """
@@ -57,25 +50,22 @@ async def generate_payment_qr(request: QRPaymentRequest):
         raise HTTPException(status_code=500, detail="Bakai token not configured")
 
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-   
     try:
-        if request.session_id:
-            cur.execute("""
-                SELECT id, plate_number, entry_time, cost_amount, duration_minutes
-                FROM parking_visits
-                WHERE id = %s AND visit_status = 'completed'
-            """, (request.session_id,))
-        else:
-            cur.execute("""
-                SELECT id, plate_number, entry_time, cost_amount, duration_minutes
-                FROM parking_visits
-                WHERE plate_number = %s AND visit_status = 'completed'
-                ORDER BY exit_time DESC LIMIT 1
-            """, (request.plate_number.upper(),))
+        async with get_db_connection() as conn:
+            if request.session_id:
+                session = await conn.fetchrow("""
+                    SELECT id, plate_number, entry_time, cost_amount, duration_minutes
+                    FROM parking_visits
+                    WHERE id = $1 AND visit_status = 'completed'
+                """, request.session_id)
+            else:
+                session = await conn.fetchrow("""
+                    SELECT id, plate_number, entry_time, cost_amount, duration_minutes
+                    FROM parking_visits
+                    WHERE plate_number = $1 AND visit_status = 'completed'
+                    ORDER BY exit_time DESC LIMIT 1
+                """, request.plate_number.upper())
        
-        session = cur.fetchone()
         if not session:
             raise HTTPException(status_code=404, detail="No completed parking session found")
        
@@ -90,67 +80,40 @@ async def generate_payment_qr(request: QRPaymentRequest):
             }
 
         operation_id = str(uuid.uuid4())
-  
-        qr_payload = {
-            "accountNo": BAKAI_CONFIG["merchant_account"],
-            "currencyId": 417,
-            "amount": float(cost_amount),
-            "operationID": operation_id
-        }
-       
-        headers = get_bakai_headers()
        
         logger.info(f"Generating QR for plate {plate_number}, amount {cost_amount} KGS, operation_id: {operation_id}")
 
-        response = requests.post(
-            f"{BAKAI_CONFIG['api_base_url']}/api/Qr/GenerateQR",
-            json=qr_payload,
-            headers=headers,
-            timeout=BAKAI_CONFIG["timeout"]
-        )
-       
-        logger.info(f"Bakai QR API response status: {response.status_code}")
-        logger.info(f"Bakai QR API response: {response.text}")
-       
-        if response.status_code != 200:
-            logger.error(f"Bakai QR API error: {response.status_code} - {response.text}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"QR generation failed: {response.text}"
-            )
-       
-        qr_result = response.json()
-        qr_image = qr_result.get("qrImage")
-       
-        if not qr_image:
-            logger.error(f"No QR image in response: {qr_result}")
-            raise HTTPException(status_code=500, detail="No QR image in response")
+        try:
+            qr_result = await bakai_client.generate_qr(cost_amount, operation_id)
+        except BakaiError as e:
+            logger.error(f"Bakai QR API error: {e}")
+            if e.status_code is None:
+                raise HTTPException(status_code=503, detail=f"Payment service unavailable: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"QR generation failed: {str(e)}")
+        qr_image = qr_result["qr_image"]
 
         local_operation_id = str(uuid.uuid4())
-        cur.execute("""
-            INSERT INTO parking_payments
-            (session_id, plate_number, amount, local_operation_id, bakai_operation_id, qr_image, transaction_id, payment_link, payment_status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-            RETURNING id
-        """, (
-            session_id,
-            plate_number,
-            cost_amount,
-            local_operation_id,
-            None,
-            qr_image,
-            operation_id,
-            f"QR_PAYMENT_{operation_id}"
-        ))
-
-        payment_id = cur.fetchone()[0]
-        conn.commit()
-       
-        cur.execute("""
-            SELECT exit_time FROM parking_visits WHERE id = %s
-        """, (session_id,))
+        async with get_db_connection() as conn:
+            payment_id = await conn.fetchval("""
+                INSERT INTO parking_payments
+                (session_id, plate_number, amount, local_operation_id, bakai_operation_id, qr_image, transaction_id, payment_link, payment_status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, 'pending')
+                RETURNING id
+            """,
+                session_id,
+                plate_number,
+                cost_amount,
+                local_operation_id,
+                None,
+                qr_image,
+                operation_id,
+                f"QR_PAYMENT_{operation_id}"
+            )
+           
+            exit_time_result = await conn.fetchrow("""
+                SELECT exit_time FROM parking_visits WHERE id = $1
+            """, session_id)
        
-        exit_time_result = cur.fetchone()
         exit_time = exit_time_result[0] if exit_time_result else datetime.now(KYRGYZSTAN_TZ)
 
 
@@ -170,40 +133,39 @@ async def generate_payment_qr(request: QRPaymentRequest):
         logger.info(f"QR generated successfully for {plate_number}, operation_id: {operation_id}")
         return result
        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error calling Bakai API: {e}")
-        raise HTTPException(status_code=503, detail=f"Payment service unavailable: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error generating QR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.get("/check-status/{operation_id}")
 async def check_payment_status(operation_id: str):
     """
-    Проверка статуса платежа через Bakai API
-    ИСПРАВЛЕННАЯ ВЕРСИЯ - правильный URL и обработка ответов
+    Проверка статуса платежа: результат общего поллера операции,
+    сколько бы клиентов ни спрашивали - к банку не больше одного запроса
     """
     if not BAKAI_CONFIG["enable_payment_flow"]:
         raise HTTPException(status_code=503, detail="Payment flow is disabled")
-   
-    conn = get_db_connection()
-    cur = conn.cursor()
-   
+    return await payment_status_poller.get(operation_id)
+
+
+async def fetch_payment_status(operation_id: str) -> dict:
+    """
+    Проверка статуса платежа через Bakai API (вызывается только поллером)
+    ИСПРАВЛЕННАЯ ВЕРСИЯ - правильный URL и обработка ответов
+    """
     try:
-        cur.execute("""
-            SELECT pp.id, pp.session_id, pp.plate_number, pp.amount, pp.payment_status,
-                   pv.exit_camera_ip
-            FROM parking_payments pp
-            JOIN parking_visits pv ON pp.session_id = pv.id
-            WHERE pp.transaction_id = %s OR pp.bakai_operation_id = %s
-        """, (operation_id, operation_id))
+        async with get_db_connection() as conn:
+            payment = await conn.fetchrow("""
+                SELECT pp.id, pp.session_id, pp.plate_number, pp.amount, pp.payment_status,
+                       pv.exit_camera_ip
+                FROM parking_payments pp
+                JOIN parking_visits pv ON pp.session_id = pv.id
+                WHERE pp.transaction_id = $1 OR pp.bakai_operation_id = $1
+            """, operation_id)
        
-        payment = cur.fetchone()
         if not payment:
             logger.warning(f"Payment not found for operation_id: {operation_id}")
             return {
@@ -223,58 +185,38 @@ async def check_payment_status(operation_id: str):
                 "message": "Payment already confirmed"
             }
 
-        headers = get_bakai_headers()
-       
-        status_response = requests.get(
-            f"{BAKAI_CONFIG['api_base_url']}/api/Qr/GetStatus?operationID={operation_id}",
-            headers=headers,
-            timeout=BAKAI_CONFIG["timeout"]
-        )
+        bank_status = await bakai_client.get_status(operation_id)
        
-        logger.info(f"Bakai status API response: {status_response.status_code}")
-        logger.info(f"Bakai status API response body: {status_response.text}")
-       
-        if status_response.status_code == 200:
-            status_data = status_response.json()
-           
-            payment_status = None
-           
-            if "status" in status_data:
-                payment_status = status_data["status"].lower()
-            elif "paymentStatus" in status_data:
-                payment_status = status_data["paymentStatus"].lower()
-            elif "isPaid" in status_data and status_data["isPaid"]:
-                payment_status = "paid"
-            elif "success" in status_data and status_data["success"]:
-                payment_status = "paid"
+        if bank_status["http_status"] == 200:
+            payment_status = bank_status["status"]
            
             if not payment_status:
                 payment_status = current_status
-                logger.warning(f"Could not determine payment status from response: {status_data}")
+                logger.warning(f"Could not determine payment status from response: {bank_status['raw_response']}")
            
             logger.info(f"Payment status for {operation_id}: {payment_status}")
            
-            if payment_status in ["paid", "success", "completed", "approved"]:
-                cur.execute("""
-                    UPDATE parking_payments
-                    SET payment_status = 'paid',
-                        paid_at = %s,
-                        updated_at = %s
-                    WHERE id = %s
-                """, (datetime.now(KYRGYZSTAN_TZ), datetime.now(KYRGYZSTAN_TZ), payment_id))
-               
-                cur.execute("""
-                    UPDATE parking_visits
-                    SET payment_received = true,
-                        updated_at = %s
-                    WHERE id = %s
-                """, (datetime.now(KYRGYZSTAN_TZ), session_id))
-               
-                conn.commit()
+            if payment_status in PAID_STATUSES:
+                async with get_db_connection() as conn:
+                    async with conn.transaction():
+                        await conn.execute("""
+                            UPDATE parking_payments
+                            SET payment_status = 'paid',
+                                paid_at = $1,
+                                updated_at = $2
+                            WHERE id = $3
+                        """, datetime.now(KYRGYZSTAN_TZ), datetime.now(KYRGYZSTAN_TZ), payment_id)
+                       
+                        await conn.execute("""
+                            UPDATE parking_visits
+                            SET payment_received = true,
+                                updated_at = $1
+                            WHERE id = $2
+                        """, datetime.now(KYRGYZSTAN_TZ), session_id)
                
                 barrier_opened = False
                 if exit_camera_ip:
-                    barrier_opened = open_barrier(exit_camera_ip)
+                    barrier_opened = await open_barrier(exit_camera_ip)
                
                 logger.info(f"Payment confirmed for {plate_number}, barrier opened: {barrier_opened}")
                
@@ -288,13 +230,13 @@ async def check_payment_status(operation_id: str):
                 }
             else:
                 if payment_status != current_status:
-                    cur.execute("""
-                        UPDATE parking_payments
-                        SET payment_status = %s,
-                            updated_at = %s
-                        WHERE id = %s
-                    """, (payment_status, datetime.now(KYRGYZSTAN_TZ), payment_id))
-                    conn.commit()
+                    async with get_db_connection() as conn:
+                        await conn.execute("""
+                            UPDATE parking_payments
+                            SET payment_status = $1,
+                                updated_at = $2
+                            WHERE id = $3
+                        """, payment_status, datetime.now(KYRGYZSTAN_TZ), payment_id)
                
                 return {
                     "operation_id": operation_id,
@@ -303,7 +245,7 @@ async def check_payment_status(operation_id: str):
                     "message": f"Payment status: {payment_status}"
                 }
        
-        elif status_response.status_code == 404:
+        elif bank_status["http_status"] == 404:
             logger.warning(f"Operation not found in Bakai system: {operation_id}")
             return {
                 "operation_id": operation_id,
@@ -312,15 +254,15 @@ async def check_payment_status(operation_id: str):
                 "message": "Operation not found in payment system"
             }
         else:
-            logger.warning(f"Could not check payment status: {status_response.status_code} - {status_response.text}")
+            logger.warning(f"Could not check payment status: {bank_status['http_status']} - {bank_status['raw_response']}")
             return {
                 "operation_id": operation_id,
                 "payment_status": current_status,
                 "final": False,
-                "message": f"Status check unavailable: {status_response.status_code}"
+                "message": f"Status check unavailable: {bank_status['http_status']}"
             }
            
-    except requests.exceptions.RequestException as e:
+    except BakaiError as e:
         logger.error(f"Network error checking payment status: {e}")
         return {
             "operation_id": operation_id,
@@ -329,12 +271,11 @@ async def check_payment_status(operation_id: str):
             "error": "Payment service unavailable"
         }
     except Exception as e:
-        conn.rollback()
         logger.error(f"Error checking payment status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
+
+
+payment_status_poller.set_checker(fetch_payment_status)
 
 
 @router.post("/webhook")
@@ -384,18 +325,15 @@ async def handle_bakai_webhook(request: Request):
         
         logger.info(f"📋 Processing webhook - operation_id: {operation_id}, status: {payment_status}")
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         try:
-            cur.execute("""
-                SELECT pp.id, pp.session_id, pp.plate_number, pp.payment_status, pv.exit_camera_ip
-                FROM parking_payments pp
-                JOIN parking_visits pv ON pp.session_id = pv.id
-                WHERE pp.transaction_id = %s OR pp.bakai_operation_id = %s
-            """, (operation_id, operation_id))
+            async with get_db_connection() as conn:
+                payment = await conn.fetchrow("""
+                    SELECT pp.id, pp.session_id, pp.plate_number, pp.payment_status, pv.exit_camera_ip
+                    FROM parking_payments pp
+                    JOIN parking_visits pv ON pp.session_id = pv.id
+                    WHERE pp.transaction_id = $1 OR pp.bakai_operation_id = $1
+                """, operation_id)
             
-            payment = cur.fetchone()
             if not payment:
                 logger.error(f"❌ Payment not found for operation_id: {operation_id}")
                 return {"status": "error", "message": f"Payment not found for operation_id: {operation_id}"}
@@ -416,32 +354,32 @@ async def handle_bakai_webhook(request: Request):
                 
                 current_time = datetime.now(KYRGYZSTAN_TZ)
 
-                cur.execute("""
-                    UPDATE parking_payments
-                    SET payment_status = 'paid',
-                        paid_at = %s,
-                        updated_at = %s,
-                        notes = 'Confirmed via webhook'
-                    WHERE id = %s
-                """, (current_time, current_time, payment_id))
-
-                cur.execute("""
-                    UPDATE parking_visits
-                    SET payment_received = true,
-                        exit_barrier_opened = true,
-                        updated_at = %s,
-                        notes = COALESCE(notes, '') || ' | Payment confirmed via webhook'
-                    WHERE id = %s
-                """, (current_time, session_id))
-                
-                conn.commit()
+                async with get_db_connection() as conn:
+                    async with conn.transaction():
+                        await conn.execute("""
+                            UPDATE parking_payments
+                            SET payment_status = 'paid',
+                                paid_at = $1,
+                                updated_at = $2,
+                                notes = 'Confirmed via webhook'
+                            WHERE id = $3
+                        """, current_time, current_time, payment_id)
+
+                        await conn.execute("""
+                            UPDATE parking_visits
+                            SET payment_received = true,
+                                exit_barrier_opened = true,
+                                updated_at = $1,
+                                notes = COALESCE(notes, '') || ' | Payment confirmed via webhook'
+                            WHERE id = $2
+                        """, current_time, session_id)
 
                 barrier_opened = False
                 barrier_error = None
                 
                 if exit_camera_ip:
                     try:
-                        barrier_opened = open_barrier(exit_camera_ip)
+                        barrier_opened = await open_barrier(exit_camera_ip)
                         if barrier_opened:
                             logger.info(f"🚧 Barrier successfully opened for camera {exit_camera_ip}")
                         else:
@@ -470,15 +408,14 @@ async def handle_bakai_webhook(request: Request):
             elif payment_status in ["FAILED", "CANCELLED", "REJECTED", "ERROR"]:
                 logger.info(f"❌ Payment failed for {plate_number}, status: {payment_status}")
 
-                cur.execute("""
-                    UPDATE parking_payments
-                    SET payment_status = 'failed',
-                        updated_at = %s,
-                        notes = %s
-                    WHERE id = %s
-                """, (datetime.now(KYRGYZSTAN_TZ), f"Failed via webhook: {payment_status}", payment_id))
-                
-                conn.commit()
+                async with get_db_connection() as conn:
+                    await conn.execute("""
+                        UPDATE parking_payments
+                        SET payment_status = 'failed',
+                            updated_at = $1,
+                            notes = $2
+                        WHERE id = $3
+                    """, datetime.now(KYRGYZSTAN_TZ), f"Failed via webhook: {payment_status}", payment_id)
                 
                 return {
                     "status": "success",
@@ -491,16 +428,15 @@ async def handle_bakai_webhook(request: Request):
             else:
                 logger.info(f"📝 Unknown payment status '{payment_status}' for {plate_number}")
                 
-                cur.execute("""
-                    UPDATE parking_payments
-                    SET payment_status = %s,
-                        updated_at = %s,
-                        notes = %s
-                    WHERE id = %s
-                """, (payment_status.lower(), datetime.now(KYRGYZSTAN_TZ), 
-                      f"Status updated via webhook: {payment_status}", payment_id))
-                
-                conn.commit()
+                async with get_db_connection() as conn:
+                    await conn.execute("""
+                        UPDATE parking_payments
+                        SET payment_status = $1,
+                            updated_at = $2,
+                            notes = $3
+                        WHERE id = $4
+                    """, payment_status.lower(), datetime.now(KYRGYZSTAN_TZ), 
+                        f"Status updated via webhook: {payment_status}", payment_id)
                 
                 return {
                     "status": "success",
@@ -511,12 +447,8 @@ async def handle_bakai_webhook(request: Request):
                 }
                 
         except Exception as e:
-            conn.rollback()
             logger.error(f"❌ Database error processing webhook: {e}")
             return {"status": "error", "message": f"Database error: {str(e)}"}
-        finally:
-            cur.close()
-            conn.close()
             
     except Exception as e:
         logger.error(f"❌ Webhook processing error: {e}")
@@ -525,22 +457,20 @@ async def handle_bakai_webhook(request: Request):
 @router.get("/history/{plate_number}")
 async def get_payment_history(plate_number: str):
     """История платежей для конкретного номера"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-   
     try:
-        cur.execute("""
-            SELECT pp.id, pp.amount, pp.transaction_id, pp.payment_status,
-                   pp.created_at, pp.paid_at, pv.entry_time, pv.exit_time,
-                   pv.duration_minutes
-            FROM parking_payments pp
-            JOIN parking_visits pv ON pp.session_id = pv.id
-            WHERE pp.plate_number = %s
-            ORDER BY pp.created_at DESC LIMIT 20
-        """, (plate_number.upper(),))
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT pp.id, pp.amount, pp.transaction_id, pp.payment_status,
+                       pp.created_at, pp.paid_at, pv.entry_time, pv.exit_time,
+                       pv.duration_minutes
+                FROM parking_payments pp
+                JOIN parking_visits pv ON pp.session_id = pv.id
+                WHERE pp.plate_number = $1
+                ORDER BY pp.created_at DESC LIMIT 20
+            """, plate_number.upper())
        
         payments = []
-        for row in cur.fetchall():
+        for row in rows:
             (payment_id, amount, transaction_id, status, created_at, paid_at,
              entry_time, exit_time, duration_minutes) = row
              
@@ -564,53 +494,46 @@ async def get_payment_history(plate_number: str):
        
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.post("/manual-confirm/{operation_id}")
 async def manual_payment_confirmation(operation_id: str):
     """Ручное подтверждение платежа (для администраторов)"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-   
     try:
-        cur.execute("""
-            SELECT pp.id, pp.session_id, pp.plate_number, pv.exit_camera_ip
-            FROM parking_payments pp
-            JOIN parking_visits pv ON pp.session_id = pv.id
-            WHERE (pp.transaction_id = %s OR pp.bakai_operation_id = %s) AND pp.payment_status = 'pending'
-        """, (operation_id, operation_id))
-       
-        payment = cur.fetchone()
-        if not payment:
-            raise HTTPException(status_code=404, detail="Pending payment not found")
-       
-        payment_id, session_id, plate_number, exit_camera_ip = payment
-       
-        cur.execute("""
-            UPDATE parking_payments
-            SET payment_status = 'paid',
-                paid_at = %s,
-                updated_at = %s,
-                notes = 'Manually confirmed'
-            WHERE id = %s
-        """, (datetime.now(KYRGYZSTAN_TZ), datetime.now(KYRGYZSTAN_TZ), payment_id))
-       
-        cur.execute("""
-            UPDATE parking_visits
-            SET payment_received = true,
-                exit_barrier_opened = true,
-                updated_at = %s
-            WHERE id = %s
-        """, (datetime.now(KYRGYZSTAN_TZ), session_id))
-       
-        conn.commit()
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                payment = await conn.fetchrow("""
+                    SELECT pp.id, pp.session_id, pp.plate_number, pv.exit_camera_ip
+                    FROM parking_payments pp
+                    JOIN parking_visits pv ON pp.session_id = pv.id
+                    WHERE (pp.transaction_id = $1 OR pp.bakai_operation_id = $1) AND pp.payment_status = 'pending'
+                """, operation_id)
+               
+                if not payment:
+                    raise HTTPException(status_code=404, detail="Pending payment not found")
+               
+                payment_id, session_id, plate_number, exit_camera_ip = payment
+               
+                await conn.execute("""
+                    UPDATE parking_payments
+                    SET payment_status = 'paid',
+                        paid_at = $1,
+                        updated_at = $2,
+                        notes = 'Manually confirmed'
+                    WHERE id = $3
+                """, datetime.now(KYRGYZSTAN_TZ), datetime.now(KYRGYZSTAN_TZ), payment_id)
+               
+                await conn.execute("""
+                    UPDATE parking_visits
+                    SET payment_received = true,
+                        exit_barrier_opened = true,
+                        updated_at = $1
+                    WHERE id = $2
+                """, datetime.now(KYRGYZSTAN_TZ), session_id)
        
         barrier_opened = False
         if exit_camera_ip:
-            barrier_opened = open_barrier(exit_camera_ip)
+            barrier_opened = await open_barrier(exit_camera_ip)
        
         return {
             "operation_id": operation_id,
@@ -620,11 +543,7 @@ async def manual_payment_confirmation(operation_id: str):
         }
        
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.get("/webhook-test")
@@ -12,7 +12,7 @@ import uuid
 import json
 import logging
 from ..config import KYRGYZSTAN_TZ, BAKAI_CONFIG, PARKING_CONFIG
-from ..db import get_async_db_connection
+from ..db import get_db_connection
 from ..services.barrier import open_barrier
 from ..services.parking import format_duration
 
@@ -47,7 +47,7 @@ async def get_operation_info(operation_id: str):
     """
     Получить информацию о платеже и визите по operation_id (transaction_id или bakai_operation_id)
     """
-    async with await get_async_db_connection() as conn:
+    async with get_db_connection() as conn:
         row = await conn.fetchrow("""
             SELECT
                 pv.plate_number,
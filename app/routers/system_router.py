@@ -3,56 +3,90 @@
 """
 from fastapi import APIRouter, HTTPException
 import os
-import requests
-from requests.auth import HTTPDigestAuth
+import asyncio
+import httpx
 from datetime import datetime
 from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG, CAMERA_CONFIG, BARRIER_CONFIG
-from ..db import get_db_connection
-from ..services.camera import is_valid_plate, get_plate_format_bonus
-from ..services.parking import process_entry, process_exit
-from ..services.barrier import open_barrier
+from ..db import get_db_connection, check_db_health
+from ..services.camera import is_valid_plate, get_plate_format_bonus, events_log_writer
+from ..services.parking import process_entry, process_exit, expiry_stats, plate_locks
+from ..services.whitelist import whitelist_index
+from ..services.tariffs import tariff_cache
+from ..services.shared_state import shared_state
+from ..services.ingest import ingest_manager
+from ..services.lanes import lane_registry
+from ..services.payment import bakai_client
+from ..services.payment_status import payment_status_poller, payment_status_hub
+from ..services.admin_feed import admin_feed
+from ..services.response_cache import response_cache, data_versions
+from ..services.barrier import open_barrier, get_barrier_controller, barrier_state_poller
 from ..models import save_event
+from ..ws_manager import screen_ws_manager, barrier_ws_manager
 
 router = APIRouter(prefix="/system", tags=["system"])
 
 @router.get("/health")
 async def system_health():
     """Расширенная проверка здоровья системы"""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT 1")
-        cur.fetchone()
-        db_status = "ok"
-        cur.close()
-        conn.close()
-    except Exception as e:
-        db_status = f"error: {str(e)}"
+    db_pool = await check_db_health()
+    db_status = "ok" if db_pool["status"] == "ok" else f"error: {db_pool['error']}"
 
     images_dir_exists = os.path.exists(CAMERA_CONFIG["images_dir"])
     images_dir_writable = os.access(CAMERA_CONFIG["images_dir"], os.W_OK) if images_dir_exists else False
 
-    camera_status = {}
-    for camera_name, camera_ip in [("entry", PARKING_CONFIG["entry_camera_ip"]), ("exit", PARKING_CONFIG["exit_camera_ip"])]:
+    lanes = list(lane_registry.lanes.values())
+
+    async def check_camera(client, lane):
         try:
-            response = requests.get(f"http://{camera_ip}", timeout=5)
-            camera_status[camera_name] = "reachable"
-        except:
-            camera_status[camera_name] = "unreachable"
+            await client.get(f"http://{lane.camera_ip}")
+            return "reachable"
+        except Exception:
+            return "unreachable"
 
-    barrier_status = {}
-    for barrier_name, barrier_config in [("entry", BARRIER_CONFIG["entry_barrier"]), ("exit", BARRIER_CONFIG["exit_barrier"])]:
+    async def check_barrier(client, lane):
+        barrier = lane.barrier
         try:
-            url = f"http://{barrier_config['ip']}:{barrier_config['port']}/ISAPI/System/deviceInfo"
-            auth = HTTPDigestAuth(barrier_config['user'], barrier_config['password'])
-            response = requests.get(url, auth=auth, timeout=5)
-            barrier_status[barrier_name] = "reachable" if response.status_code in [200, 401] else "unreachable"
-        except:
-            barrier_status[barrier_name] = "unreachable"
-    
+            response = await client.get(
+                f"http://{barrier['ip']}:{barrier['port']}/ISAPI/System/deviceInfo",
+                auth=httpx.DigestAuth(barrier["user"], barrier["password"])
+            )
+            return "reachable" if response.status_code in [200, 401] else "unreachable"
+        except Exception:
+            return "unreachable"
+
+    # Все полосы проверяются параллельно, не блокируя event loop
+    async with httpx.AsyncClient(timeout=5, trust_env=False) as client:
+        barrier_lanes = [lane for lane in lanes if lane.barrier]
+        camera_results, barrier_results = await asyncio.gather(
+            asyncio.gather(*(check_camera(client, lane) for lane in lanes)),
+            asyncio.gather(*(check_barrier(client, lane) for lane in barrier_lanes))
+        )
+    camera_status = {lane.name: status for lane, status in zip(lanes, camera_results)}
+    barrier_status = {lane.name: status for lane, status in zip(barrier_lanes, barrier_results)}
+
     return {
         "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat(),
         "database": db_status,
+        "database_pool": db_pool,
+        "expired_sessions": expiry_stats,
+        "whitelist_index": whitelist_index.stats(),
+        "tariff_cache": tariff_cache.stats(),
+        "camera_events_log": events_log_writer.stats(),
+        "shared_state": shared_state.stats(),
+        "camera_ingest": ingest_manager.stats(),
+        "plate_locks": plate_locks.stats(),
+        "barrier_breakers": {
+            lane.name: get_barrier_controller(lane.camera_ip).stats()
+            for lane in lane_registry.lanes.values() if lane.barrier
+        },
+        "barrier_state_poller": barrier_state_poller.stats(),
+        "bakai_client": bakai_client.stats(),
+        "payment_status_poller": payment_status_poller.stats(),
+        "payment_status_hub": payment_status_hub.stats(),
+        "screen_ws": screen_ws_manager.stats(),
+        "barrier_ws": barrier_ws_manager.stats(),
+        "admin_feed": admin_feed.stats(),
+        "response_cache": response_cache.stats(),
         "images_directory": {
             "exists": images_dir_exists,
             "writable": images_dir_writable,
@@ -67,6 +101,7 @@ async def system_health():
             "night_rate": PARKING_CONFIG["night_rate"],
             "free_minutes": PARKING_CONFIG["free_minutes"],
             "session_timeout_hours": PARKING_CONFIG["session_timeout_hours"],
+            "expiry_check_interval_seconds": PARKING_CONFIG["expiry_check_interval_seconds"],
             "min_plate_length": PARKING_CONFIG["min_plate_length"]
         },
         "security_status": {
@@ -80,42 +115,31 @@ async def system_health():
 async def get_system_stats():
     """Общая статистика системы"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        cur.execute("SELECT COUNT(*) FROM camera")
-        total_events = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM camera WHERE plate_number != '' AND plate_number IS NOT NULL")
-        events_with_plates = cur.fetchone()[0]
+        async with get_db_connection() as conn:
+            total_events = await conn.fetchval("SELECT COUNT(*) FROM camera")
+            
+            events_with_plates = await conn.fetchval("SELECT COUNT(*) FROM camera WHERE plate_number != '' AND plate_number IS NOT NULL")
 
-        cur.execute("SELECT COUNT(*) FROM alarm_images WHERE download_success = true")
-        successful_images = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM alarm_images")
-        total_image_attempts = cur.fetchone()[0]
+            successful_images = await conn.fetchval("SELECT COUNT(*) FROM alarm_images WHERE download_success = true")
+            
+            total_image_attempts = await conn.fetchval("SELECT COUNT(*) FROM alarm_images")
 
-        cur.execute("""
-            SELECT
-                COUNT(*) FILTER (WHERE visit_status = 'active') as active_sessions,
-                COUNT(*) FILTER (WHERE visit_status = 'completed') as completed_sessions,
-                COUNT(*) FILTER (WHERE visit_status = 'timeout') as timeout_sessions,
-                COUNT(*) FILTER (WHERE entry_barrier_opened = true) as successful_entries,
-                COUNT(*) FILTER (WHERE exit_barrier_opened = true) as successful_exits
-            FROM parking_visits
-        """)
-        parking_stats = cur.fetchone()
+            parking_stats = await conn.fetchrow("""
+                SELECT
+                    COUNT(*) FILTER (WHERE visit_status = 'active') as active_sessions,
+                    COUNT(*) FILTER (WHERE visit_status = 'completed') as completed_sessions,
+                    COUNT(*) FILTER (WHERE visit_status = 'timeout') as timeout_sessions,
+                    COUNT(*) FILTER (WHERE entry_barrier_opened = true) as successful_entries,
+                    COUNT(*) FILTER (WHERE exit_barrier_opened = true) as successful_exits
+                FROM parking_visits
+            """)
 
-        cur.execute("""
-            SELECT camera_key, COUNT(*) as event_count,
-                   COUNT(*) FILTER (WHERE plate_number != '' AND plate_number IS NOT NULL) as plates_recognized
-            FROM camera
-            GROUP BY camera_key
-        """)
-        camera_breakdown = cur.fetchall()
-        
-        cur.close()
-        conn.close()
+            camera_breakdown = await conn.fetch("""
+                SELECT camera_key, COUNT(*) as event_count,
+                       COUNT(*) FILTER (WHERE plate_number != '' AND plate_number IS NOT NULL) as plates_recognized
+                FROM camera
+                GROUP BY camera_key
+            """)
         
         return {
             "total_events": total_events,
@@ -214,12 +238,13 @@ async def test_camera_event(camera_ip: str):
         plate = scenario["plate"]
         expected = scenario["should_open_barrier"]
 
-        event_id = save_event(f"test_{camera_ip}", "TEST_ANPR", plate, f"TEST_SCENARIO_{scenario['name']}")
+        event_id = await save_event(f"test_{camera_ip}", "TEST_ANPR", plate, f"TEST_SCENARIO_{scenario['name']}")
 
-        if camera_ip == PARKING_CONFIG["entry_camera_ip"]:
-            result = process_entry(camera_ip, plate, event_id)
-        elif camera_ip == PARKING_CONFIG["exit_camera_ip"]:
-            result = process_exit(camera_ip, plate, event_id)
+        lane = lane_registry.resolve(camera_ip)
+        if lane and lane.role == "entry":
+            result = await process_entry(lane.camera_ip, plate, event_id)
+        elif lane and lane.role == "exit":
+            result = await process_exit(lane.camera_ip, plate, event_id)
         else:
             result = {"barrier_opened": False, "message": "Unknown camera"}
         
@@ -248,10 +273,11 @@ async def test_camera_event(camera_ip: str):
 async def test_barrier_direct(camera_ip: str):
     """Прямое тестирование шлагбаума"""
     try:
-        if camera_ip not in [PARKING_CONFIG["entry_camera_ip"], PARKING_CONFIG["exit_camera_ip"]]:
+        lane = lane_registry.resolve(camera_ip)
+        if not lane or not lane.barrier:
             return {"error": f"Camera {camera_ip} not configured for barrier control"}
         
-        success = open_barrier(camera_ip)
+        success = await open_barrier(camera_ip)
         
         return {
             "status": "test_completed",
@@ -298,5 +324,21 @@ async def get_system_config():
                 "port": BARRIER_CONFIG["exit_barrier"]["port"],
                 "channel": BARRIER_CONFIG["exit_barrier"]["channel"]
             }
-        }
-    }
\ No newline at end of file
+        },
+        "lanes": lane_registry.stats()
+    }
+
+@router.get("/lanes")
+async def get_lanes():
+    """Реестр полос (камера -> роль, шлагбаум, оплата, канал экрана)"""
+    return lane_registry.stats()
+
+@router.post("/lanes/reload")
+async def reload_lanes():
+    """Перечитать LANES_FILE без перезапуска"""
+    try:
+        lane_registry.load()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Ошибка загрузки полос (оставлены прежние): {e}")
+    data_versions.bump("config")
+    return lane_registry.stats()
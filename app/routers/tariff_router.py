@@ -8,10 +8,13 @@ from typing import Optional
 from ..config import KYRGYZSTAN_TZ
 from ..db import get_db_connection
 from ..models import get_active_tariff, set_active_tariff, create_tariff
+from ..services.tariffs import tariff_cache
+from ..services.admin_feed import delta_response
+from ..services.response_cache import data_versions
 
 router = APIRouter(prefix="/tariffs", tags=["tariffs"])
 
-class TariffCreate(BaseModel):0
+class TariffCreate(BaseModel):
     name: str
     hourly_rate: float
     night_rate: float
@@ -34,7 +37,7 @@ class TariffUpdate(BaseModel):
 @router.get("/active")
 async def get_current_active_tariff():
     """Получить текущий активный тариф"""
-    tariff = get_active_tariff()
+    tariff = await get_active_tariff()
     if not tariff:
         raise HTTPException(status_code=404, detail="No active tariff found")
     
@@ -44,38 +47,51 @@ async def get_current_active_tariff():
         "timestamp": datetime.now(KYRGYZSTAN_TZ).isoformat()
     }
 
+async def fetch_tariff_list(ids=None):
+    """Тарифы (ids - только эти), новые сверху"""
+    query = """
+        SELECT id, name, hourly_rate, night_rate, free_minutes, max_hours,
+               is_active, valid_from, valid_until, description, created_at
+        FROM parking_tariffs
+    """
+    params = []
+    if ids is not None:
+        params.append(list(ids))
+        query += " WHERE id = ANY($1::int[])"
+    query += " ORDER BY created_at DESC"
+    async with get_db_connection() as conn:
+        rows = await conn.fetch(query, *params)
+
+    tariffs = []
+    for row in rows:
+        tariff_id, name, hourly_rate, night_rate, free_minutes, max_hours, is_active, valid_from, valid_until, description, created_at = row
+
+        tariffs.append({
+            "id": tariff_id,
+            "name": name,
+            "hourly_rate": float(hourly_rate),
+            "night_rate": float(night_rate),
+            "free_minutes": free_minutes,
+            "max_hours": max_hours,
+            "is_active": is_active,
+            "valid_from": valid_from.isoformat() if valid_from else None,
+            "valid_until": valid_until.isoformat() if valid_until else None,
+            "description": description,
+            "created_at": created_at.isoformat()
+        })
+    return tariffs
+
 @router.get("/list")
-async def list_all_tariffs():
-    """Получить список всех тарифов"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
+async def list_all_tariffs(since: Optional[int] = None):
+    """
+    Получить список всех тарифов.
+    since=<курсор> - только изменения после курсора ленты админки (since=0 - полный список с курсором)
+    """
     try:
-        cur.execute("""
-            SELECT id, name, hourly_rate, night_rate, free_minutes, max_hours,
-                   is_active, valid_from, valid_until, description, created_at
-            FROM parking_tariffs
-            ORDER BY created_at DESC
-        """)
-        
-        tariffs = []
-        for row in cur.fetchall():
-            tariff_id, name, hourly_rate, night_rate, free_minutes, max_hours, is_active, valid_from, valid_until, description, created_at = row
-            
-            tariffs.append({
-                "id": tariff_id,
-                "name": name,
-                "hourly_rate": float(hourly_rate),
-                "night_rate": float(night_rate),
-                "free_minutes": free_minutes,
-                "max_hours": max_hours,
-                "is_active": is_active,
-                "valid_from": valid_from.isoformat() if valid_from else None,
-                "valid_until": valid_until.isoformat() if valid_until else None,
-                "description": description,
-                "created_at": created_at.isoformat()
-            })
-        
+        if since is not None:
+            return await delta_response("tariffs", since, fetch_tariff_list)
+
+        tariffs = await fetch_tariff_list()
         return {
             "status": "success",
             "tariffs": tariffs,
@@ -84,15 +100,12 @@ async def list_all_tariffs():
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.post("/create")
 async def create_new_tariff(tariff_data: TariffCreate):
     """Создать новый тариф"""
     try:
-        tariff_id = create_tariff(
+        tariff_id = await create_tariff(
             name=tariff_data.name,
             hourly_rate=tariff_data.hourly_rate,
             night_rate=tariff_data.night_rate,
@@ -100,6 +113,8 @@ async def create_new_tariff(tariff_data: TariffCreate):
             max_hours=tariff_data.max_hours,
             description=tariff_data.description
         )
+        tariff_cache.invalidate()
+        data_versions.bump("tariffs")
         
         if not tariff_id:
             raise HTTPException(status_code=500, detail="Failed to create tariff")
@@ -117,22 +132,18 @@ async def create_new_tariff(tariff_data: TariffCreate):
 async def activate_tariff(tariff_id: int):
     """Активировать указанный тариф"""
     try:
-        success = set_active_tariff(tariff_id)
+        success = await set_active_tariff(tariff_id)
+        tariff_cache.invalidate()
+        data_versions.bump("tariffs")
         
         if not success:
             raise HTTPException(status_code=500, detail="Failed to activate tariff")
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT name, hourly_rate, night_rate FROM parking_tariffs
-            WHERE id = %s
-        """, (tariff_id,))
-        
-        tariff_info = cur.fetchone()
-        cur.close()
-        conn.close()
+        async with get_db_connection() as conn:
+            tariff_info = await conn.fetchrow("""
+                SELECT name, hourly_rate, night_rate FROM parking_tariffs
+                WHERE id = $1
+            """, tariff_id)
         
         if tariff_info:
             name, hourly_rate, night_rate = tariff_info
@@ -158,13 +169,11 @@ async def activate_tariff(tariff_id: int):
 @router.put("/{tariff_id}")
 async def update_tariff(tariff_id: int, tariff_data: TariffUpdate):
     """Обновить существующий тариф"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
         # Проверяем существование тарифа
-        cur.execute("SELECT id FROM parking_tariffs WHERE id = %s", (tariff_id,))
-        if not cur.fetchone():
+        async with get_db_connection() as conn:
+            exists = await conn.fetchval("SELECT id FROM parking_tariffs WHERE id = $1", tariff_id)
+        if not exists:
             raise HTTPException(status_code=404, detail="Tariff not found")
         
         # Строим динамический UPDATE запрос
@@ -172,41 +181,43 @@ async def update_tariff(tariff_id: int, tariff_data: TariffUpdate):
         update_values = []
         
         if tariff_data.name is not None:
-            update_fields.append("name = %s")
             update_values.append(tariff_data.name)
+            update_fields.append(f"name = ${len(update_values)}")
         if tariff_data.hourly_rate is not None:
-            update_fields.append("hourly_rate = %s")
             update_values.append(tariff_data.hourly_rate)
+            update_fields.append(f"hourly_rate = ${len(update_values)}")
         if tariff_data.night_rate is not None:
-            update_fields.append("night_rate = %s")
             update_values.append(tariff_data.night_rate)
+            update_fields.append(f"night_rate = ${len(update_values)}")
         if tariff_data.free_minutes is not None:
-            update_fields.append("free_minutes = %s")
             update_values.append(tariff_data.free_minutes)
+            update_fields.append(f"free_minutes = ${len(update_values)}")
         if tariff_data.max_hours is not None:
-            update_fields.append("max_hours = %s")
             update_values.append(tariff_data.max_hours)
+            update_fields.append(f"max_hours = ${len(update_values)}")
         if tariff_data.description is not None:
-            update_fields.append("description = %s")
             update_values.append(tariff_data.description)
+            update_fields.append(f"description = ${len(update_values)}")
         if tariff_data.valid_from is not None:
-            update_fields.append("valid_from = %s")
             update_values.append(tariff_data.valid_from)
+            update_fields.append(f"valid_from = ${len(update_values)}")
         if tariff_data.valid_until is not None:
-            update_fields.append("valid_until = %s")
             update_values.append(tariff_data.valid_until)
+            update_fields.append(f"valid_until = ${len(update_values)}")
         
         if not update_fields:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        update_fields.append("updated_at = %s")
         update_values.append(datetime.now(KYRGYZSTAN_TZ))
+        update_fields.append(f"updated_at = ${len(update_values)}")
         update_values.append(tariff_id)
         
-        query = f"UPDATE parking_tariffs SET {', '.join(update_fields)} WHERE id = %s"
+        query = f"UPDATE parking_tariffs SET {', '.join(update_fields)} WHERE id = ${len(update_values)}"
         
-        cur.execute(query, update_values)
-        conn.commit()
+        async with get_db_connection() as conn:
+            await conn.execute(query, *update_values)
+        tariff_cache.invalidate()
+        data_versions.bump("tariffs")
         
         return {
             "status": "success",
@@ -215,33 +226,28 @@ async def update_tariff(tariff_id: int, tariff_data: TariffUpdate):
         }
         
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.delete("/{tariff_id}")
 async def delete_tariff(tariff_id: int):
     """Удалить тариф (только неактивный)"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT name, is_active FROM parking_tariffs WHERE id = %s
-        """, (tariff_id,))
-        
-        tariff = cur.fetchone()
-        if not tariff:
-            raise HTTPException(status_code=404, detail="Tariff not found")
-        
-        name, is_active = tariff
-        if is_active:
-            raise HTTPException(status_code=400, detail="Cannot delete active tariff")
-        
-        cur.execute("DELETE FROM parking_tariffs WHERE id = %s", (tariff_id,))
-        conn.commit()
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                tariff = await conn.fetchrow("""
+                    SELECT name, is_active FROM parking_tariffs WHERE id = $1
+                """, tariff_id)
+                
+                if not tariff:
+                    raise HTTPException(status_code=404, detail="Tariff not found")
+                
+                name, is_active = tariff
+                if is_active:
+                    raise HTTPException(status_code=400, detail="Cannot delete active tariff")
+                
+                await conn.execute("DELETE FROM parking_tariffs WHERE id = $1", tariff_id)
+        tariff_cache.invalidate()
+        data_versions.bump("tariffs")
         
         return {
             "status": "success",
@@ -249,44 +255,34 @@ async def delete_tariff(tariff_id: int):
         }
         
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 @router.get("/stats")
 async def get_tariff_usage_stats():
     """Статистика использования тарифов"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT 
-                COUNT(*) as total_sessions,
-                SUM(cost_amount) as total_revenue,
-                AVG(cost_amount) as avg_cost,
-                AVG(duration_minutes) as avg_duration
-            FROM parking_visits
-            WHERE visit_status IN ('completed', 'manual')
-        """)
-        
-        total_stats = cur.fetchone()
-        
-        cur.execute("""
-            SELECT 
-                EXTRACT(DOW FROM entry_time) as day_of_week,
-                COUNT(*) as session_count,
-                AVG(cost_amount) as avg_cost
-            FROM parking_visits
-            WHERE visit_status IN ('completed', 'manual')
-            AND entry_time >= CURRENT_DATE - INTERVAL '30 days'
-            GROUP BY EXTRACT(DOW FROM entry_time)
-            ORDER BY day_of_week
-        """)
-        
-        weekly_stats = cur.fetchall()
+        async with get_db_connection() as conn:
+            total_stats = await conn.fetchrow("""
+                SELECT 
+                    COUNT(*) as total_sessions,
+                    SUM(cost_amount) as total_revenue,
+                    AVG(cost_amount) as avg_cost,
+                    AVG(duration_minutes) as avg_duration
+                FROM parking_visits
+                WHERE visit_status IN ('completed', 'manual')
+            """)
+
+            weekly_stats = await conn.fetch("""
+                SELECT 
+                    EXTRACT(DOW FROM entry_time) as day_of_week,
+                    COUNT(*) as session_count,
+                    AVG(cost_amount) as avg_cost
+                FROM parking_visits
+                WHERE visit_status IN ('completed', 'manual')
+                AND entry_time >= CURRENT_DATE - INTERVAL '30 days'
+                GROUP BY EXTRACT(DOW FROM entry_time)
+                ORDER BY day_of_week
+            """)
         
         return {
             "status": "success",
@@ -307,7 +303,4 @@ async def get_tariff_usage_stats():
         }
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+Лента изменений для админки вместо опроса списков каждые 5 секунд.
+Триггеры *_admin_change пишут каждое изменение визитов, оплат, белого списка
+и тарифов в admin_changes вместе с txid транзакции и шлют NOTIFY admin_changes.
+Слушатель процесса рассылает изменения подписчикам /ws/admin-feed,
+а списки с ?since=<курсор> отдают только строки, измененные после курсора.
+
+Курсор - xmin снимка (самая старая незавершенная транзакция), а не MAX(id):
+id выдается при INSERT, и транзакция, зафиксированная позже чужого чтения,
+со старым id осталась бы за курсором навсегда. Все txid меньше xmin уже
+завершены, поэтому изменение с txid >= курсора либо видно сейчас, либо придет
+в следующей дельте (повтор уже отданных строк безопасен - клиент их заменяет).
+Журнал хранится retention_hours; очистка запоминает наибольший удаленный txid
+(admin_changes_trim), и только курсор не больше него требует полного списка (reset).
+"""
+import asyncio
+import json
+import logging
+from ..config import ADMIN_FEED_CONFIG
+from ..db import get_db_connection
+from ..ws_manager import admin_ws_manager
+
+logger = logging.getLogger(__name__)
+
+# Имя в ленте -> таблица
+ADMIN_FEED_TABLES = {
+    "visits": "parking_visits",
+    "payments": "parking_payments",
+    "whitelist": "parking_whitelist",
+    "tariffs": "parking_tariffs"
+}
+FEED_NAMES = {table: name for name, table in ADMIN_FEED_TABLES.items()}
+# Колонки, которые показывает админка (списки и аналитика): UPDATE только других
+# колонок (например, отметки entry/exit_barrier_opened) в журнал не попадает
+ADMIN_FEED_COLUMNS = {
+    "parking_visits": ("plate_number", "entry_time", "exit_time", "visit_status", "entry_camera_ip", "duration_minutes")
+}
+
+
+class AdminFeed:
+    def __init__(self):
+        self.counters = {"notifications": 0, "resyncs": 0, "delta_reads": 0, "resets": 0}
+
+    async def on_notify(self, payload):
+        """Обработчик NOTIFY admin_changes; payload=None - переподключение, клиентам перечитать списки"""
+        if payload is None:
+            self.counters["resyncs"] += 1
+            await admin_ws_manager.broadcast({"type": "resync"})
+            return
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Bad admin_changes notification: {payload}")
+            return
+        self.counters["notifications"] += 1
+        await admin_ws_manager.broadcast({
+            "type": "change",
+            "feed": FEED_NAMES.get(data.get("table"), data.get("table")),
+            "id": data.get("id"),
+            "op": data.get("op")
+        })
+
+    async def current_cursor(self, conn) -> int:
+        """Курсор ленты: все транзакции с txid меньше него завершены"""
+        return await conn.fetchval("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+
+    async def changes_since(self, conn, feed: str, since: int):
+        """
+        Изменения ленты feed после курсора since: (cursor, ids измененных строк, reset).
+        reset=True - курсор 0, из будущего или изменения после него уже удалены очисткой.
+        Курсор берется до выборки изменений: все, что выборка не увидела, имеет txid >= курсора.
+        """
+        self.counters["delta_reads"] += 1
+        row = await conn.fetchrow("""
+            SELECT txid_snapshot_xmin(txid_current_snapshot()), (SELECT trimmed_txid FROM admin_changes_trim)
+        """)
+        cursor, trimmed = row[0], row[1]
+        if since <= 0 or since > cursor or (trimmed is not None and since <= trimmed):
+            self.counters["resets"] += 1
+            return cursor, [], True
+        rows = await conn.fetch("""
+            SELECT DISTINCT row_id FROM admin_changes
+            WHERE table_name = $1 AND txid >= $2
+        """, ADMIN_FEED_TABLES[feed], since)
+        return cursor, [row[0] for row in rows], False
+
+    async def trim(self) -> int:
+        """Удаляет записи старше retention_hours и поднимает отметку удаленного txid"""
+        async with get_db_connection() as conn:
+            return await conn.fetchval("""
+                WITH deleted AS (
+                    DELETE FROM admin_changes
+                    WHERE changed_at < NOW() - make_interval(secs => $1)
+                    RETURNING txid
+                ), mark AS (
+                    INSERT INTO admin_changes_trim (id, trimmed_txid)
+                    SELECT TRUE, MAX(txid) FROM deleted HAVING COUNT(*) > 0
+                    ON CONFLICT (id) DO UPDATE
+                        SET trimmed_txid = GREATEST(admin_changes_trim.trimmed_txid, EXCLUDED.trimmed_txid)
+                )
+                SELECT COUNT(*) FROM deleted
+            """, ADMIN_FEED_CONFIG["retention_hours"] * 3600)
+
+    def stats(self) -> dict:
+        return {**self.counters, "subscribers": admin_ws_manager.stats()}
+
+
+admin_feed = AdminFeed()
+
+
+async def delta_response(feed: str, since: int, fetch_items):
+    """
+    Ответ списка с ?since=: fetch_items(ids) возвращает строки с полем id
+    (ids=None - полный список). items - измененные строки, прошедшие фильтры списка,
+    removed - измененные id, которых в списке больше нет (удалены или не подходят под фильтр).
+    """
+    async with get_db_connection() as conn:
+        cursor, changed_ids, reset = await admin_feed.changes_since(conn, feed, since)
+    if reset:
+        return {"cursor": cursor, "reset": True, "items": await fetch_items(None), "removed": []}
+    items = await fetch_items(changed_ids) if changed_ids else []
+    present = {item["id"] for item in items}
+    return {
+        "cursor": cursor,
+        "reset": False,
+        "items": items,
+        "removed": [row_id for row_id in changed_ids if row_id not in present]
+    }
+
+
+async def admin_feed_trim_task():
+    """Периодическая очистка admin_changes (запускается из lifespan)"""
+    while True:
+        await asyncio.sleep(ADMIN_FEED_CONFIG["trim_interval_seconds"])
+        try:
+            deleted = await admin_feed.trim()
+            if deleted:
+                print(f"🧹 Admin feed: removed {deleted} old changes")
+        except Exception as e:
+            print(f"❌ Admin feed trim error: {e}")
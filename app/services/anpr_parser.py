@@ -0,0 +1,169 @@
+"""
+Разбор событий ANPR камер Hikvision (multipart/form-data: XML/JSON + JPEG).
+Тело делится по boundary один раз, текстовая часть разбирается в AnprEvent,
+изображения остаются срезами memoryview без копирования.
+"""
+import json
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import List, Optional
+from .camera import (
+    find_plate_number, find_event_type, find_picture_url, is_valid_plate,
+    STRUCTURED_XML_PRIORITY, STRUCTURED_JSON_PRIORITY
+)
+
+BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+PICTURE_URL_FIELDS = ("pictureurl", "imageurl", "snapshoturl", "filename", "picture", "image")
+LANE_FIELDS = ("lane", "laneno", "lanenumber", "line")
+
+
+@dataclass
+class AnprImage:
+    name: str
+    content_type: str
+    data: memoryview
+
+
+@dataclass
+class AnprEvent:
+    ip_address: Optional[str] = None
+    plate: str = ""
+    event_type: str = ""
+    picture_url: str = ""
+    confidence: Optional[float] = None
+    direction: Optional[str] = None
+    lane: Optional[str] = None
+    text: str = ""
+    images: List[AnprImage] = field(default_factory=list)
+
+
+def _part_headers(raw: memoryview) -> dict:
+    headers = {}
+    for line in bytes(raw).decode("latin-1").split("\r\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def split_multipart(body: bytes, boundary: str):
+    """Выдает (headers, memoryview тела части) для каждой части multipart"""
+    view = memoryview(body)
+    delimiter = b"--" + boundary.encode("latin-1")
+    position = body.find(delimiter)
+    while position != -1:
+        start = position + len(delimiter)
+        if body[start:start + 2] == b"--":
+            return
+        next_position = body.find(delimiter, start)
+        end = next_position if next_position != -1 else len(body)
+        header_end = body.find(b"\r\n\r\n", start, end)
+        if header_end != -1:
+            content_end = end - 2 if body[end - 2:end] == b"\r\n" else end
+            yield _part_headers(view[start:header_end]), view[header_end + 4:content_end]
+        position = next_position
+
+
+def _collect_xml_fields(text: str) -> dict:
+    """Первое значение каждого тега (локальное имя в нижнем регистре)"""
+    fields = {}
+    root = ET.fromstring(text)
+    for element in root.iter():
+        name = element.tag.rsplit("}", 1)[-1].lower()
+        value = (element.text or "").strip()
+        if value and name not in fields:
+            fields[name] = value
+    return fields
+
+
+def _collect_json_fields(data, fields: dict) -> dict:
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, (dict, list)):
+                _collect_json_fields(value, fields)
+            elif value not in (None, "") and key.lower() not in fields:
+                fields[key.lower()] = str(value).strip()
+    elif isinstance(data, list):
+        for item in data:
+            _collect_json_fields(item, fields)
+    return fields
+
+
+def _structured_plate(fields: dict, priorities: dict) -> str:
+    best_plate, best_priority = "", -1
+    for name, priority in priorities.items():
+        plate = ''.join(c for c in fields.get(name, "").upper() if c.isalnum())
+        if plate and priority > best_priority and is_valid_plate(plate):
+            best_plate, best_priority = plate, priority
+    return best_plate
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_anpr_event(body: bytes, content_type: str = "") -> AnprEvent:
+    """Разбирает тело события камеры в AnprEvent"""
+    event = AnprEvent()
+    text_parts = []
+
+    boundary_match = BOUNDARY_RE.search(content_type or "")
+    if boundary_match:
+        for headers, content in split_multipart(body, boundary_match.group(1)):
+            part_type = headers.get("content-type", "").lower()
+            if part_type.startswith("image/") or bytes(content[:3]) == JPEG_MAGIC:
+                disposition = headers.get("content-disposition", "")
+                name_match = re.search(r'name="([^"]*)"', disposition)
+                event.images.append(AnprImage(
+                    name=name_match.group(1) if name_match else "",
+                    content_type=part_type or "image/jpeg",
+                    data=content
+                ))
+            else:
+                text_parts.append(bytes(content).decode("utf-8", errors="ignore"))
+    else:
+        text_parts.append(body.decode("utf-8", errors="ignore"))
+
+    event.text = "\n".join(part.strip() for part in text_parts if part.strip())
+    if not event.text:
+        return event
+
+    fields = None
+    priorities = STRUCTURED_XML_PRIORITY
+    for part in text_parts:
+        part = part.strip()
+        try:
+            if part.startswith("<"):
+                fields = _collect_xml_fields(part)
+            elif part.startswith("{") or part.startswith("["):
+                fields = _collect_json_fields(json.loads(part), {})
+                priorities = STRUCTURED_JSON_PRIORITY
+        except (ET.ParseError, ValueError):
+            fields = None
+        if fields:
+            break
+
+    if fields:
+        event.ip_address = fields.get("ipaddress")
+        event.plate = _structured_plate(fields, priorities)
+        event.event_type = fields.get("eventtype", "")
+        event.picture_url = next((fields[name] for name in PICTURE_URL_FIELDS if fields.get(name)), "")
+        event.confidence = _to_float(fields.get("confidencelevel") or fields.get("confidence"))
+        event.direction = fields.get("direction")
+        event.lane = next((fields[name] for name in LANE_FIELDS if fields.get(name)), None)
+
+    # Нестандартный payload - прежний эвристический поиск по тексту (без бинарных частей)
+    if not event.plate:
+        event.plate = find_plate_number(event.text)
+    if not event.event_type:
+        event.event_type = find_event_type(event.text)
+    if not event.picture_url and not fields:
+        event.picture_url = find_picture_url(event.text)
+
+    return event
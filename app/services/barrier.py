@@ -1,194 +1,383 @@
 """
-Модуль управления шлагбаумом
+Модуль управления шлагбаумом.
+На каждый шлагбаум - один BarrierController с постоянным httpx.AsyncClient
+(keep-alive) и одним экземпляром DigestAuth: после первого 401 nonce
+переиспользуется, и команда уходит одним запросом по уже открытому соединению.
+
+Команды одного шлагбаума выполняются по очереди. Одинаковые команды
+(въезд + webhook оплаты + кнопка админа) склеиваются: пока команда в работе -
+ждут ее результат, после успеха еще barrier_coalesce_seconds отвечают успехом
+без запроса к устройству. Ошибки повторяются с jitter backoff, после
+barrier_breaker_threshold неудачных команд подряд breaker размыкается
+и вызовы сразу получают False до истечения barrier_breaker_reset_seconds;
+затем проходит одна пробная команда, остальные отклоняются до ее результата.
 """
-import requests
-from requests.auth import HTTPDigestAuth
-from ..config import BARRIER_CONFIG, PARKING_CONFIG
+import asyncio
+import contextvars
+import random
+import time
+import xml.etree.ElementTree as ET
+import httpx
+from datetime import datetime
+from ..config import PARKING_CONFIG, KYRGYZSTAN_TZ
+from ..ws_manager import barrier_ws_manager
+from .lanes import lane_registry
 
+GATE_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<BarrierGate><ctrlMode>{mode}</ctrlMode></BarrierGate>'''
 
-def open_barrier(camera_ip: str) -> bool:
-    """Открывает шлагбаум для указанной камеры"""
-    try:
-        barrier_config = None
-        if camera_ip == PARKING_CONFIG["entry_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["entry_barrier"]
-        elif camera_ip == PARKING_CONFIG["exit_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["exit_barrier"]
-        else:
-            print(f"⚠️ No barrier configuration for camera {camera_ip}")
-            return False
+# Дедлайн обработки события (time.monotonic()): повторы команды не выходят за бюджет события
+event_deadline = contextvars.ContextVar("event_deadline", default=None)
 
-        IP = barrier_config["ip"]
-        PORT = barrier_config["port"]
-        USER = barrier_config["user"]
-        PASS = barrier_config["password"]
-        CHANNEL = barrier_config["channel"]
+BARRIER_DEADLINE_MARGIN_SECONDS = 0.5
 
-        URL = f"http://{IP}:{PORT}/ISAPI/Parking/channels/{CHANNEL}/barrierGate"
-        AUTH = HTTPDigestAuth(USER, PASS)
-        HEADERS = {"Content-Type": "application/xml"}
 
-        xml_data = '''<?xml version="1.0" encoding="utf-8"?>
-<BarrierGate><ctrlMode>open</ctrlMode></BarrierGate>'''
+def barrier_worst_case_seconds() -> float:
+    """Худшее время команды без дедлайна: все попытки по таймауту плюс максимальный backoff"""
+    attempts = PARKING_CONFIG["barrier_retry_attempts"]
+    backoff = PARKING_CONFIG["barrier_retry_backoff_seconds"]
+    return (
+        attempts * PARKING_CONFIG["barrier_timeout_seconds"]
+        + sum(2 * backoff * 2 ** (attempt - 1) for attempt in range(1, attempts))
+    )
 
-        print(f"🔄 Открываем шлагбаум для камеры {camera_ip}...")
 
-        try:
-            response = requests.put(
-                URL,
-                auth=AUTH,
-                headers=HEADERS,
-                data=xml_data.encode('utf-8'),
-                timeout=10
-            )
-        except requests.exceptions.Timeout:
-            print(f"⏱️ Таймаут: шлагбаум {camera_ip} не отвечает (timeout)")
-            return False
-        except requests.exceptions.ConnectionError:
-            print(f"🌐 Нет соединения: шлагбаум {camera_ip} физически недоступен (connection error)")
-            return False
-        except Exception as e:
-            print(f"❌ Ошибка сети при открытии шлагбаума {camera_ip}: {e}")
-            return False
+_short_budget_warnings = set()
 
-        print(f"📊 Код ответа: {response.status_code}")
-        print(f"📝 Ответ: {response.text}")
 
-        if response.status_code == 200:
-            print(f"✅ Шлагбаум для камеры {camera_ip} успешно открыт!")
-            return True
-        elif response.status_code == 403:
-            print("⚠️ Ошибка авторизации - проверьте логин/пароль")
-        else:
-            print(f"⚠️ Неожиданный код: {response.status_code}")
+def warn_if_event_budget_short(budget: float):
+    """
+    Предупреждает (один раз на значение), если бюджет события не вмещает все попытки
+    команды: последние повторы будут обрезаны дедлайном. Конфигурация не меняется.
+    """
+    worst_case = barrier_worst_case_seconds()
+    if budget <= worst_case and budget not in _short_budget_warnings:
+        _short_budget_warnings.add(budget)
+        print(f"⚠️ EVENT_BUDGET {budget}s <= barrier worst case {worst_case:.1f}s - повторы шлагбаума обрезаются дедлайном события")
 
-        return False
 
-    except Exception as e:
-        print(f"❌ Ошибка открытия шлагбаума для {camera_ip}: {e}")
-        return False
+COMMAND_NAMES = {
+    "open": ("Открываем", "открытии", "открыт"),
+    "close": ("Закрываем", "закрытии", "закрыт"),
+}
 
-def close_barrier(camera_ip: str) -> bool:
-    """Закрывает шлагбаум для указанной камеры"""
-    try:
-        barrier_config = None
-        if camera_ip == PARKING_CONFIG["entry_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["entry_barrier"]
-        elif camera_ip == PARKING_CONFIG["exit_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["exit_barrier"]
-        else:
-            print(f"⚠️ No barrier configuration for camera {camera_ip}")
-            return False
 
-        IP = barrier_config["ip"]
-        PORT = barrier_config["port"]
-        USER = barrier_config["user"]
-        PASS = barrier_config["password"]
-        CHANNEL = barrier_config["channel"]
+class BarrierController:
+    def __init__(self, camera_ip: str, barrier_config: dict):
+        self.camera_ip = camera_ip
+        self.barrier_config = barrier_config
+        self.base_url = f"http://{barrier_config['ip']}:{barrier_config['port']}"
+        self.gate_path = f"/ISAPI/Parking/channels/{barrier_config['channel']}/barrierGate"
+        self.auth = httpx.DigestAuth(barrier_config["user"], barrier_config["password"])
+        self.client = None
+        self.queue_lock = asyncio.Lock()
+        self.waiting = 0
+        self.inflight = {}
+        self.last_success = {}
+        self.breaker_state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.counters = {"commands": 0, "coalesced": 0, "retries": 0, "failed": 0, "rejected": 0}
+
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=self.auth,
+                timeout=httpx.Timeout(
+                    PARKING_CONFIG["barrier_timeout_seconds"],
+                    connect=PARKING_CONFIG["barrier_connect_timeout_seconds"]
+                ),
+                limits=httpx.Limits(max_connections=2, max_keepalive_connections=2, keepalive_expiry=60),
+                trust_env=False
+            )
+        return self.client
+
+    async def command(self, mode: str) -> bool:
+        """Отправляет команду open/close через очередь шлагбаума, True - если выполнена"""
+        inflight = self.inflight.get(mode)
+        if inflight is not None:
+            self.counters["coalesced"] += 1
+            print(f"🔗 Команда {mode} для {self.camera_ip} уже выполняется - ждем ее результат")
+            return await asyncio.shield(inflight)
 
-        URL = f"http://{IP}:{PORT}/ISAPI/Parking/channels/{CHANNEL}/barrierGate"
-        AUTH = HTTPDigestAuth(USER, PASS)
-        HEADERS = {"Content-Type": "application/xml"}
+        done_at = self.last_success.get(mode)
+        if done_at is not None and time.monotonic() - done_at < PARKING_CONFIG["barrier_coalesce_seconds"]:
+            self.counters["coalesced"] += 1
+            print(f"🔗 Команда {mode} для {self.camera_ip} уже выполнена только что - повтор не отправляем")
+            return True
 
-        xml_data = '''<?xml version="1.0" encoding="utf-8"?>
-<BarrierGate><ctrlMode>close</ctrlMode></BarrierGate>'''
+        if not self._breaker_allows():
+            self.counters["rejected"] += 1
+            reason = "идет пробная команда" if self.breaker_state == "half_open" else "разомкнут"
+            print(f"🚫 Breaker шлагбаума {self.camera_ip}: {reason} - команда {mode} отклонена")
+            return False
 
-        print(f"🔄 Закрываем шлагбаум для камеры {camera_ip}...")
+        task = asyncio.create_task(self._run(mode, event_deadline.get()))
+        self.inflight[mode] = task
+        task.add_done_callback(lambda _: self.inflight.pop(mode, None))
+        return await asyncio.shield(task)
 
+    async def _run(self, mode: str, deadline: float = None) -> bool:
+        """deadline - time.monotonic() конца бюджета события: после него попыток не начинаем"""
+        # waiting - команды, ждущие очереди устройства (одна команда за раз)
+        self.waiting += 1
         try:
-            response = requests.put(
-                URL,
-                auth=AUTH,
-                headers=HEADERS,
-                data=xml_data.encode('utf-8'),
-                timeout=10
-            )
-        except requests.exceptions.Timeout:
-            print(f"⏱️ Таймаут: шлагбаум {camera_ip} не отвечает (timeout)")
-            return False
-        except requests.exceptions.ConnectionError:
-            print(f"🌐 Нет соединения: шлагбаум {camera_ip} физически недоступен (connection error)")
+            await self.queue_lock.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            self.counters["commands"] += 1
+            attempts = PARKING_CONFIG["barrier_retry_attempts"]
+            for attempt in range(attempts):
+                if attempt:
+                    backoff = PARKING_CONFIG["barrier_retry_backoff_seconds"] * 2 ** (attempt - 1)
+                    delay = backoff + random.uniform(0, backoff)
+                    if deadline is not None and time.monotonic() + delay >= deadline:
+                        break
+                    self.counters["retries"] += 1
+                    await asyncio.sleep(delay)
+                timeout = PARKING_CONFIG["barrier_timeout_seconds"]
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        print(f"⏱️ Бюджет события исчерпан - команда {mode} для {self.camera_ip} не отправлена")
+                        break
+                status_code = await self._send(mode, timeout)
+                if status_code == 200:
+                    self._record_success(mode)
+                    return True
+                if status_code is not None and status_code < 500:
+                    break
+            self._record_failure()
             return False
+        finally:
+            self.queue_lock.release()
+
+    async def _send(self, mode: str, timeout: float):
+        """Один запрос к устройству (не дольше timeout): код ответа или None при сетевой ошибке"""
+        verb, action, done = COMMAND_NAMES[mode]
+        print(f"🔄 {verb} шлагбаум для камеры {self.camera_ip}...")
+
+        try:
+            response = await self._client().put(
+                self.gate_path,
+                headers={"Content-Type": "application/xml"},
+                content=GATE_XML.format(mode=mode).encode("utf-8"),
+                timeout=httpx.Timeout(
+                    timeout,
+                    connect=min(timeout, PARKING_CONFIG["barrier_connect_timeout_seconds"])
+                )
+            )
+        except httpx.TimeoutException:
+            print(f"⏱️ Таймаут: шлагбаум {self.camera_ip} не отвечает (timeout)")
+            return None
+        except httpx.ConnectError:
+            print(f"🌐 Нет соединения: шлагбаум {self.camera_ip} физически недоступен (connection error)")
+            return None
         except Exception as e:
-            print(f"❌ Ошибка сети при закрытии шлагбаума {camera_ip}: {e}")
-            return False
+            print(f"❌ Ошибка сети при {action} шлагбаума {self.camera_ip}: {e}")
+            return None
 
         print(f"📊 Код ответа: {response.status_code}")
         print(f"📝 Ответ: {response.text}")
 
         if response.status_code == 200:
-            print(f"✅ Шлагбаум для камеры {camera_ip} успешно закрыт!")
-            return True
-        elif response.status_code == 403:
+            print(f"✅ Шлагбаум для камеры {self.camera_ip} успешно {done}!")
+        elif response.status_code in (401, 403):
             print("⚠️ Ошибка авторизации - проверьте логин/пароль")
         else:
             print(f"⚠️ Неожиданный код: {response.status_code}")
 
-        return False
+        return response.status_code
 
-    except Exception as e:
-        print(f"❌ Ошибка закрытия шлагбаума для {camera_ip}: {e}")
+    def _breaker_allows(self) -> bool:
+        """closed - пропускает все; half_open - только одну пробную команду, до ее результата остальные отклоняются"""
+        if self.breaker_state == "closed":
+            return True
+        if self.breaker_state == "half_open":
+            return False
+        if time.monotonic() - self.opened_at >= PARKING_CONFIG["barrier_breaker_reset_seconds"]:
+            self.breaker_state = "half_open"
+            print(f"🟡 Breaker шлагбаума {self.camera_ip}: пробная команда")
+            return True
         return False
 
-def get_barrier_state(camera_ip: str) -> str:
-    """Получает состояние шлагбаума для указанной камеры"""
-    try:
-        barrier_config = None
-        if camera_ip == PARKING_CONFIG["entry_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["entry_barrier"]
-        elif camera_ip == PARKING_CONFIG["exit_camera_ip"]:
-            barrier_config = BARRIER_CONFIG["exit_barrier"]
-        else:
-            print(f"⚠️ No barrier configuration for camera {camera_ip}")
-            return "unknown"
+    def _record_success(self, mode: str):
+        if self.breaker_state != "closed":
+            print(f"🟢 Breaker шлагбаума {self.camera_ip} замкнут")
+        self.breaker_state = "closed"
+        self.consecutive_failures = 0
+        # Открытие после закрытия (и наоборот) - новая команда, не повтор
+        self.last_success = {mode: time.monotonic()}
+
+    def _record_failure(self):
+        self.counters["failed"] += 1
+        self.consecutive_failures += 1
+        if self.breaker_state == "half_open" or (
+            self.breaker_state == "closed"
+            and self.consecutive_failures >= PARKING_CONFIG["barrier_breaker_threshold"]
+        ):
+            self.breaker_state = "open"
+            self.opened_at = time.monotonic()
+            print(f"🔴 Breaker шлагбаума {self.camera_ip} разомкнут после {self.consecutive_failures} ошибок подряд")
 
-        IP = barrier_config["ip"]
-        PORT = barrier_config["port"]
-        USER = barrier_config["user"]
-        PASS = barrier_config["password"]
-        CHANNEL = barrier_config["channel"]
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker_state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_for_seconds": round(time.monotonic() - self.opened_at, 1) if self.breaker_state == "open" else 0,
+            "inflight": len(self.inflight),
+            "waiting": self.waiting,
+            **self.counters
+        }
 
-        URL = f"http://{IP}:{PORT}/ISAPI/Parking/channels/{CHANNEL}/barrierGate/status"
-        AUTH = HTTPDigestAuth(USER, PASS)
+    async def open(self) -> bool:
+        return await self.command("open")
 
-        print(f"🔄 Получаем состояние шлагбаума для камеры {camera_ip}...")
+    async def close(self) -> bool:
+        return await self.command("close")
+
+    async def state(self, verbose: bool = True) -> str:
+        """Состояние шлагбаума (barrierState) или код ошибки; verbose=False - без логов (для поллера)"""
+        log = print if verbose else (lambda *args: None)
+        log(f"🔄 Получаем состояние шлагбаума для камеры {self.camera_ip}...")
 
         try:
-            response = requests.get(
-                URL,
-                auth=AUTH,
-                timeout=10
-            )
-        except requests.exceptions.Timeout:
-            print(f"⏱️ Таймаут: шлагбаум {camera_ip} не отвечает (timeout)")
+            response = await self._client().get(f"{self.gate_path}/status")
+        except httpx.TimeoutException:
+            log(f"⏱️ Таймаут: шлагбаум {self.camera_ip} не отвечает (timeout)")
             return "timeout"
-        except requests.exceptions.ConnectionError:
-            print(f"🌐 Нет соединения: шлагбаум {camera_ip} физически недоступен (connection error)")
+        except httpx.ConnectError:
+            log(f"🌐 Нет соединения: шлагбаум {self.camera_ip} физически недоступен (connection error)")
             return "connection_error"
         except Exception as e:
-            print(f"❌ Ошибка сети при получении состояния шлагбаума {camera_ip}: {e}")
+            log(f"❌ Ошибка сети при получении состояния шлагбаума {self.camera_ip}: {e}")
             return "error"
 
-        print(f"📊 Код ответа: {response.status_code}")
-        print(f"📝 Ответ: {response.text}")
+        log(f"📊 Код ответа: {response.status_code}")
+        log(f"📝 Ответ: {response.text}")
 
         if response.status_code == 200:
-            import xml.etree.ElementTree as ET
             try:
-                root = ET.fromstring(response.text)
-                state = root.findtext("barrierState")
-                print(f"✅ Состояние шлагбаума: {state}")
+                state = ET.fromstring(response.text).findtext("barrierState")
+                log(f"✅ Состояние шлагбаума: {state}")
                 return state if state else "unknown"
             except Exception as e:
-                print(f"❌ Ошибка парсинга XML: {e}")
+                log(f"❌ Ошибка парсинга XML: {e}")
                 return "parse_error"
-        elif response.status_code == 403:
-            print("⚠️ Ошибка авторизации - проверьте логин/пароль")
+        elif response.status_code in (401, 403):
+            log("⚠️ Ошибка авторизации - проверьте логин/пароль")
             return "auth_error"
         else:
-            print(f"⚠️ Неожиданный код: {response.status_code}")
+            log(f"⚠️ Неожиданный код: {response.status_code}")
             return "unexpected_code"
 
-    except Exception as e:
-        print(f"❌ Ошибка получения состояния шлагбаума для {camera_ip}: {e}")
-        return "error"
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+barrier_controllers = {}
+# Закрытие соединений замененных контроллеров: ссылка держится до завершения задачи
+closing_tasks = set()
+
+
+def get_barrier_controller(camera_ip: str):
+    """BarrierController полосы камеры или None, если шлагбаум для нее не настроен"""
+    lane = lane_registry.resolve(camera_ip)
+    if lane is None or not lane.barrier:
+        print(f"⚠️ No barrier configuration for camera {camera_ip}")
+        return None
+
+    controller = barrier_controllers.get(lane.name)
+    if controller is None or controller.barrier_config != lane.barrier:
+        # Новая полоса или шлагбаум изменен в реестре - соединение старого закрываем
+        if controller is not None:
+            task = asyncio.create_task(controller.aclose())
+            closing_tasks.add(task)
+            task.add_done_callback(closing_tasks.discard)
+        controller = BarrierController(lane.camera_ip, lane.barrier)
+        barrier_controllers[lane.name] = controller
+    return controller
+
+
+async def close_barrier_controllers():
+    """Закрывает HTTP-соединения шлагбаумов (вызывается при остановке)"""
+    for controller in barrier_controllers.values():
+        await controller.aclose()
+    barrier_controllers.clear()
+
+
+async def open_barrier(camera_ip: str) -> bool:
+    """Открывает шлагбаум для указанной камеры"""
+    controller = get_barrier_controller(camera_ip)
+    return await controller.open() if controller else False
+
+
+async def close_barrier(camera_ip: str) -> bool:
+    """Закрывает шлагбаум для указанной камеры"""
+    controller = get_barrier_controller(camera_ip)
+    return await controller.close() if controller else False
+
+
+async def get_barrier_state(camera_ip: str) -> str:
+    """Получает состояние шлагбаума для указанной камеры"""
+    controller = get_barrier_controller(camera_ip)
+    return await controller.state() if controller else "unknown"
+
+
+class BarrierStatePoller:
+    """
+    Фоновый опрос состояния шлагбаумов раз в barrier_state_poll_seconds.
+    Админка читает состояние из кэша (со временем замера), изменения
+    рассылаются подписчикам /ws/barrier-state.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.polls = 0
+
+    def get(self, camera_ip: str):
+        lane = lane_registry.resolve(camera_ip)
+        return self.states.get(lane.camera_ip) if lane else None
+
+    async def poll_once(self):
+        lanes = [lane for lane in lane_registry.lanes.values() if lane.barrier]
+        states = await asyncio.gather(
+            *(get_barrier_controller(lane.camera_ip).state(verbose=False) for lane in lanes)
+        )
+        self.polls += 1
+        sampled_at = datetime.now(KYRGYZSTAN_TZ).isoformat()
+        for camera_ip in set(self.states) - {lane.camera_ip for lane in lanes}:
+            del self.states[camera_ip]
+        for lane, state in zip(lanes, states):
+            camera_ip = lane.camera_ip
+            previous = self.states.get(camera_ip)
+            changed = previous is None or previous["state"] != state
+            self.states[camera_ip] = {
+                "lane": lane.name,
+                "camera_ip": camera_ip,
+                "state": state,
+                "sampled_at": sampled_at,
+                "changed_at": sampled_at if changed else previous["changed_at"]
+            }
+            if changed:
+                print(f"🚧 Barrier {camera_ip} state: {previous['state'] if previous else None} -> {state}")
+                await barrier_ws_manager.broadcast({"type": "barrier_state", **self.states[camera_ip]})
+
+    async def run(self):
+        """Цикл опроса (запускается из lifespan)"""
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                print(f"❌ Barrier state poll error: {e}")
+            await asyncio.sleep(PARKING_CONFIG["barrier_state_poll_seconds"])
+
+    def stats(self) -> dict:
+        return {"polls": self.polls, "states": list(self.states.values())}
+
+
+barrier_state_poller = BarrierStatePoller()
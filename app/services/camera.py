@@ -2,59 +2,102 @@
 Модуль работы с событиями камер и распознавания номеров
 """
 import re
+import time
+import asyncio
 import hashlib
-from datetime import datetime, timedelta
-from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG
+import logging
+from functools import lru_cache
+from datetime import datetime
+from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG, CAMERA_CONFIG
 from ..db import get_db_connection
+from .shared_state import shared_state
 
-recent_events_cache = {}
+logger = logging.getLogger(__name__)
 
+class EventsLogWriter:
+    """Пакетная асинхронная запись camera_events_log (COPY пачками в фоне)"""
 
-def is_duplicate_event(camera_ip: str, plate: str, raw_event: str) -> bool:
-    """Проверяет, является ли событие дубликатом"""
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=CAMERA_CONFIG["events_log_queue_size"])
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, camera_ip: str, event_hash: str, event_time: datetime, plate: str):
+        if not CAMERA_CONFIG["events_log_enabled"]:
+            return
+        try:
+            self.queue.put_nowait((camera_ip, event_hash, event_time, plate))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def flush(self):
+        records = []
+        while not self.queue.empty() and len(records) < CAMERA_CONFIG["events_log_batch_size"]:
+            records.append(self.queue.get_nowait())
+        if not records:
+            return 0
+        async with get_db_connection() as conn:
+            await conn.copy_records_to_table(
+                "camera_events_log",
+                records=records,
+                columns=["camera_ip", "event_hash", "event_time", "plate_number"]
+            )
+        self.written += len(records)
+        return len(records)
+
+    async def cleanup(self):
+        """Удаляет записи старше events_log_retention_days"""
+        async with get_db_connection() as conn:
+            await conn.execute("""
+                DELETE FROM camera_events_log
+                WHERE event_time < NOW() - make_interval(days => $1)
+            """, CAMERA_CONFIG["events_log_retention_days"])
+
+    async def run(self):
+        """Фоновая задача (запускается из lifespan)"""
+        last_cleanup = 0.0
+        while True:
+            try:
+                while await self.flush() == CAMERA_CONFIG["events_log_batch_size"]:
+                    pass
+                if time.monotonic() - last_cleanup > 3600:
+                    await self.cleanup()
+                    last_cleanup = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Error writing camera_events_log: {e}")
+            await asyncio.sleep(CAMERA_CONFIG["events_log_flush_seconds"])
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CAMERA_CONFIG["events_log_enabled"],
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+
+events_log_writer = EventsLogWriter()
+
+
+async def is_duplicate_event(camera_ip: str, plate: str, raw_event: str) -> bool:
+    """Проверяет, является ли событие дубликатом (через общее состояние воркеров)"""
     try:
         event_content = f"{camera_ip}_{plate}_{raw_event[:500]}"
         event_hash = hashlib.md5(event_content.encode()).hexdigest()
-       
-        current_time = datetime.now(KYRGYZSTAN_TZ)
-
-        cache_key = f"{camera_ip}_{plate}"
-        if cache_key in recent_events_cache:
-            last_time = recent_events_cache[cache_key]
-            if (current_time - last_time).total_seconds() < PARKING_CONFIG["min_detection_interval_seconds"]:
-                print(f"⚠️ Duplicate event detected in cache for {camera_ip} plate {plate}")
-                return True
-       
-        recent_events_cache[cache_key] = current_time
-
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        cur.execute("""
-            SELECT id FROM camera_events_log
-            WHERE camera_ip = %s
-            AND event_hash = %s
-            AND event_time > %s
-            LIMIT 1
-        """, (camera_ip, event_hash, current_time - timedelta(seconds=30)))
-       
-        if cur.fetchone():
-            print(f"⚠️ Duplicate event detected in DB for {camera_ip}")
-            cur.close()
-            conn.close()
+
+        if await shared_state.seen_recently(f"dedup:{camera_ip}_{plate}", PARKING_CONFIG["min_detection_interval_seconds"]):
+            print(f"⚠️ Duplicate event detected in cache for {camera_ip} plate {plate}")
             return True
 
-        cur.execute("""
-            INSERT INTO camera_events_log (camera_ip, event_hash, event_time, plate_number)
-            VALUES (%s, %s, %s, %s)
-        """, (camera_ip, event_hash, current_time, plate))
-       
-        conn.commit()
-        cur.close()
-        conn.close()
-       
+        if await shared_state.seen_recently(f"dedup_hash:{camera_ip}_{event_hash}", CAMERA_CONFIG["dedup_hash_window_seconds"]):
+            print(f"⚠️ Duplicate event detected by hash for {camera_ip}")
+            return True
+
+        events_log_writer.add(camera_ip, event_hash, datetime.now(KYRGYZSTAN_TZ), plate)
         return False
-       
+
     except Exception as e:
         print(f"❌ Error checking duplicate event: {e}")
         return False
@@ -90,109 +133,132 @@ def is_valid_plate(plate: str) -> bool:
     return False
 
 
+# Структурированные поля событий ANPR: тег/ключ -> приоритет
+STRUCTURED_XML_PRIORITY = {"platenumber": 100, "plateno": 95, "licenseplate": 90, "anprplate": 85}
+STRUCTURED_JSON_PRIORITY = {"platenumber": 80, "plateno": 75, "plate": 70, "licenseplate": 65}
+
+STRUCTURED_XML_RE = re.compile(
+    r'<(plateNumber|plateNo|licensePlate|anprPlate)[^>]*>\s*([A-Z0-9]+)\s*</\1>',
+    re.IGNORECASE
+)
+STRUCTURED_JSON_RE = re.compile(
+    r'"(plateNumber|plateNo|plate|licensePlate)"\s*:\s*"([A-Z0-9]+)"',
+    re.IGNORECASE
+)
+
+# Выделение фрагментов с "plate" из больших payload (XML и JSON за один проход)
+PLATE_SECTION_RE = re.compile(
+    r'<[^>]*plate[^>]*>.*?</[^>]*>|"[^"]*plate[^"]*"\s*:\s*"[^"]*"',
+    re.IGNORECASE | re.DOTALL
+)
+
+PLATE_PATTERNS = [(re.compile(pattern, re.IGNORECASE | re.MULTILINE), priority) for pattern, priority in [
+    (r'<plateNumber[^>]*>\s*([A-Z0-9]+)\s*</plateNumber>', 100),
+    (r'<plateNo[^>]*>\s*([A-Z0-9]+)\s*</plateNo>', 95),
+    (r'<licensePlate[^>]*>\s*([A-Z0-9]+)\s*</licensePlate>', 90),
+    (r'<anprPlate[^>]*>\s*([A-Z0-9]+)\s*</anprPlate>', 85),
+
+    (r'"plateNumber"\s*:\s*"([A-Z0-9]+)"', 80),
+    (r'"plateNo"\s*:\s*"([A-Z0-9]+)"', 75),
+    (r'"plate"\s*:\s*"([A-Z0-9]+)"', 70),
+    (r'"licensePlate"\s*:\s*"([A-Z0-9]+)"', 65),
+
+    (r'\b([0-9]{5}[A-Z]{1,3})\b', 90),
+    (r'\b([0-9]{2}[A-Z]{3}[0-9]{2})\b', 85),
+    (r'\b([0-9]{2}KG[0-9]{3}[A-Z]{3})\b', 80),
+    (r'\b(T[0-9]{4}[A-Z]{2})\b', 75),
+    (r'\b([CD|MO][0-9]{3,4})\b', 70),
+
+    (r'\b([A-Z]{1,2}[0-9]{3,4}[A-Z]{1,3})\b', 60),
+    (r'\b([0-9]{2,3}[A-Z]{2,3}[0-9]{2,3})\b', 55),
+
+    (r'PlateResult[^>]*>([A-Z0-9]{4,10})<', 85),
+    (r'RecognitionResult[^>]*>([A-Z0-9]{4,10})<', 80),
+    (r'VehiclePlate[^>]*>([A-Z0-9]{4,10})<', 75),
+    (r'"result"\s*:\s*"([A-Z0-9]{4,10})"', 70),
+    (r'<result[^>]*>([A-Z0-9]{4,10})</result>', 75),
+
+    (r'plate[^>]*=[\'"]*([A-Z0-9]{5,10})[\'"]*', 40),
+    (r'number[^>]*=[\'"]*([A-Z0-9]{5,10})[\'"]*', 35),
+    (r'Plate[:\s]*([A-Z0-9]{5,10})', 30),
+    (r'License[:\s]*([A-Z0-9]{5,10})', 25),
+]]
+
+
+def _normalize_candidate(match: str) -> str:
+    return ''.join(c for c in match.strip().upper() if c.isalnum())
+
+
+def _best_candidate(candidates):
+    """candidates - список (plate, score, pattern_num), возвращает лучший или None"""
+    best = None
+    for candidate in candidates:
+        if best is None or candidate[1] > best[1]:
+            best = candidate
+    return best
+
+
+def find_structured_plate(text):
+    """
+    Быстрый путь: номер из структурированных полей (XML <plateNumber>..., JSON "plateNumber").
+    Возвращает (plate, score) лучшего валидного кандидата или None.
+    """
+    candidates = []
+    for regex, priorities in ((STRUCTURED_XML_RE, STRUCTURED_XML_PRIORITY), (STRUCTURED_JSON_RE, STRUCTURED_JSON_PRIORITY)):
+        for match in regex.finditer(text):
+            plate = _normalize_candidate(match.group(2))
+            if len(plate) >= PARKING_CONFIG["min_plate_length"] and is_valid_plate(plate):
+                candidates.append((plate, priorities[match.group(1).lower()] + get_plate_format_bonus(plate), 0))
+    best = _best_candidate(candidates)
+    return (best[0], best[1]) if best else None
+
+
 def find_plate_number(text):
     """
     Улучшенное распознавание номеров:
+    - Сначала структурированные поля (XML/JSON): при совпадении эвристики не запускаются
     - Возвращает лучший найденный номер даже если он не прошел строгую валидацию (для диагностики)
-    - Логирует все кандидаты и причину отклонения
+    - Кандидаты и причины отклонения пишутся в debug-лог
     """
     if not text:
         return ""
-   
-    print(f"🔍 Analyzing {len(text)} characters for plate numbers...")
 
-    if len(text) > 1000:
-        xml_parts = []
-        json_parts = []
+    structured = find_structured_plate(text)
+    if structured:
+        print(f"✅ BEST PLATE: '{structured[0]}' (score: {structured[1]}, structured field)")
+        return structured[0]
 
-        xml_matches = re.finditer(r'<[^>]*plate[^>]*>.*?</[^>]*>', text, re.IGNORECASE | re.DOTALL)
-        for match in xml_matches:
-            xml_parts.append(match.group())
+    print(f"🔍 Analyzing {len(text)} characters for plate numbers...")
 
-        json_matches = re.finditer(r'"[^"]*plate[^"]*"\s*:\s*"[^"]*"', text, re.IGNORECASE)
-        for match in json_matches:
-            json_parts.append(match.group())
-       
-        print(f"📋 Found {len(xml_parts)} XML plate sections, {len(json_parts)} JSON plate sections")
+    if len(text) > 1000:
+        sections = [match.group() for match in PLATE_SECTION_RE.finditer(text)]
+        logger.debug(f"Found {len(sections)} plate sections")
 
-        analysis_text = " ".join(xml_parts + json_parts)
+        analysis_text = " ".join(sections)
         if len(analysis_text) < 100:
             analysis_text = text[:2000]
     else:
         analysis_text = text
 
-    plate_patterns = [
-        (r'<plateNumber[^>]*>\s*([A-Z0-9]+)\s*</plateNumber>', 100),
-        (r'<plateNo[^>]*>\s*([A-Z0-9]+)\s*</plateNo>', 95),
-        (r'<licensePlate[^>]*>\s*([A-Z0-9]+)\s*</licensePlate>', 90),
-        (r'<anprPlate[^>]*>\s*([A-Z0-9]+)\s*</anprPlate>', 85),
-
-        (r'"plateNumber"\s*:\s*"([A-Z0-9]+)"', 80),
-        (r'"plateNo"\s*:\s*"([A-Z0-9]+)"', 75),
-        (r'"plate"\s*:\s*"([A-Z0-9]+)"', 70),
-        (r'"licensePlate"\s*:\s*"([A-Z0-9]+)"', 65),
-
-        (r'\b([0-9]{5}[A-Z]{1,3})\b', 90),
-        (r'\b([0-9]{2}[A-Z]{3}[0-9]{2})\b', 85),
-        (r'\b([0-9]{2}KG[0-9]{3}[A-Z]{3})\b', 80),
-        (r'\b(T[0-9]{4}[A-Z]{2})\b', 75),
-        (r'\b([CD|MO][0-9]{3,4})\b', 70),
-
-        (r'\b([A-Z]{1,2}[0-9]{3,4}[A-Z]{1,3})\b', 60),
-        (r'\b([0-9]{2,3}[A-Z]{2,3}[0-9]{2,3})\b', 55),
-       
-        (r'PlateResult[^>]*>([A-Z0-9]{4,10})<', 85),
-        (r'RecognitionResult[^>]*>([A-Z0-9]{4,10})<', 80),
-        (r'VehiclePlate[^>]*>([A-Z0-9]{4,10})<', 75),
-        (r'"result"\s*:\s*"([A-Z0-9]{4,10})"', 70),
-        (r'<result[^>]*>([A-Z0-9]{4,10})</result>', 75),
-       
-        (r'plate[^>]*=[\'"]*([A-Z0-9]{5,10})[\'"]*', 40),
-        (r'number[^>]*=[\'"]*([A-Z0-9]{5,10})[\'"]*', 35),
-        (r'Plate[:\s]*([A-Z0-9]{5,10})', 30),
-        (r'License[:\s]*([A-Z0-9]{5,10})', 25),
-    ]
-
     found_candidates = []
     all_candidates = []
-
-    for i, (pattern, priority) in enumerate(plate_patterns):
-        try:
-            matches = re.findall(pattern, analysis_text, re.IGNORECASE | re.MULTILINE)
-            for match in matches:
-                if isinstance(match, tuple):
-                    match = match[0] if match[0] else ""
-               
-                if match and len(match.strip()) >= PARKING_CONFIG["min_plate_length"]:
-                    plate = match.strip().upper()
-                    plate = ''.join(c for c in plate if c.isalnum())
-                    all_candidates.append(plate)
-                    if is_valid_plate(plate):
-                        bonus = get_plate_format_bonus(plate)
-                        final_score = priority + bonus
-                        found_candidates.append((plate, final_score, i+1))
-                        print(f"🎯 Pattern {i+1} found: '{plate}' (score: {final_score})")
-                    else:
-                        print(f"⚠️ Pattern {i+1} candidate rejected: '{plate}' (not valid by rules)")
-        except Exception as e:
-            print(f"⚠️ Pattern {i+1} error: {e}")
-            continue
+    min_length = PARKING_CONFIG["min_plate_length"]
+
+    for i, (regex, priority) in enumerate(PLATE_PATTERNS):
+        for match in regex.findall(analysis_text):
+            if match and len(match.strip()) >= min_length:
+                plate = _normalize_candidate(match)
+                all_candidates.append(plate)
+                if is_valid_plate(plate):
+                    final_score = priority + get_plate_format_bonus(plate)
+                    found_candidates.append((plate, final_score, i+1))
+                    logger.debug(f"Pattern {i+1} found: '{plate}' (score: {final_score})")
+                else:
+                    logger.debug(f"Pattern {i+1} candidate rejected: '{plate}' (not valid by rules)")
 
     if found_candidates:
-        unique_candidates = {}
-        for plate, score, pattern_num in found_candidates:
-            if plate not in unique_candidates or unique_candidates[plate][1] < score:
-                unique_candidates[plate] = (plate, score, pattern_num)
-
-        sorted_candidates = sorted(unique_candidates.values(), key=lambda x: x[1], reverse=True)
-        best_plate = sorted_candidates[0][0]
-       
-        print(f"✅ BEST PLATE: '{best_plate}' (score: {sorted_candidates[0][1]}, from {len(found_candidates)} total matches)")
-
-        if len(sorted_candidates) > 1:
-            alternatives = [f"'{cand[0]}'({cand[1]})" for cand in sorted_candidates[1:3]]
-            print(f"🔄 Alternatives: {', '.join(alternatives)}")
-       
+        best_plate, best_score, _ = _best_candidate(found_candidates)
+        print(f"✅ BEST PLATE: '{best_plate}' (score: {best_score}, from {len(found_candidates)} total matches)")
         return best_plate
 
     if all_candidates:
@@ -203,22 +269,25 @@ def find_plate_number(text):
     return ""
 
 
+# Кыргызские форматы номеров: одна проверка вместо цепочки re.match (порядок ветвей = приоритет)
+PLATE_FORMAT_RE = re.compile(
+    r'(?P<f50>[0-9]{5}[A-Z]{1,3})'          # 01008ABM
+    r'|(?P<f45>[0-9]{2}[A-Z]{3}[0-9]{2})'   # 01ABC23
+    r'|(?P<f40>[0-9]{2}KG[0-9]{3}[A-Z]{3})' # 01KG123ABC
+    r'|(?P<f35>T[0-9]{4}[A-Z]{2})'          # T1234AB
+    r'|(?P<f30>[CD|MO][0-9]{3,4})'          # CD1234
+    r'|(?P<f20>[A-Z]{1,2}[0-9]{3,4}[A-Z]{1,3})'  # B123ABC
+)
+
+
+@lru_cache(maxsize=4096)
 def get_plate_format_bonus(plate: str) -> int:
     """Дает бонусные баллы за соответствие кыргызским форматам"""
     bonus = 0
-   
-    if re.match(r'^[0-9]{5}[A-Z]{1,3}$', plate):  # 01008ABM
-        bonus += 50
-    elif re.match(r'^[0-9]{2}[A-Z]{3}[0-9]{2}$', plate):  # 01ABC23
-        bonus += 45
-    elif re.match(r'^[0-9]{2}KG[0-9]{3}[A-Z]{3}$', plate):  # 01KG123ABC
-        bonus += 40
-    elif re.match(r'^T[0-9]{4}[A-Z]{2}$', plate):  # T1234AB
-        bonus += 35
-    elif re.match(r'^[CD|MO][0-9]{3,4}$', plate):  # CD1234
-        bonus += 30
-    elif re.match(r'^[A-Z]{1,2}[0-9]{3,4}[A-Z]{1,3}$', plate):  # B123ABC
-        bonus += 20
+
+    match = PLATE_FORMAT_RE.fullmatch(plate)
+    if match:
+        bonus += int(match.lastgroup[1:])
 
     if 6 <= len(plate) <= 8:
         bonus += 10
@@ -228,19 +297,20 @@ def get_plate_format_bonus(plate: str) -> int:
     return bonus
 
 
+EVENT_TYPE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'<eventType[^>]*>([^<]+)</eventType>',
+    r'"eventType"\s*:\s*"([^"]+)"',
+    r'eventType["\s]*[:=]["\s]*["\']?([^"\'<>\s,]+)["\']?'
+]]
+
+
 def find_event_type(text):
     """Ищет тип события"""
     if not text:
         return ""
    
-    patterns = [
-        r'<eventType[^>]*>([^<]+)</eventType>',
-        r'"eventType"\s*:\s*"([^"]+)"',
-        r'eventType["\s]*[:=]["\s]*["\']?([^"\'<>\s,]+)["\']?'
-    ]
-   
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in EVENT_TYPE_PATTERNS:
+        match = pattern.search(text)
         if match:
             return match.group(1).strip()
    
@@ -250,28 +320,29 @@ def find_event_type(text):
     return ""
 
 
+PICTURE_URL_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'<pictureURL[^>]*>([^<]+)</pictureURL>',
+    r'"pictureURL"\s*:\s*"([^"]+)"',
+    r'<filename[^>]*>([^<]+)</filename>',
+    r'"filename"\s*:\s*"([^"]+)"',
+    r'<picture[^>]*>([^<]+)</picture>',
+    r'"picture"\s*:\s*"([^"]+)"',
+    r'<image[^>]*>([^<]+)</image>',
+    r'"image"\s*:\s*"([^"]+)"',
+    r'<imageURL[^>]*>([^<]+)</imageURL>',
+    r'"imageURL"\s*:\s*"([^"]+)"',
+    r'<snapShotURL[^>]*>([^<]+)</snapShotURL>',
+    r'"snapShotURL"\s*:\s*"([^"]+)"',
+]]
+
+
 def find_picture_url(text):
     """Поиск URL изображения - ускоренная версия"""
     if not text:
         return ""
    
-    patterns = [
-        r'<pictureURL[^>]*>([^<]+)</pictureURL>',
-        r'"pictureURL"\s*:\s*"([^"]+)"',
-        r'<filename[^>]*>([^<]+)</filename>',
-        r'"filename"\s*:\s*"([^"]+)"',
-        r'<picture[^>]*>([^<]+)</picture>',
-        r'"picture"\s*:\s*"([^"]+)"',
-        r'<image[^>]*>([^<]+)</image>',
-        r'"image"\s*:\s*"([^"]+)"',
-        r'<imageURL[^>]*>([^<]+)</imageURL>',
-        r'"imageURL"\s*:\s*"([^"]+)"',
-        r'<snapShotURL[^>]*>([^<]+)</snapShotURL>',
-        r'"snapShotURL"\s*:\s*"([^"]+)"',
-    ]
-   
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in PICTURE_URL_PATTERNS:
+        match = pattern.search(text)
         if match:
             url = match.group(1).strip()
             print(f"🖼️ Found picture URL: {url}")
@@ -42,25 +42,21 @@ class ImageProcessorService:
 
     async def process_pending_images(self):
         """Обработка изображений, которые не удалось скачать сразу"""
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         try:
             cutoff_time = datetime.now(KYRGYZSTAN_TZ) - timedelta(hours=2)
             
-            cur.execute("""
-                SELECT ai.id, ai.event_id, ai.camera_ip, ai.plate_number, 
-                       ai.image_url, c.event_type, ai.created_at
-                FROM alarm_images ai
-                JOIN camera c ON ai.event_id = c.id
-                WHERE ai.download_success = false
-                AND ai.created_at > %s
-                AND (ai.error_message NOT LIKE '%404%' OR ai.error_message IS NULL)
-                ORDER BY ai.created_at DESC
-                LIMIT 10
-            """, (cutoff_time,))
-            
-            pending_images = cur.fetchall()
+            async with get_db_connection() as conn:
+                pending_images = await conn.fetch("""
+                    SELECT ai.id, ai.event_id, ai.camera_ip, ai.plate_number, 
+                           ai.image_url, c.event_type, ai.created_at
+                    FROM alarm_images ai
+                    JOIN camera c ON ai.event_id = c.id
+                    WHERE ai.download_success = false
+                    AND ai.created_at > $1
+                    AND (ai.error_message NOT LIKE '%404%' OR ai.error_message IS NULL)
+                    ORDER BY ai.created_at DESC
+                    LIMIT 10
+                """, cutoff_time)
             
             if pending_images:
                 logger.info(f"📸 Found {len(pending_images)} pending images to retry")
@@ -73,71 +69,59 @@ class ImageProcessorService:
 
                     image_data, actual_url = download_image_from_camera(image_url or "", camera_ip)
                     
-                    if image_data:
-                        filename, filepath, file_size = save_image_to_disk(
-                            image_data, event_id, camera_ip, plate, event_type or "ANPR"
-                        )
-                        
-                        if filename:
-                            cur.execute("""
-                                UPDATE alarm_images
-                                SET image_filename = %s, image_path = %s, image_size = %s,
-                                    download_success = true, error_message = null,
-                                    image_url = %s
-                                WHERE id = %s
-                            """, (filename, filepath, file_size, actual_url, image_id))
+                    async with get_db_connection() as conn:
+                        if image_data:
+                            filename, filepath, file_size = save_image_to_disk(
+                                image_data, event_id, camera_ip, plate, event_type or "ANPR"
+                            )
                             
-                            logger.info(f"✅ Successfully downloaded delayed image for event {event_id}")
+                            if filename:
+                                await conn.execute("""
+                                    UPDATE alarm_images
+                                    SET image_filename = $1, image_path = $2, image_size = $3,
+                                        download_success = true, error_message = null,
+                                        image_url = $4
+                                    WHERE id = $5
+                                """, filename, filepath, file_size, actual_url, image_id)
+                                
+                                logger.info(f"✅ Successfully downloaded delayed image for event {event_id}")
+                            else:
+                                await conn.execute("""
+                                    UPDATE alarm_images 
+                                    SET error_message = 'Failed to save to disk after retry'
+                                    WHERE id = $1
+                                """, image_id)
                         else:
-                            cur.execute("""
+                            await conn.execute("""
                                 UPDATE alarm_images 
-                                SET error_message = 'Failed to save to disk after retry'
-                                WHERE id = %s
-                            """, (image_id,))
-                    else:
-                        cur.execute("""
-                            UPDATE alarm_images 
-                            SET error_message = COALESCE(error_message, '') || ' | Retry failed'
-                            WHERE id = %s
-                        """, (image_id,))
+                                SET error_message = COALESCE(error_message, '') || ' | Retry failed'
+                                WHERE id = $1
+                            """, image_id)
 
                     await asyncio.sleep(2)
-                
-                conn.commit()
             
         except Exception as e:
-            conn.rollback()
             logger.error(f"📸 Error processing pending images: {e}")
-        finally:
-            cur.close()
-            conn.close()
 
     async def cleanup_old_failed_images(self):
         """Очистка старых неуспешных записей"""
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         try:
             cutoff_time = datetime.now(KYRGYZSTAN_TZ) - timedelta(hours=24)
             
-            cur.execute("""
-                DELETE FROM alarm_images
-                WHERE download_success = false
-                AND created_at < %s
-            """, (cutoff_time,))
+            async with get_db_connection() as conn:
+                status = await conn.execute("""
+                    DELETE FROM alarm_images
+                    WHERE download_success = false
+                    AND created_at < $1
+                """, cutoff_time)
             
-            deleted_count = cur.rowcount
-            conn.commit()
+            deleted_count = int(status.split()[-1])
             
             if deleted_count > 0:
                 logger.info(f"📸 Cleaned up {deleted_count} old failed image records")
                 
         except Exception as e:
-            conn.rollback()
             logger.error(f"📸 Error cleaning up old images: {e}")
-        finally:
-            cur.close()
-            conn.close()
 
 image_processor = ImageProcessorService()
 
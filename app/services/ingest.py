@@ -0,0 +1,153 @@
+"""
+Стадия приема событий камер: HTTP-обработчик только разбирает событие и кладет
+его в очередь своей полосы (lane = IP камеры), а воркеры полосы обрабатывают
+события по порядку. Полосы не блокируют друг друга, поток событий от одной
+камеры ограничен глубиной ее очереди.
+
+INGEST_DROP_POLICY при переполнении очереди:
+- drop_oldest - вытеснить самое старое событие (актуальнее машина у шлагбаума);
+- reject      - отклонить новое событие.
+"""
+import asyncio
+import time
+import traceback
+from ..config import INGEST_CONFIG
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestLane:
+    def __init__(self, name: str, handler):
+        self.name = name
+        self.handler = handler
+        self.queue = asyncio.Queue(maxsize=INGEST_CONFIG["queue_size"])
+        self.workers = []
+        self.in_progress = 0
+        self.processed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def start(self):
+        for _ in range(INGEST_CONFIG["lane_concurrency"]):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def submit(self, item) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self.queue.full():
+            if INGEST_CONFIG["drop_policy"] != "drop_oldest":
+                self.rejected += 1
+                raise IngestQueueFull(self.name)
+            _, _, dropped_future = self.queue.get_nowait()
+            self.dropped += 1
+            if not dropped_future.done():
+                dropped_future.set_result({
+                    "status": "dropped",
+                    "message": "Событие вытеснено из переполненной очереди"
+                })
+        self.queue.put_nowait((item, time.monotonic(), future))
+        return future
+
+    async def _worker(self):
+        while True:
+            item, enqueued_at, future = await self.queue.get()
+            waited = time.monotonic() - enqueued_at
+            self.wait_last = waited
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.in_progress += 1
+            try:
+                result = await self.handler(item)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ingest lane {self.name} error: {e}")
+                traceback.print_exc()
+                # Результат, а не исключение: future может уже никто не ждать
+                # (таймаут ответа, wait_for_result=False) - иначе "exception was never retrieved"
+                if not future.done():
+                    future.set_result({
+                        "status": "error",
+                        "message": str(e),
+                        "lane": self.name,
+                        "barrier_opened": False
+                    })
+            finally:
+                self.in_progress -= 1
+                self.processed += 1
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "in_progress": self.in_progress,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "wait_last_ms": round(self.wait_last * 1000, 1),
+            "wait_avg_ms": round(self.wait_total / self.processed * 1000, 1) if self.processed else 0,
+            "wait_max_ms": round(self.wait_max * 1000, 1)
+        }
+
+
+class IngestManager:
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.lanes = {}
+
+    def set_handler(self, handler):
+        self.handler = handler
+
+    def lane(self, name: str) -> IngestLane:
+        if name not in self.lanes and len(self.lanes) >= INGEST_CONFIG["max_lanes"]:
+            name = "other"
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = IngestLane(name, self.handler)
+            lane.start()
+            self.lanes[name] = lane
+        return lane
+
+    async def submit(self, lane_name: str, item):
+        """
+        Ставит событие в очередь полосы и ждет результат обработки (не дольше
+        response_timeout_seconds - дальше событие обрабатывается без ожидания)
+        """
+        future = self.lane(lane_name).submit(item)
+        if not INGEST_CONFIG["wait_for_result"]:
+            return {"status": "queued", "lane": lane_name}
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=INGEST_CONFIG["response_timeout_seconds"])
+        except asyncio.TimeoutError:
+            return {"status": "queued", "lane": lane_name, "message": "Событие в обработке"}
+
+    def stop(self):
+        for lane in self.lanes.values():
+            lane.stop()
+
+    def stats(self) -> dict:
+        return {
+            "drop_policy": INGEST_CONFIG["drop_policy"],
+            "queue_size": INGEST_CONFIG["queue_size"],
+            "lane_concurrency": INGEST_CONFIG["lane_concurrency"],
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()}
+        }
+
+
+ingest_manager = IngestManager()
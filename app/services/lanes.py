@@ -0,0 +1,164 @@
+"""
+Реестр полос (lane): камера -> роль (въезд/выезд), шлагбаум, оплата, канал экрана.
+Загружается один раз из LANES_FILE (JSON-список полос) или из DEFAULT_LANES,
+индексируется по внутреннему и публичным IP камеры - маршрутизация события за O(1).
+Файл перечитывается без перезапуска при изменении (lanes_reload_task) или
+через POST /system/lanes/reload.
+
+Пример элемента LANES_FILE:
+{"name": "exit_2", "role": "exit", "camera_ip": "192.0.0.21",
+ "public_ips": ["212.112.126.253"], "barrier": {"ip": "192.0.0.21", "port": 80,
+ "user": "admin", "password": "...", "channel": 1},
+ "payment_flow": true, "screen_channel": "exit_2", "title": "Выезд 2"}
+"barrier" - имя из BARRIER_CONFIG, словарь подключения или null.
+"""
+import asyncio
+import json
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional
+from ..config import LANES_CONFIG, DEFAULT_LANES, BARRIER_CONFIG
+from .response_cache import data_versions
+
+LANE_ROLES = ("entry", "exit")
+
+
+@dataclass
+class Lane:
+    name: str
+    role: str
+    camera_ip: str
+    public_ips: List[str] = field(default_factory=list)
+    barrier: Optional[dict] = None
+    payment_flow: bool = False
+    screen_channel: str = ""
+    title: str = ""
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "role": self.role,
+            "camera_ip": self.camera_ip,
+            "public_ips": self.public_ips,
+            "barrier": {key: value for key, value in self.barrier.items() if key != "password"} if self.barrier else None,
+            "payment_flow": self.payment_flow,
+            "screen_channel": self.screen_channel,
+            "title": self.title
+        }
+
+
+def build_lane(spec: dict) -> Lane:
+    """Lane из элемента конфигурации, ValueError - если описание некорректно"""
+    name = spec.get("name")
+    role = spec.get("role")
+    camera_ip = spec.get("camera_ip")
+    if not name or not camera_ip:
+        raise ValueError(f"Lane requires name and camera_ip: {spec}")
+    if role not in LANE_ROLES:
+        raise ValueError(f"Lane {name}: unknown role {role!r}")
+
+    barrier = spec.get("barrier")
+    if isinstance(barrier, str):
+        if barrier not in BARRIER_CONFIG:
+            raise ValueError(f"Lane {name}: unknown barrier {barrier!r}")
+        barrier = BARRIER_CONFIG[barrier]
+    if barrier is not None:
+        barrier = {
+            "ip": barrier["ip"],
+            "port": int(barrier.get("port", 80)),
+            "user": barrier.get("user", "admin"),
+            "password": barrier.get("password", ""),
+            "channel": int(barrier.get("channel", 1))
+        }
+
+    return Lane(
+        name=name,
+        role=role,
+        camera_ip=camera_ip,
+        public_ips=list(spec.get("public_ips", [])),
+        barrier=barrier,
+        payment_flow=bool(spec.get("payment_flow", role == "exit")),
+        screen_channel=spec.get("screen_channel") or name,
+        title=spec.get("title", name)
+    )
+
+
+class LaneRegistry:
+    def __init__(self):
+        self.lanes = {}
+        self.by_ip = {}
+        self.camera_ips = frozenset()
+        self.source = None
+        self.file_mtime = None
+        self.version = 0
+
+    def _apply(self, specs, source: str):
+        lanes = {}
+        by_ip = {}
+        for spec in specs:
+            lane = build_lane(spec)
+            if lane.name in lanes:
+                raise ValueError(f"Duplicate lane name {lane.name}")
+            lanes[lane.name] = lane
+            for ip in [lane.camera_ip, *lane.public_ips]:
+                if ip in by_ip:
+                    raise ValueError(f"IP {ip} belongs to lanes {by_ip[ip].name} and {lane.name}")
+                by_ip[ip] = lane
+        # Новые индексы подменяются целиком - читатели не видят полузагруженный реестр
+        self.lanes = lanes
+        self.by_ip = by_ip
+        self.camera_ips = frozenset(lane.camera_ip for lane in lanes.values())
+        self.source = source
+        self.version += 1
+        print(f"🛣️ Lanes loaded from {source}: {', '.join(f'{lane.name}({lane.role})' for lane in lanes.values())}")
+
+    def load(self):
+        """Загружает полосы из LANES_FILE, а если файла нет - из DEFAULT_LANES"""
+        path = LANES_CONFIG["file"]
+        if path and os.path.exists(path):
+            mtime = os.path.getmtime(path)
+            with open(path, "r", encoding="utf-8") as f:
+                specs = json.load(f)
+            self._apply(specs, path)
+            self.file_mtime = mtime
+        else:
+            self._apply(DEFAULT_LANES, "default")
+            self.file_mtime = None
+
+    def reload_if_changed(self) -> bool:
+        """Перечитывает LANES_FILE, если он появился, изменился или удален"""
+        path = LANES_CONFIG["file"]
+        mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+        if mtime == self.file_mtime:
+            return False
+        self.load()
+        return True
+
+    def resolve(self, ip: str) -> Optional[Lane]:
+        """Полоса по внутреннему или публичному IP камеры"""
+        return self.by_ip.get(ip)
+
+    def by_role(self, role: str) -> List[Lane]:
+        return [lane for lane in self.lanes.values() if lane.role == role]
+
+    def stats(self) -> dict:
+        return {
+            "source": self.source,
+            "version": self.version,
+            "lanes": [lane.to_dict() for lane in self.lanes.values()]
+        }
+
+
+lane_registry = LaneRegistry()
+lane_registry.load()
+
+
+async def lanes_reload_task():
+    """Отслеживание изменений LANES_FILE (запускается из lifespan)"""
+    while True:
+        await asyncio.sleep(LANES_CONFIG["reload_interval_seconds"])
+        try:
+            if lane_registry.reload_if_changed():
+                data_versions.bump("config")
+        except Exception as e:
+            print(f"❌ Lanes reload error (previous lanes kept): {e}")
@@ -1,13 +1,17 @@
 """Модуль бизнес-логики парковки с интеграцией оплаты (въезд/выезд/стоимость/платежи)"""
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG, BAKAI_CONFIG
 from ..db import get_db_connection
 from .barrier import open_barrier
-from app.models import get_whitelist
 from datetime import datetime
 from .camera import is_valid_plate
+from .whitelist import whitelist_index
+from .tariffs import tariff_cache
+from .lanes import lane_registry
 
-def get_payment_analytics(day: str = None):
+async def get_payment_analytics(day: str = None):
     """
     Возвращает аналитику по оплатам за выбранный день:
     - общее количество оплат
@@ -17,47 +21,41 @@ def get_payment_analytics(day: str = None):
     """
     from collections import defaultdict
     from datetime import datetime, date, timedelta
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        if not day:
-            day = date.today().isoformat()
-        cur.execute("""
+    if not day:
+        day = date.today().isoformat()
+    async with get_db_connection() as conn:
+        rows = await conn.fetch("""
             SELECT id, plate_number, amount, payment_status, paid_at, created_at, bakai_operation_id
             FROM parking_payments
-            WHERE DATE(paid_at) = %s AND payment_status = 'paid'
+            WHERE DATE(paid_at) = $1 AND payment_status = 'paid'
             ORDER BY paid_at ASC
-        """, (day,))
-        rows = cur.fetchall()
-        payments = []
-        total_sum = 0
-        for row in rows:
-            payment = {
-                "id": row[0],
-                "plate_number": row[1],
-                "amount": float(row[2]),
-                "payment_status": row[3],
-                "paid_at": row[4].isoformat() if row[4] else None,
-                "created_at": row[5].isoformat() if row[5] else None,
-                "operator": row[6]
-            }
-            payments.append(payment)
-            total_sum += float(row[2])
-        from ..config import PARKING_CONFIG
-        paid_mode = PARKING_CONFIG.get("mode", "paid")
-        paid_mode_duration = 24 * 60 if paid_mode == "paid" else 0
-        return {
-            "date": day,
-            "payments_count": len(payments),
-            "total_sum": round(total_sum, 2),
-            "payments": payments,
-            "paid_mode_minutes": paid_mode_duration
+        """, date.fromisoformat(day))
+    payments = []
+    total_sum = 0
+    for row in rows:
+        payment = {
+            "id": row[0],
+            "plate_number": row[1],
+            "amount": float(row[2]),
+            "payment_status": row[3],
+            "paid_at": row[4].isoformat() if row[4] else None,
+            "created_at": row[5].isoformat() if row[5] else None,
+            "operator": row[6]
         }
-    finally:
-        cur.close()
-        conn.close()
+        payments.append(payment)
+        total_sum += float(row[2])
+    from ..config import PARKING_CONFIG
+    paid_mode = PARKING_CONFIG.get("mode", "paid")
+    paid_mode_duration = 24 * 60 if paid_mode == "paid" else 0
+    return {
+        "date": day,
+        "payments_count": len(payments),
+        "total_sum": round(total_sum, 2),
+        "payments": payments,
+        "paid_mode_minutes": paid_mode_duration
+    }
 
-def get_parking_analytics(days: int = 7):
+async def get_parking_analytics(days: int = 7):
     """
     Возвращает общую аналитику по парковке за последние days дней:
     - среднее количество въездов в день
@@ -66,239 +64,153 @@ def get_parking_analytics(days: int = 7):
     - среднее время стоянки по дням недели (0=Пн, 6=Вс)
     - распределение въездов/выездов по дням недели (для графика)
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        from collections import Counter, defaultdict
-        cur.execute("""
-            SELECT entry_time, duration_minutes
-            FROM parking_visits
-            WHERE entry_time >= NOW() - INTERVAL '%s days'
-              AND visit_status IN ('completed', 'manual', 'timeout')
-        """, (days,))
-        entry_rows = cur.fetchall()
-        cur.execute("""
-            SELECT exit_time
-            FROM parking_visits
-            WHERE exit_time IS NOT NULL
-              AND exit_time >= NOW() - INTERVAL '%s days'
-              AND visit_status IN ('completed', 'manual', 'timeout')
-        """, (days,))
-        exit_rows = cur.fetchall()
-        if not entry_rows and not exit_rows:
-            return {
-                "avg_entries_per_day": 0,
-                "hourly_distribution": {},
-                "hourly_exit_distribution": {},
-                "avg_duration_minutes": 0,
-                "weekday_avg_duration": {},
-                "weekday_entry_distribution": {},
-                "weekday_exit_distribution": {}
-            }
-        day_counter = Counter()
-        hour_entry_counter = Counter()
-        durations = []
-        weekday_durations = defaultdict(list)
-        weekday_entry_counter = Counter()
-        for entry_time, duration in entry_rows:
-            if entry_time:
-                day_counter[entry_time.date()] += 1
-                hour_entry_counter[entry_time.hour] += 1
-                weekday = entry_time.weekday()
-                weekday_entry_counter[weekday] += 1
-                if duration:
-                    weekday_durations[weekday].append(duration)
-            if duration:
-                durations.append(duration)
-        hour_exit_counter = Counter()
-        weekday_exit_counter = Counter()
-        for (exit_time,) in exit_rows:
-            if exit_time:
-                hour_exit_counter[exit_time.hour] += 1
-                weekday = exit_time.weekday()
-                weekday_exit_counter[weekday] += 1
-        avg_entries_per_day = sum(day_counter.values()) / max(1, len(day_counter))
-        hourly_distribution = {h: hour_entry_counter[h] for h in range(24)}
-        hourly_exit_distribution = {h: hour_exit_counter[h] for h in range(24)}
-        avg_duration_minutes = int(sum(durations) / max(1, len(durations))) if durations else 0
-        weekday_avg_duration = {}
-        for wd in range(7):
-            vals = weekday_durations.get(wd, [])
-            weekday_avg_duration[wd] = int(sum(vals) / len(vals)) if vals else 0
-        weekday_entry_distribution = {wd: weekday_entry_counter[wd] for wd in range(7)}
-        weekday_exit_distribution = {wd: weekday_exit_counter[wd] for wd in range(7)}
+    # Распределения считаются в Postgres: из БД приходят ~60 агрегатов вместо всех визитов.
+    # Наборы группировки: (kind) - итоги, (kind, hour) - по часам, (kind, weekday) - по дням недели;
+    # у итоговой строки hour и weekday - NULL (в данных они всегда заполнены).
+    async with get_db_connection() as conn:
+        rows = await conn.fetch("""
+            WITH events AS (
+                SELECT 'entry' AS kind, entry_time AT TIME ZONE $2 AS local_time,
+                       NULLIF(duration_minutes, 0) AS duration
+                FROM parking_visits
+                WHERE entry_time >= NOW() - make_interval(days => $1)
+                  AND visit_status IN ('completed', 'manual', 'timeout')
+                UNION ALL
+                SELECT 'exit', exit_time AT TIME ZONE $2, NULL
+                FROM parking_visits
+                WHERE exit_time IS NOT NULL
+                  AND exit_time >= NOW() - make_interval(days => $1)
+                  AND visit_status IN ('completed', 'manual', 'timeout')
+            ), local_events AS (
+                SELECT kind, duration,
+                       EXTRACT(HOUR FROM local_time)::int AS hour,
+                       EXTRACT(ISODOW FROM local_time)::int - 1 AS weekday,
+                       date_trunc('day', local_time) AS day
+                FROM events
+            )
+            SELECT kind, hour, weekday,
+                   COUNT(*) AS events,
+                   COUNT(DISTINCT day) AS days,
+                   SUM(duration) AS duration_sum,
+                   COUNT(duration) AS duration_count
+            FROM local_events
+            GROUP BY GROUPING SETS ((kind), (kind, hour), (kind, weekday))
+        """, days, KYRGYZSTAN_TZ.key)
+    if not rows:
         return {
-            "avg_entries_per_day": round(avg_entries_per_day, 2),
-            "hourly_distribution": hourly_distribution,
-            "hourly_exit_distribution": hourly_exit_distribution,
-            "avg_duration_minutes": avg_duration_minutes,
-            "weekday_avg_duration": weekday_avg_duration,
-            "weekday_entry_distribution": weekday_entry_distribution,
-            "weekday_exit_distribution": weekday_exit_distribution
+            "avg_entries_per_day": 0,
+            "hourly_distribution": {},
+            "hourly_exit_distribution": {},
+            "avg_duration_minutes": 0,
+            "weekday_avg_duration": {},
+            "weekday_entry_distribution": {},
+            "weekday_exit_distribution": {}
         }
-    finally:
-        cur.close()
-        conn.close()
 
-def get_plate_analytics(days: int = 7):
+    def avg_duration(row) -> int:
+        return int(row["duration_sum"] / row["duration_count"]) if row and row["duration_count"] else 0
+
+    totals = {}
+    hourly = {"entry": {}, "exit": {}}
+    weekdays = {"entry": {}, "exit": {}}
+    for row in rows:
+        if row["hour"] is not None:
+            hourly[row["kind"]][row["hour"]] = row
+        elif row["weekday"] is not None:
+            weekdays[row["kind"]][row["weekday"]] = row
+        else:
+            totals[row["kind"]] = row
+
+    entry_totals = totals.get("entry")
+    avg_entries_per_day = entry_totals["events"] / max(1, entry_totals["days"]) if entry_totals else 0
+
+    def counts(by_key: dict, size: int) -> dict:
+        return {key: by_key[key]["events"] if key in by_key else 0 for key in range(size)}
+
+    return {
+        "avg_entries_per_day": round(avg_entries_per_day, 2),
+        "hourly_distribution": counts(hourly["entry"], 24),
+        "hourly_exit_distribution": counts(hourly["exit"], 24),
+        "avg_duration_minutes": avg_duration(entry_totals),
+        "weekday_avg_duration": {wd: avg_duration(weekdays["entry"].get(wd)) for wd in range(7)},
+        "weekday_entry_distribution": counts(weekdays["entry"], 7),
+        "weekday_exit_distribution": counts(weekdays["exit"], 7)
+    }
+
+async def get_plate_analytics(days: int = 7):
     """
     Возвращает список всех номеров с их статистикой за последние days дней:
     - сколько раз заезжал
     - среднее время стоянки
     - средний час въезда/выезда
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("""
+    async with get_db_connection() as conn:
+        rows = await conn.fetch("""
             SELECT plate_number, entry_time, exit_time, duration_minutes
             FROM parking_visits
-            WHERE entry_time >= NOW() - INTERVAL '%s days'
+            WHERE entry_time >= NOW() - make_interval(days => $1)
               AND plate_number IS NOT NULL
               AND visit_status IN ('completed', 'manual', 'timeout')
-        """, (days,))
-        rows = cur.fetchall()
-        from collections import defaultdict
-        stats = defaultdict(lambda: {
-            "count": 0,
-            "total_duration": 0,
-            "entry_hours": [],
-            "exit_hours": []
+        """, days)
+    from collections import defaultdict
+    stats = defaultdict(lambda: {
+        "count": 0,
+        "total_duration": 0,
+        "entry_hours": [],
+        "exit_hours": []
+    })
+    for plate, entry_time, exit_time, duration in rows:
+        if not plate:
+            continue
+        s = stats[plate]
+        s["count"] += 1
+        if duration:
+            s["total_duration"] += duration
+        if entry_time:
+            s["entry_hours"].append(entry_time.astimezone(KYRGYZSTAN_TZ).hour)
+        if exit_time:
+            s["exit_hours"].append(exit_time.astimezone(KYRGYZSTAN_TZ).hour)
+    result = []
+    for plate, s in stats.items():
+        avg_duration = int(s["total_duration"] / s["count"]) if s["count"] else 0
+        avg_entry_hour = round(sum(s["entry_hours"]) / len(s["entry_hours"]), 1) if s["entry_hours"] else None
+        avg_exit_hour = round(sum(s["exit_hours"]) / len(s["exit_hours"]), 1) if s["exit_hours"] else None
+        result.append({
+            "plate_number": plate,
+            "count": s["count"],
+            "avg_duration_minutes": avg_duration,
+            "avg_entry_hour": avg_entry_hour,
+            "avg_exit_hour": avg_exit_hour
         })
-        for plate, entry_time, exit_time, duration in rows:
-            if not plate:
-                continue
-            s = stats[plate]
-            s["count"] += 1
-            if duration:
-                s["total_duration"] += duration
-            if entry_time:
-                s["entry_hours"].append(entry_time.hour)
-            if exit_time:
-                s["exit_hours"].append(exit_time.hour)
-        result = []
-        for plate, s in stats.items():
-            avg_duration = int(s["total_duration"] / s["count"]) if s["count"] else 0
-            avg_entry_hour = round(sum(s["entry_hours"]) / len(s["entry_hours"]), 1) if s["entry_hours"] else None
-            avg_exit_hour = round(sum(s["exit_hours"]) / len(s["exit_hours"]), 1) if s["exit_hours"] else None
-            result.append({
-                "plate_number": plate,
-                "count": s["count"],
-                "avg_duration_minutes": avg_duration,
-                "avg_entry_hour": avg_entry_hour,
-                "avg_exit_hour": avg_exit_hour
-            })
-        result.sort(key=lambda x: x["count"], reverse=True)
-        return result
-    finally:
-        cur.close()
-        conn.close()
+    result.sort(key=lambda x: x["count"], reverse=True)
+    return result
 
-def is_plate_in_whitelist(plate: str) -> bool:
+async def is_plate_in_whitelist(plate: str, conn=None) -> bool:
     """
-    Проверяет, есть ли номер в белом списке с валидным сроком действия
+    Проверяет, есть ли номер в белом списке с валидным сроком действия (по индексу в памяти)
     """
-    from app.config import KYRGYZSTAN_TZ
-    plate = plate.strip().upper()
-    now = datetime.now(KYRGYZSTAN_TZ)
-    whitelist = get_whitelist(active_only=True)
-    for entry in whitelist:
-        if entry["plate_number"].strip().upper() == plate:
-            valid_from = entry["valid_from"]
-            valid_until = entry["valid_until"]
-            if valid_from and valid_from.tzinfo is None:
-                from_zone = now.tzinfo
-                valid_from = valid_from.replace(tzinfo=from_zone)
-            if valid_until and valid_until.tzinfo is None:
-                from_zone = now.tzinfo
-                valid_until = valid_until.replace(tzinfo=from_zone)
-            if valid_from and now < valid_from:
-                continue
-            if valid_until and now > valid_until:
-                continue
-            return True
-    return False
-
-def calculate_parking_cost(entry_time: datetime, exit_time: datetime) -> dict:
-    """Рассчитывает стоимость парковки с использованием тарифов из БД"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    try:
-        cur.execute("""
-            SELECT hourly_rate, night_rate, free_minutes, max_hours, name
-            FROM parking_tariffs
-            WHERE is_active = true
-            AND (valid_until IS NULL OR valid_until >= CURRENT_DATE)
-            ORDER BY created_at DESC
-            LIMIT 1
-        """)
-        tariff = cur.fetchone()
-        
-        if tariff:
-            hourly_rate, night_rate, free_minutes, max_hours, tariff_name = tariff
-        else:
-            hourly_rate = PARKING_CONFIG["hourly_rate"]
-            night_rate = PARKING_CONFIG["night_rate"]
-            free_minutes = PARKING_CONFIG["free_minutes"]
-            max_hours = PARKING_CONFIG["max_hours"]
-            tariff_name = "default"
-            
-    except Exception as e:
-        print(f"Error getting tariff from DB: {e}")
-        hourly_rate = PARKING_CONFIG["hourly_rate"]
-        night_rate = PARKING_CONFIG["night_rate"]
-        free_minutes = PARKING_CONFIG["free_minutes"]
-        max_hours = PARKING_CONFIG["max_hours"]
-        tariff_name = "default"
-    finally:
-        cur.close()
-        conn.close()
-    
-    duration = exit_time - entry_time
-    total_minutes = int(duration.total_seconds() / 60)
-   
-    if total_minutes <= free_minutes:
-        return {
-            "duration_minutes": total_minutes,
-            "total_cost": 0.0,
-            "free_time": True,
-            "description": f"Бесплатно ({total_minutes} мин)",
-            "tariff_used": tariff_name
-        }
-   
-    billable_minutes = total_minutes - free_minutes
-    hours = billable_minutes / 60
-   
-    entry_hour = entry_time.hour
-    exit_hour = exit_time.hour
-   
-    is_night_parking = (entry_hour >= 22 or entry_hour <= 6) and (exit_hour >= 22 or exit_hour <= 6)
-   
-    if is_night_parking:
-        rate = night_rate
-        rate_type = "ночной"
-    else:
-        rate = hourly_rate
-        rate_type = "дневной"
-   
-    billable_hours = max(1, int(hours) + (1 if hours % 1 > 0 else 0))
-   
-    if billable_hours > max_hours:
-        billable_hours = max_hours
-   
-    total_cost = billable_hours * rate
-   
-    return {
-        "duration_minutes": total_minutes,
-        "billable_hours": billable_hours,
-        "total_cost": total_cost,
-        "rate": rate,
-        "rate_type": rate_type,
-        "free_time": False,
-        "description": f"{billable_hours} ч × {rate} сом ({rate_type} тариф)",
-        "tariff_used": tariff_name
-    }
+    if not whitelist_index.loaded:
+        await whitelist_index.load(conn)
+    return whitelist_index.contains(plate)
+
+async def lock_plate(conn, plate: str) -> bool:
+    """
+    Блокирует номер до конца текущей транзакции (pg_advisory_xact_lock) и
+    проверяет белый список. Два события по одному номеру обрабатываются
+    строго последовательно.
+    """
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", plate.strip().upper())
+    return await is_plate_in_whitelist(plate, conn)
+
+async def get_tariff_table(conn=None):
+    """Тарифная таблица активного тарифа из кэша (см. services/tariff_engine.py)"""
+    return await tariff_cache.get_table(conn)
+
+async def calculate_parking_cost(entry_time: datetime, exit_time: datetime, conn=None, tariff=None) -> dict:
+    """Рассчитывает стоимость парковки по кэшированной тарифной таблице (conn - соединение на случай перезагрузки кэша)"""
+    if tariff is None:
+        tariff = await get_tariff_table(conn)
+    return tariff.cost(entry_time, exit_time)
 
 def format_duration(minutes: int) -> str:
     """Форматирует продолжительность в читаемый вид"""
@@ -313,169 +225,274 @@ def format_duration(minutes: int) -> str:
     else:
         return f"{hours} ч {remaining_minutes} мин"
 
-def close_expired_sessions():
-    """Автоматически закрывает просроченные сессии"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-   
+expiry_stats = {
+    "last_run": None,
+    "last_closed": 0,
+    "total_closed": 0,
+    "error": None
+}
+
+async def close_expired_sessions(conn=None):
+    """
+    Автоматически закрывает просроченные сессии пачками по expiry_batch_size:
+    на пачку - один SELECT ... FOR UPDATE SKIP LOCKED и один UPDATE по unnest.
+    """
     try:
-        cutoff_time = datetime.now(KYRGYZSTAN_TZ) - timedelta(hours=PARKING_CONFIG["session_timeout_hours"])
-       
-        cur.execute("""
-            SELECT id, plate_number, entry_time
-            FROM parking_visits
-            WHERE visit_status = 'active' AND entry_time < %s
-        """, (cutoff_time,))
-       
-        expired_sessions = cur.fetchall()
-       
-        for session_id, plate, entry_time in expired_sessions:
-            timeout_time = entry_time + timedelta(hours=PARKING_CONFIG["session_timeout_hours"])
-            cost_info = calculate_parking_cost(entry_time, timeout_time)
-           
-            cur.execute("""
-                UPDATE parking_visits
-                SET exit_time = %s,
-                    duration_minutes = %s,
-                    cost_amount = %s,
-                    cost_description = %s,
-                    visit_status = 'timeout',
-                    notes = 'Автоматически закрыто по таймауту',
-                    updated_at = %s
-                WHERE id = %s
-            """, (
-                timeout_time, cost_info["duration_minutes"], cost_info["total_cost"],
-                cost_info["description"] + " (таймаут)", datetime.now(KYRGYZSTAN_TZ), session_id
-            ))
-           
-            print(f"⏰ Session {session_id} for {plate} closed by timeout")
-       
-        conn.commit()
-        return len(expired_sessions)
-       
+        if conn is None:
+            async with get_db_connection() as conn:
+                return await close_expired_sessions(conn)
+
+        timeout = timedelta(hours=PARKING_CONFIG["session_timeout_hours"])
+        batch_size = PARKING_CONFIG["expiry_batch_size"]
+        tariff = await get_tariff_table(conn)
+        closed_total = 0
+
+        while True:
+            async with conn.transaction():
+                now = datetime.now(KYRGYZSTAN_TZ)
+                expired_sessions = await conn.fetch("""
+                    SELECT id, entry_time
+                    FROM parking_visits
+                    WHERE visit_status = 'active' AND entry_time < $1
+                    ORDER BY entry_time
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                """, now - timeout, batch_size)
+                if not expired_sessions:
+                    break
+
+                ids, exit_times, durations, costs, descriptions = [], [], [], [], []
+                for session_id, entry_time in expired_sessions:
+                    timeout_time = entry_time + timeout
+                    cost_info = await calculate_parking_cost(entry_time, timeout_time, tariff=tariff)
+                    ids.append(session_id)
+                    exit_times.append(timeout_time)
+                    durations.append(cost_info["duration_minutes"])
+                    costs.append(cost_info["total_cost"])
+                    descriptions.append(cost_info["description"] + " (таймаут)")
+
+                await conn.execute("""
+                    UPDATE parking_visits AS v
+                    SET exit_time = e.exit_time,
+                        duration_minutes = e.duration_minutes,
+                        cost_amount = e.cost_amount,
+                        cost_description = e.cost_description,
+                        visit_status = 'timeout',
+                        notes = 'Автоматически закрыто по таймауту',
+                        updated_at = $6
+                    FROM unnest($1::int[], $2::timestamptz[], $3::int[], $4::numeric[], $5::text[])
+                        AS e(id, exit_time, duration_minutes, cost_amount, cost_description)
+                    WHERE v.id = e.id
+                """, ids, exit_times, durations, costs, descriptions, now)
+
+            closed_total += len(expired_sessions)
+            if len(expired_sessions) < batch_size:
+                break
+
+        expiry_stats["last_closed"] = closed_total
+        expiry_stats["total_closed"] += closed_total
+        expiry_stats["error"] = None
+        return closed_total
+
     except Exception as e:
-        conn.rollback()
+        expiry_stats["error"] = str(e)
         print(f"❌ Error closing expired sessions: {e}")
         return 0
+
     finally:
-        cur.close()
-        conn.close()
+        expiry_stats["last_run"] = datetime.now(KYRGYZSTAN_TZ).isoformat()
+
+async def expired_sessions_task():
+    """Фоновое закрытие просроченных сессий (запускается из lifespan)"""
+    while True:
+        expired_count = await close_expired_sessions()
+        if expired_count > 0:
+            print(f"⏰ Closed {expired_count} expired sessions")
+        await asyncio.sleep(PARKING_CONFIG["expiry_check_interval_seconds"])
+
+# Обращения к БД на одно событие въезда/выезда: одно соединение из пула и одна
+# транзакция, номер заблокирован pg_advisory_xact_lock до COMMIT.
+#   1. lock_plate - блокировка номера (белый список - из индекса в памяти);
+#   2. поиск активной сессии (белый список на выезде - один CTE вместо 2-3);
+#   3. тариф - из кэша, запрос только после сброса кэша;
+#   4. INSERT/UPDATE визита (+1 UPDATE при принудительном закрытии на въезде).
+# Итого не более 5 запросов + BEGIN/COMMIT, обычный въезд - 3, выезд - 3.
+# Просроченные сессии закрывает фоновая задача expired_sessions_task.
+# Шлагбаум открывается после COMMIT: транзакция, соединение пула и блокировка
+# номера не ждут устройство; флаг *_barrier_opened ставится отдельным UPDATE.
+
+class KeyedLocks:
+    """
+    asyncio.Lock на ключ (номер): ожидающие выстраиваются в порядке прихода,
+    разные ключи не блокируют друг друга. Лок удаляется, когда его никто не ждет.
+    """
 
-def process_entry(camera_ip: str, plate: str, event_id: int) -> dict:
+    def __init__(self):
+        self.locks = {}
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def stats(self) -> dict:
+        return {"held": len(self.locks), "contended": self.contended}
+
+
+# События одного номера в этом процессе ждут друг друга здесь, не занимая
+# соединение пула на pg_advisory_xact_lock (он остается для других воркеров).
+# Порядок внутри полосы (камеры) обеспечивает очередь services/ingest.py.
+plate_locks = KeyedLocks()
+
+
+async def process_entry(camera_ip: str, plate: str, event_id: int) -> dict:
+    """Обработка въезда: события одного номера - строго по очереди"""
+    async with plate_locks.hold((plate or "").strip().upper()):
+        return await _process_entry(camera_ip, plate, event_id)
+
+
+async def process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
+    """Обработка выезда: события одного номера - строго по очереди"""
+    async with plate_locks.hold((plate or "").strip().upper()):
+        return await _process_exit(camera_ip, plate, event_id)
+
+
+async def _mark_barrier_opened(session_id: int, column: str):
+    """Отметка об открытии шлагбаума после COMMIT визита (ошибка не отменяет проезд)"""
+    try:
+        async with get_db_connection() as conn:
+            await conn.execute(f"UPDATE parking_visits SET {column} = true WHERE id = $1", session_id)
+    except Exception as e:
+        print(f"⚠️ Не удалось отметить {column} для визита {session_id}: {e}")
+
+
+async def _process_entry(camera_ip: str, plate: str, event_id: int) -> dict:
     """Обработка въезда - ТОЛЬКО С ВАЛИДНЫМ НОМЕРОМ"""
     if not plate or plate.strip().upper() == "UNKNOWN" or not is_valid_plate(plate):
         print(f"❌ Entry denied or UNKNOWN plate: '{plate}' — just open barrier, do not save to DB")
-        barrier_opened = open_barrier(camera_ip)
+        barrier_opened = await open_barrier(camera_ip)
         return {
             "action": "unknown_plate",
             "barrier_opened": barrier_opened,
             "message": f"Въезд: номер не распознан (шлагбаум {'открыт' if barrier_opened else 'не открыт'})"
         }
 
-    if is_plate_in_whitelist(plate):
-        barrier_opened = open_barrier(camera_ip)
-        print(f"🚦 Белый список: въезд {plate} - шлагбаум открыт бесплатно")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        try:
-            entry_time = datetime.now(KYRGYZSTAN_TZ)
-            cur.execute("""
-                INSERT INTO parking_visits
-                (plate_number, entry_time, entry_camera_ip, entry_event_id,
-                 visit_status, entry_barrier_opened, cost_amount, cost_description, notes)
-                VALUES (%s, %s, %s, %s, 'active', %s, 0, 'Белый список', 'Въезд по белому списку')
-                RETURNING id
-            """, (plate, entry_time, camera_ip, event_id, barrier_opened))
-            session_id = cur.fetchone()[0]
-            conn.commit()
+    whitelisted = False
+    barrier_opened = False
+    try:
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                whitelisted = await lock_plate(conn, plate)
+                existing_session = None
+
+                if whitelisted:
+                    action = "entry_whitelist"
+                    entry_time = datetime.now(KYRGYZSTAN_TZ)
+                    # Повторный въезд по белому списку не создает вторую активную сессию
+                    session_id = await conn.fetchval("""
+                        WITH existing AS (
+                            SELECT id FROM parking_visits
+                            WHERE plate_number = $1 AND visit_status = 'active'
+                            LIMIT 1
+                        ), created AS (
+                            INSERT INTO parking_visits
+                            (plate_number, entry_time, entry_camera_ip, entry_event_id,
+                             visit_status, entry_barrier_opened, cost_amount, cost_description, notes)
+                            SELECT $1, $2, $3, $4, 'active', false, 0, 'Белый список', 'Въезд по белому списку'
+                            WHERE NOT EXISTS (SELECT 1 FROM existing)
+                            RETURNING id
+                        )
+                        SELECT id FROM created UNION ALL SELECT id FROM existing
+                    """, plate, entry_time, camera_ip, event_id)
+                else:
+                    existing_session = await conn.fetchrow("""
+                        SELECT id, entry_time FROM parking_visits
+                        WHERE plate_number = $1 AND visit_status = 'active'
+                        ORDER BY entry_time DESC LIMIT 1
+                    """, plate)
+
+                if existing_session:
+                    session_id, entry_time = existing_session
+                    hours_since_entry = (datetime.now(KYRGYZSTAN_TZ) - entry_time).total_seconds() / 3600
+
+                    if hours_since_entry < 2:
+                        print(f"⚠️ Duplicate entry detected for {plate}")
+                        action = "duplicate_entry"
+                    else:
+                        print(f"🔄 Force-closing old session for {plate}")
+
+                        exit_time = datetime.now(KYRGYZSTAN_TZ)
+                        cost_info = await calculate_parking_cost(entry_time, exit_time, conn)
+
+                        await conn.execute("""
+                            UPDATE parking_visits
+                            SET exit_time = $1,
+                                duration_minutes = $2,
+                                cost_amount = $3,
+                                cost_description = $4,
+                                visit_status = 'manual',
+                                notes = 'Принудительно закрыто из-за нового въезда',
+                                updated_at = $5
+                            WHERE id = $6
+                        """,
+                            exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
+                            cost_info["description"] + " (принуд. закрытие)", datetime.now(KYRGYZSTAN_TZ), session_id
+                        )
+                        existing_session = None
+
+                if not whitelisted and not existing_session:
+                    action = "entry"
+                    entry_time = datetime.now(KYRGYZSTAN_TZ)
+                    session_id = await conn.fetchval("""
+                        INSERT INTO parking_visits
+                        (plate_number, entry_time, entry_camera_ip, entry_event_id,
+                         visit_status, entry_barrier_opened)
+                        VALUES ($1, $2, $3, $4, 'active', false)
+                        RETURNING id
+                    """, plate, entry_time, camera_ip, event_id)
+
+        # Визит зафиксирован (COMMIT), соединение и блокировка номера отпущены -
+        # только теперь команда шлагбауму
+        barrier_opened = await open_barrier(camera_ip)
+
+        if action == "entry_whitelist":
+            print(f"🚦 Белый список: въезд {plate} - шлагбаум {'открыт' if barrier_opened else 'не открыт'} бесплатно")
+            if barrier_opened:
+                await _mark_barrier_opened(session_id, "entry_barrier_opened")
             return {
                 "action": "entry_whitelist",
                 "session_id": session_id,
                 "plate": plate,
                 "entry_time": entry_time.isoformat(),
                 "barrier_opened": barrier_opened,
-                "message": f"Въезд: {plate} (белый список) - шлагбаум открыт бесплатно, запись создана"
+                "message": f"Въезд: {plate} (белый список) - шлагбаум {'открыт' if barrier_opened else 'не открыт'} бесплатно, запись создана"
             }
-        except Exception as e:
-            conn.rollback()
-            print(f"❌ Error processing entry (whitelist): {e}")
+
+        if action == "duplicate_entry":
             return {
-                "error": str(e),
+                "action": "duplicate_entry",
+                "existing_session_id": session_id,
+                "entry_time": entry_time.isoformat(),
+                "hours_since_entry": round(hours_since_entry, 1),
                 "barrier_opened": barrier_opened,
-                "message": f"Ошибка въезда {plate} (белый список) - шлагбаум открыт, но запись не создана"
+                "message": f"Повторный въезд {plate}" + (" - шлагбаум открыт" if barrier_opened else " - ошибка шлагбаума")
             }
-        finally:
-            cur.close()
-            conn.close()
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    try:
-        expired_count = close_expired_sessions()
-        if expired_count > 0:
-            print(f"⏰ Closed {expired_count} expired sessions")
-
-        cur.execute("""
-            SELECT id, entry_time FROM parking_visits
-            WHERE plate_number = %s AND visit_status = 'active'
-            ORDER BY entry_time DESC LIMIT 1
-        """, (plate,))
-
-        existing_session = cur.fetchone()
-
-        if existing_session:
-            session_id, entry_time = existing_session
-            hours_since_entry = (datetime.now(KYRGYZSTAN_TZ) - entry_time).total_seconds() / 3600
-
-            if hours_since_entry < 2:
-                print(f"⚠️ Duplicate entry detected for {plate}")
-                barrier_opened = open_barrier(camera_ip)
 
-                return {
-                    "action": "duplicate_entry",
-                    "existing_session_id": session_id,
-                    "entry_time": entry_time.isoformat(),
-                    "hours_since_entry": round(hours_since_entry, 1),
-                    "barrier_opened": barrier_opened,
-                    "message": f"Повторный въезд {plate}" + (" - шлагбаум открыт" if barrier_opened else " - ошибка шлагбаума")
-                }
-            else:
-                print(f"🔄 Force-closing old session for {plate}")
-
-                exit_time = datetime.now(KYRGYZSTAN_TZ)
-                cost_info = calculate_parking_cost(entry_time, exit_time)
-
-                cur.execute("""
-                    UPDATE parking_visits
-                    SET exit_time = %s,
-                        duration_minutes = %s,
-                        cost_amount = %s,
-                        cost_description = %s,
-                        visit_status = 'manual',
-                        notes = 'Принудительно закрыто из-за нового въезда',
-                        updated_at = %s
-                    WHERE id = %s
-                """, (
-                    exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
-                    cost_info["description"] + " (принуд. закрытие)", datetime.now(KYRGYZSTAN_TZ), session_id
-                ))
-
-        entry_time = datetime.now(KYRGYZSTAN_TZ)
-
-        barrier_opened = open_barrier(camera_ip)
         print(f"🚪 BARRIER CONTROL: {barrier_opened} for valid plate {plate}")
-
-        cur.execute("""
-            INSERT INTO parking_visits
-            (plate_number, entry_time, entry_camera_ip, entry_event_id,
-             visit_status, entry_barrier_opened)
-            VALUES (%s, %s, %s, %s, 'active', %s)
-            RETURNING id
-        """, (plate, entry_time, camera_ip, event_id, barrier_opened))
-
-        session_id = cur.fetchone()[0]
-        conn.commit()
+        if barrier_opened:
+            await _mark_barrier_opened(session_id, "entry_barrier_opened")
 
         result = {
             "action": "entry",
@@ -490,158 +507,201 @@ def process_entry(camera_ip: str, plate: str, event_id: int) -> dict:
         return result
 
     except Exception as e:
-        conn.rollback()
+        if whitelisted:
+            print(f"❌ Error processing entry (whitelist): {e}")
+            # Номер в белом списке пропускаем и без записи визита
+            if not barrier_opened:
+                barrier_opened = await open_barrier(camera_ip)
+            return {
+                "error": str(e),
+                "barrier_opened": barrier_opened,
+                "message": f"Ошибка въезда {plate} (белый список) - шлагбаум {'открыт' if barrier_opened else 'не открыт'}, но запись не создана"
+            }
         print(f"❌ Error processing entry: {e}")
         return {
             "error": str(e),
             "barrier_opened": False,
             "message": f"Ошибка въезда {plate} - шлагбаум заблокирован"
         }
-    finally:
-        cur.close()
-        conn.close()
 
-def process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
+async def _process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
     """Обработка выезда с ИНТЕГРАЦИЕЙ ПЛАТЕЖЕЙ или в режиме free"""
     if not plate or plate.strip().upper() == "UNKNOWN" or not is_valid_plate(plate):
         print(f"❌ Exit denied or UNKNOWN plate: '{plate}' — just open barrier, do not save to DB")
-        barrier_opened = open_barrier(camera_ip)
+        barrier_opened = await open_barrier(camera_ip)
         return {
             "action": "unknown_plate",
             "barrier_opened": barrier_opened,
             "message": f"Выезд: номер не распознан (шлагбаум {'открыт' if barrier_opened else 'не открыт'})"
         }
 
-    if is_plate_in_whitelist(plate):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("""
-                SELECT id, entry_time FROM parking_visits
-                WHERE plate_number = %s AND visit_status = 'active'
-                ORDER BY entry_time DESC LIMIT 1
-            """, (plate,))
-            active_session = cur.fetchone()
-            barrier_opened = open_barrier(camera_ip)
-            if active_session:
-                session_id, entry_time = active_session
-                exit_time = datetime.now(KYRGYZSTAN_TZ)
-                duration_minutes = int((exit_time - entry_time).total_seconds() / 60)
-                cur.execute("""
-                    UPDATE parking_visits
-                    SET exit_time = %s,
-                        duration_minutes = %s,
-                        cost_amount = 0,
-                        cost_description = 'Бесплатно (белый список)',
-                        visit_status = 'completed',
-                        exit_camera_ip = %s,
-                        exit_event_id = %s,
-                        exit_barrier_opened = %s,
-                        payment_received = True,
-                        updated_at = %s,
-                        notes = 'Сессия завершена по белому списку'
-                    WHERE id = %s
-                """, (
-                    exit_time, duration_minutes, camera_ip, event_id, barrier_opened,
-                    datetime.now(KYRGYZSTAN_TZ), session_id
-                ))
-                conn.commit()
-                return {
-                    "action": "exit_whitelist",
-                    "plate": plate,
-                    "barrier_opened": barrier_opened,
-                    "payment_required": False,
-                    "message": f"Выезд: {plate} (белый список) - шлагбаум открыт бесплатно, сессия закрыта"
-                }
-            else:
-                print(f"🚦 Белый список: выезд {plate} - активная сессия не найдена")
-                now = datetime.now(KYRGYZSTAN_TZ)
-                cur.execute("""
-                    INSERT INTO parking_visits
-                    (plate_number, entry_time, exit_time, duration_minutes, cost_amount,
-                     cost_description, visit_status, exit_camera_ip, exit_event_id,
-                     exit_barrier_opened, notes)
-                    VALUES (%s, %s, %s, 0, 0, 'Белый список, выезд без въезда', 'manual', %s, %s, %s,
-                            'Выезд по белому списку без активной сессии')
-                    RETURNING id
-                """, (
-                    plate, now, now, camera_ip, event_id, barrier_opened
-                ))
-                session_id = cur.fetchone()[0]
-                conn.commit()
+    free_mode = PARKING_CONFIG.get("mode", "paid") == "free"
+    whitelisted = False
+    barrier_opened = False
+    needs_payment = False
+    try:
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                whitelisted = await lock_plate(conn, plate)
+
+                if whitelisted:
+                    action = "exit_whitelist"
+                    now = datetime.now(KYRGYZSTAN_TZ)
+                    # Закрываем активную сессию или, если ее нет, создаем запись выезда - одним запросом
+                    session_id, session_closed = await conn.fetchrow("""
+                        WITH closed AS (
+                            UPDATE parking_visits
+                            SET exit_time = $2,
+                                duration_minutes = FLOOR(EXTRACT(EPOCH FROM ($2::timestamptz - entry_time)) / 60)::int,
+                                cost_amount = 0,
+                                cost_description = 'Бесплатно (белый список)',
+                                visit_status = 'completed',
+                                exit_camera_ip = $3,
+                                exit_event_id = $4,
+                                exit_barrier_opened = false,
+                                payment_received = True,
+                                updated_at = $2,
+                                notes = 'Сессия завершена по белому списку'
+                            WHERE id = (
+                                SELECT id FROM parking_visits
+                                WHERE plate_number = $1 AND visit_status = 'active'
+                                ORDER BY entry_time DESC LIMIT 1
+                            )
+                            RETURNING id
+                        ), created AS (
+                            INSERT INTO parking_visits
+                            (plate_number, entry_time, exit_time, duration_minutes, cost_amount,
+                             cost_description, visit_status, exit_camera_ip, exit_event_id,
+                             exit_barrier_opened, notes)
+                            SELECT $1, $2, $2, 0, 0, 'Белый список, выезд без въезда', 'manual', $3, $4, false,
+                                   'Выезд по белому списку без активной сессии'
+                            WHERE NOT EXISTS (SELECT 1 FROM closed)
+                            RETURNING id
+                        )
+                        SELECT id, true FROM closed
+                        UNION ALL
+                        SELECT id, false FROM created
+                    """, plate, now, camera_ip, event_id)
+                else:
+                    if free_mode:
+                        print("🚦 Режим парковки: FREE — оплата не требуется, шлагбаум открывается автоматически")
+
+                    active_session = await conn.fetchrow("""
+                        SELECT id, entry_time FROM parking_visits
+                        WHERE plate_number = $1 AND visit_status = 'active'
+                        ORDER BY entry_time DESC LIMIT 1
+                    """, plate)
+
+                    if not active_session:
+                        action = "exit_without_entry"
+                        if not free_mode:
+                            print(f"⚠️ No active session found for vehicle {plate}")
+                        now = datetime.now(KYRGYZSTAN_TZ)
+
+                        session_id = await conn.fetchval("""
+                            INSERT INTO parking_visits
+                            (plate_number, entry_time, exit_time, duration_minutes, cost_amount,
+                             cost_description, visit_status, exit_camera_ip, exit_event_id,
+                             exit_barrier_opened, notes)
+                            VALUES ($1, $2, $3, 0, 0, $4, 'manual', $5, $6, false, $7)
+                            RETURNING id
+                        """,
+                            plate, now, now,
+                            'Выезд без въезда (free mode)' if free_mode else 'Выезд без въезда',
+                            camera_ip, event_id,
+                            'Сессия въезда не найдена (free mode)' if free_mode else 'Сессия въезда не найдена'
+                        )
+                    else:
+                        action = "exit"
+                        session_id, entry_time = active_session
+                        exit_time = datetime.now(KYRGYZSTAN_TZ)
+
+                        cost_info = await calculate_parking_cost(entry_time, exit_time, conn)
+
+                        exit_lane = lane_registry.resolve(camera_ip)
+                        needs_payment = (
+                            not free_mode and
+                            BAKAI_CONFIG["enable_payment_flow"] and 
+                            cost_info["total_cost"] > 0 and 
+                            exit_lane is not None and exit_lane.payment_flow
+                        )
+
+                        await conn.execute("""
+                            UPDATE parking_visits
+                            SET exit_time = $1,
+                                duration_minutes = $2,
+                                cost_amount = $3,
+                                cost_description = $4,
+                                visit_status = 'completed',
+                                exit_camera_ip = $5,
+                                exit_event_id = $6,
+                                exit_barrier_opened = false,
+                                payment_received = $7,
+                                updated_at = $8,
+                                notes = COALESCE($9, notes)
+                            WHERE id = $10
+                        """,
+                            exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
+                            cost_info["description"], camera_ip, event_id,
+                            not needs_payment and (free_mode or cost_info["total_cost"] == 0),
+                            datetime.now(KYRGYZSTAN_TZ),
+                            'Требуется оплата для открытия шлагбаума' if needs_payment
+                            else 'Сессия завершена в режиме free' if free_mode else None,
+                            session_id
+                        )
+
+        # Визит зафиксирован (COMMIT), соединение и блокировка номера отпущены -
+        # только теперь команда шлагбауму (при оплате его откроет webhook)
+        if not needs_payment:
+            barrier_opened = await open_barrier(camera_ip)
+            if barrier_opened:
+                await _mark_barrier_opened(session_id, "exit_barrier_opened")
+
+        if action == "exit_whitelist":
+            if session_closed:
                 return {
                     "action": "exit_whitelist",
-                    "session_id": session_id,
                     "plate": plate,
                     "barrier_opened": barrier_opened,
                     "payment_required": False,
-                    "message": f"Выезд: {plate} (белый список) - шлагбаум открыт бесплатно (активная сессия не найдена, запись создана)"
+                    "message": f"Выезд: {plate} (белый список) - шлагбаум {'открыт' if barrier_opened else 'не открыт'} бесплатно, сессия закрыта"
                 }
-        finally:
-            cur.close()
-            conn.close()
+            print(f"🚦 Белый список: выезд {plate} - активная сессия не найдена")
+            return {
+                "action": "exit_whitelist",
+                "session_id": session_id,
+                "plate": plate,
+                "barrier_opened": barrier_opened,
+                "payment_required": False,
+                "message": f"Выезд: {plate} (белый список) - шлагбаум {'открыт' if barrier_opened else 'не открыт'} бесплатно (активная сессия не найдена, запись создана)"
+            }
 
-    if PARKING_CONFIG.get("mode", "paid") == "free":
-        print("🚦 Режим парковки: FREE — оплата не требуется, шлагбаум открывается автоматически")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("""
-                SELECT id, entry_time FROM parking_visits
-                WHERE plate_number = %s AND visit_status = 'active'
-                ORDER BY entry_time DESC LIMIT 1
-            """, (plate,))
-            active_session = cur.fetchone()
-            if not active_session:
-                now = datetime.now(KYRGYZSTAN_TZ)
-                barrier_opened = open_barrier(camera_ip)
-                cur.execute("""
-                    INSERT INTO parking_visits
-                    (plate_number, entry_time, exit_time, duration_minutes, cost_amount,
-                     cost_description, visit_status, exit_camera_ip, exit_event_id,
-                     exit_barrier_opened, notes)
-                    VALUES (%s, %s, %s, 0, 0, 'Выезд без въезда (free mode)', 'manual', %s, %s, %s,
-                            'Сессия въезда не найдена (free mode)')
-                    RETURNING id
-                """, (
-                    plate, now, now, camera_ip, event_id, barrier_opened
-                ))
-                manual_session_id = cur.fetchone()[0]
-                conn.commit()
+        if action == "exit_without_entry":
+            if free_mode:
                 return {
                     "action": "exit_without_entry",
-                    "session_id": manual_session_id,
+                    "session_id": session_id,
                     "plate": plate,
                     "barrier_opened": barrier_opened,
                     "payment_required": False,
                     "message": f"Выезд без въезда: {plate} (free mode) - шлагбаум открыт",
                     "warning": "Активная сессия въезда не найдена (free mode)"
                 }
-            session_id, entry_time = active_session
-            exit_time = datetime.now(KYRGYZSTAN_TZ)
-            cost_info = calculate_parking_cost(entry_time, exit_time)
-            barrier_opened = open_barrier(camera_ip)
-            cur.execute("""
-                UPDATE parking_visits
-                SET exit_time = %s,
-                    duration_minutes = %s,
-                    cost_amount = %s,
-                    cost_description = %s,
-                    visit_status = 'completed',
-                    exit_camera_ip = %s,
-                    exit_event_id = %s,
-                    exit_barrier_opened = %s,
-                    payment_received = True,
-                    updated_at = %s,
-                    notes = 'Сессия завершена в режиме free'
-                WHERE id = %s
-            """, (
-                exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
-                cost_info["description"], camera_ip, event_id, barrier_opened,
-                datetime.now(KYRGYZSTAN_TZ), session_id
-            ))
-            conn.commit()
-            duration_str = format_duration(cost_info["duration_minutes"])
+            return {
+                "action": "exit_without_entry",
+                "session_id": session_id,
+                "plate": plate,
+                "barrier_opened": barrier_opened,
+                "message": f"Выезд без въезда: {plate}" + (" - шлагбаум открыт" if barrier_opened else " - ошибка шлагбаума"),
+                "warning": "Активная сессия въезда не найдена"
+            }
+
+        if not needs_payment:
+            print(f"🚪 EXIT BARRIER OPENED: {barrier_opened} for valid plate {plate}")
+
+        duration_str = format_duration(cost_info["duration_minutes"])
+
+        if free_mode:
             result = {
                 "action": "exit_free_mode",
                 "session_id": session_id,
@@ -658,99 +718,8 @@ def process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
             }
             print(f"✅ Exit processed (free mode): {result}")
             return result
-        except Exception as e:
-            conn.rollback()
-            print(f"❌ Error processing exit (free mode): {e}")
-            return {
-                "error": str(e),
-                "barrier_opened": False,
-                "message": f"Ошибка выезда {plate} (free mode) - шлагбаум заблокирован"
-            }
-        finally:
-            cur.close()
-            conn.close()
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    try:
-        expired_count = close_expired_sessions()
-        if expired_count > 0:
-            print(f"⏰ Closed {expired_count} expired sessions")
-
-        cur.execute("""
-            SELECT id, entry_time FROM parking_visits
-            WHERE plate_number = %s AND visit_status = 'active'
-            ORDER BY entry_time DESC LIMIT 1
-        """, (plate,))
-
-        active_session = cur.fetchone()
-
-        if not active_session:
-            print(f"⚠️ No active session found for vehicle {plate}")
-
-            barrier_opened = open_barrier(camera_ip)
-
-            cur.execute("""
-                INSERT INTO parking_visits
-                (plate_number, entry_time, exit_time, duration_minutes, cost_amount,
-                 cost_description, visit_status, exit_camera_ip, exit_event_id,
-                 exit_barrier_opened, notes)
-                VALUES (%s, %s, %s, 0, 0, 'Выезд без въезда', 'manual', %s, %s, %s,
-                        'Сессия въезда не найдена')
-                RETURNING id
-            """, (
-                plate, datetime.now(KYRGYZSTAN_TZ), datetime.now(KYRGYZSTAN_TZ),
-                camera_ip, event_id, barrier_opened
-            ))
-
-            manual_session_id = cur.fetchone()[0]
-            conn.commit()
-
-            return {
-                "action": "exit_without_entry",
-                "session_id": manual_session_id,
-                "plate": plate,
-                "barrier_opened": barrier_opened,
-                "message": f"Выезд без въезда: {plate}" + (" - шлагбаум открыт" if barrier_opened else " - ошибка шлагбаума"),
-                "warning": "Активная сессия въезда не найдена"
-            }
-
-        session_id, entry_time = active_session
-        exit_time = datetime.now(KYRGYZSTAN_TZ)
-
-        cost_info = calculate_parking_cost(entry_time, exit_time)
-
-        needs_payment = (
-            BAKAI_CONFIG["enable_payment_flow"] and 
-            cost_info["total_cost"] > 0 and 
-            camera_ip == PARKING_CONFIG["exit_camera_ip"]
-        )
 
         if needs_payment:
-            cur.execute("""
-                UPDATE parking_visits
-                SET exit_time = %s,
-                    duration_minutes = %s,
-                    cost_amount = %s,
-                    cost_description = %s,
-                    visit_status = 'completed',
-                    exit_camera_ip = %s,
-                    exit_event_id = %s,
-                    exit_barrier_opened = false,
-                    payment_received = false,
-                    notes = 'Требуется оплата для открытия шлагбаума',
-                    updated_at = %s
-                WHERE id = %s
-            """, (
-                exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
-                cost_info["description"], camera_ip, event_id,
-                datetime.now(KYRGYZSTAN_TZ), session_id
-            ))
-
-            conn.commit()
-            duration_str = format_duration(cost_info["duration_minutes"])
-
             print(f"💳 PAYMENT REQUIRED for {plate}: {cost_info['total_cost']} сом")
 
             result = {
@@ -768,32 +737,6 @@ def process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
                 "message": f"Выезд: {plate} | {duration_str} | {cost_info['total_cost']} сом | ТРЕБУЕТСЯ ОПЛАТА"
             }
         else:
-            barrier_opened = open_barrier(camera_ip)
-            print(f"🚪 EXIT BARRIER OPENED: {barrier_opened} for valid plate {plate}")
-
-            cur.execute("""
-                UPDATE parking_visits
-                SET exit_time = %s,
-                    duration_minutes = %s,
-                    cost_amount = %s,
-                    cost_description = %s,
-                    visit_status = 'completed',
-                    exit_camera_ip = %s,
-                    exit_event_id = %s,
-                    exit_barrier_opened = %s,
-                    payment_received = %s,
-                    updated_at = %s
-                WHERE id = %s
-            """, (
-                exit_time, cost_info["duration_minutes"], cost_info["total_cost"],
-                cost_info["description"], camera_ip, event_id, barrier_opened,
-                True if cost_info["total_cost"] == 0 else False,
-                datetime.now(KYRGYZSTAN_TZ), session_id
-            ))
-
-            conn.commit()
-            duration_str = format_duration(cost_info["duration_minutes"])
-
             result = {
                 "action": "exit",
                 "session_id": session_id,
@@ -813,30 +756,40 @@ def process_exit(camera_ip: str, plate: str, event_id: int) -> dict:
         return result
        
     except Exception as e:
-        conn.rollback()
+        if whitelisted:
+            print(f"❌ Error processing exit (whitelist): {e}")
+            # Номер в белом списке выпускаем и без закрытия сессии
+            if not barrier_opened:
+                barrier_opened = await open_barrier(camera_ip)
+            return {
+                "error": str(e),
+                "barrier_opened": barrier_opened,
+                "message": f"Ошибка выезда {plate} (белый список) - шлагбаум {'открыт' if barrier_opened else 'не открыт'}, но сессия не закрыта"
+            }
+        if free_mode:
+            print(f"❌ Error processing exit (free mode): {e}")
+            return {
+                "error": str(e),
+                "barrier_opened": False,
+                "message": f"Ошибка выезда {plate} (free mode) - шлагбаум заблокирован"
+            }
         print(f"❌ Error processing exit: {e}")
         return {
             "error": str(e),
             "barrier_opened": False,
             "message": f"Ошибка выезда {plate} - шлагбаум заблокирован"
         }
-    finally:
-        cur.close()
-        conn.close()
 
-def create_payment_session(session_id: int) -> dict:
+async def create_payment_session(session_id: int) -> dict:
     """Создать платежную сессию для завершенного визита"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT plate_number, entry_time, exit_time, cost_amount, cost_description, payment_received
-            FROM parking_visits
-            WHERE id = %s AND visit_status = 'completed'
-        """, (session_id,))
+        async with get_db_connection() as conn:
+            session = await conn.fetchrow("""
+                SELECT plate_number, entry_time, exit_time, cost_amount, cost_description, payment_received
+                FROM parking_visits
+                WHERE id = $1 AND visit_status = 'completed'
+            """, session_id)
         
-        session = cur.fetchone()
         if not session:
             return {"error": "Session not found or not completed"}
         
@@ -860,6 +813,3 @@ def create_payment_session(session_id: int) -> dict:
         
     except Exception as e:
         return {"error": str(e)}
-    finally:
-        cur.close()
-        conn.close()
@@ -1,155 +1,156 @@
 """
-Модуль для работы с Bakai OpenBanking API - генерация QR и проверка статуса
+Модуль для работы с Bakai OpenBanking API - генерация QR и проверка статуса.
+Один асинхронный клиент на процесс: пул keep-alive соединений HTTP/1.1,
+у каждого вызова свой дедлайн, повторы при сетевых ошибках и 5xx.
+Повтор GenerateQR идет с тем же operationID, поэтому банк не создаст второй QR.
 """
-import requests
+import asyncio
+import random
+import time
 import uuid
 import logging
-from datetime import datetime
+import httpx
 from ..config import BAKAI_CONFIG
-from ..db import get_db_connection
 
 logger = logging.getLogger(__name__)
 
-class BakaiPaymentService:
+PAID_STATUSES = ("paid", "success", "completed", "approved")
+
+
+class BakaiError(Exception):
+    """Ошибка вызова Bakai: status_code=None - банк недоступен (сеть/таймаут)"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_payment_status(data: dict):
+    """Статус платежа из ответа GetStatus (в нижнем регистре) или None, если не распознан"""
+    if "status" in data and data["status"]:
+        return str(data["status"]).lower()
+    if "paymentStatus" in data and data["paymentStatus"]:
+        return str(data["paymentStatus"]).lower()
+    if data.get("isPaid") or data.get("success"):
+        return "paid"
+    return None
+
+
+class BakaiClient:
     def __init__(self):
-        self.base_url = BAKAI_CONFIG["api_base_url"]
-        self.token = BAKAI_CONFIG["token"]
-        self.merchant_account = BAKAI_CONFIG["merchant_account"]
-        self.timeout = BAKAI_CONFIG["timeout"]
-    
-    def generate_qr_code(self, amount: float, operation_id: str = None) -> dict:
+        self.client = None
+        self.stats_counters = {"requests": 0, "retries": 0, "errors": 0}
+
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=BAKAI_CONFIG["api_base_url"],
+                headers={
+                    "Authorization": f"Bearer {BAKAI_CONFIG['token']}",
+                    "Content-Type": "application/json",
+                    "Accept": "application/json"
+                },
+                timeout=httpx.Timeout(BAKAI_CONFIG["timeout"], connect=BAKAI_CONFIG["connect_timeout"]),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+            )
+        return self.client
+
+    async def _request(self, method: str, path: str, deadline_seconds: float, **kwargs) -> httpx.Response:
+        """Запрос с повторами до истечения дедлайна; 4xx и 200 возвращаются без повторов"""
+        deadline = time.monotonic() + deadline_seconds
+        attempts = BAKAI_CONFIG["retry_attempts"]
+        last_error = None
+        for attempt in range(attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if attempt:
+                self.stats_counters["retries"] += 1
+                backoff = 0.3 * 2 ** (attempt - 1)
+                await asyncio.sleep(min(backoff + random.uniform(0, backoff), remaining))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            self.stats_counters["requests"] += 1
+            try:
+                response = await self._client().request(
+                    method, path, timeout=min(BAKAI_CONFIG["timeout"], remaining), **kwargs
+                )
+            except httpx.HTTPError as e:
+                last_error = BakaiError(f"Bakai API unavailable: {e!r}")
+                logger.warning(f"Bakai {path} attempt {attempt + 1}/{attempts} failed: {e!r}")
+                continue
+            if response.status_code < 500:
+                return response
+            last_error = BakaiError(f"Bakai API error: {response.status_code} - {response.text}", response.status_code)
+            logger.warning(f"Bakai {path} attempt {attempt + 1}/{attempts}: {response.status_code}")
+        self.stats_counters["errors"] += 1
+        raise last_error or BakaiError(f"Bakai API deadline {deadline_seconds}s exceeded")
+
+    async def generate_qr(self, amount: float, operation_id: str = None, deadline_seconds: float = None) -> dict:
         """
-        Генерация QR кода для оплаты через Bakai OpenBanking
-        
-        Args:
-            amount: Сумма к оплате
-            operation_id: Уникальный ID операции (генерируется автоматически если None)
-        
-        Returns:
-            dict: Результат генерации QR кода
+        Генерация QR кода для оплаты.
+        Возвращает operation_id (наш), bakai_operation_id (из ответа банка или наш),
+        qr_image и raw_response; при ошибке - BakaiError.
         """
-        if not operation_id:
-            operation_id = str(uuid.uuid4())
-        
-        url = f"{self.base_url}/api/Qr/GenerateQR"
-        
+        operation_id = operation_id or str(uuid.uuid4())
         payload = {
-            "accountNo": self.merchant_account,
+            "accountNo": BAKAI_CONFIG["merchant_account"],
             "currencyId": 417,
-            "amount": round(amount, 2),
+            "amount": round(float(amount), 2),
             "operationID": operation_id
         }
-        
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
+        logger.info(f"Generating QR code for amount: {amount}, operation: {operation_id}")
+        response = await self._request(
+            "POST", "/api/Qr/GenerateQR",
+            deadline_seconds or BAKAI_CONFIG["qr_deadline_seconds"],
+            json=payload
+        )
+        if response.status_code != 200:
+            raise BakaiError(f"Bakai QR API error: {response.status_code} - {response.text}", response.status_code)
+
+        result = response.json()
+        qr_image = result.get("qrImage")
+        if not qr_image:
+            raise BakaiError(f"No QR image in Bakai response: {result}", response.status_code)
+
+        return {
+            "operation_id": operation_id,
+            "bakai_operation_id": result.get("operationID") or result.get("operationId") or result.get("transactionId") or operation_id,
+            "qr_image": qr_image,
+            "raw_response": result
         }
-        
-        try:
-            logger.info(f"Generating QR code for amount: {amount}, operation: {operation_id}")
-            
-            response = requests.post(
-                url, 
-                json=payload, 
-                headers=headers, 
-                timeout=self.timeout
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                logger.info(f"QR code generated successfully: {operation_id}")
-                return {
-                    "success": True,
-                    "operation_id": operation_id,
-                    "qr_image": result.get("qrImage", ""),
-                    "raw_response": result
-                }
-            else:
-                error_msg = f"Bakai API error: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                return {
-                    "success": False,
-                    "error": error_msg,
-                    "status_code": response.status_code
-                }
-                
-        except requests.exceptions.Timeout:
-            error_msg = "Bakai API timeout"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-        except requests.exceptions.RequestException as e:
-            error_msg = f"Bakai API request error: {str(e)}"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-        except Exception as e:
-            error_msg = f"Unexpected error in QR generation: {str(e)}"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-    
-    def check_payment_status(self, operation_id: str) -> dict:
+
+    async def get_status(self, operation_id: str, deadline_seconds: float = None) -> dict:
         """
-        Проверка статуса оплаты по operation_id
-        
-        Args:
-            operation_id: ID операции для проверки статуса
-        
-        Returns:
-            dict: Статус оплаты
+        Статус оплаты по operation_id: http_status, status (None - не распознан),
+        paid и raw_response; банк недоступен - BakaiError.
         """
-        url = f"{self.base_url}/api/Qr/GetStatus"
-        
-        payload = {
-            "operationID": operation_id
-        }
-        
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
+        response = await self._request(
+            "GET", "/api/Qr/GetStatus",
+            deadline_seconds or BAKAI_CONFIG["status_deadline_seconds"],
+            params={"operationID": operation_id}
+        )
+        logger.info(f"Bakai status API response: {response.status_code} {response.text}")
+        if response.status_code != 200:
+            return {"http_status": response.status_code, "status": None, "paid": False, "raw_response": response.text}
+
+        data = response.json()
+        status = parse_payment_status(data)
+        return {
+            "http_status": 200,
+            "status": status,
+            "paid": status in PAID_STATUSES,
+            "raw_response": data
         }
-        
-        try:
-            logger.info(f"Checking payment status for operation: {operation_id}")
-            
-            response = requests.post(
-                url, 
-                json=payload, 
-                headers=headers, 
-                timeout=self.timeout
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                status = result.get("status", "").lower()
-                
-                logger.info(f"Payment status for {operation_id}: {status}")
-                
-                return {
-                    "success": True,
-                    "operation_id": operation_id,
-                    "status": status,
-                    "paid": status == "paid",
-                    "raw_response": result
-                }
-            else:
-                error_msg = f"Bakai status check error: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                return {
-                    "success": False,
-                    "error": error_msg,
-                    "status_code": response.status_code
-                }
-                
-        except requests.exceptions.Timeout:
-            error_msg = "Bakai status check timeout"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-        except requests.exceptions.RequestException as e:
-            error_msg = f"Bakai status check request error: {str(e)}"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-        except Exception as e:
-            error_msg = f"Unexpected error in status check: {str(e)}"
-            logger.error(error_msg)
-            return {"success": False, "error": error_msg}
-
-bakai_service = BakaiPaymentService()
\ No newline at end of file
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def stats(self) -> dict:
+        return dict(self.stats_counters)
+
+
+bakai_client = BakaiClient()
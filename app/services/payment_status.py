@@ -0,0 +1,179 @@
+"""
+Общий опрос статуса платежей: на каждую ожидающую операцию - одна фоновая
+задача и не более одного запроса к банку одновременно. HTTP (/payment/check-status)
+читатели (и /ws/payment_status при выключенном NOTIFY) получают закэшированный результат.
+
+Интервал: status_poll_fast_seconds первые status_poll_fast_period_seconds,
+затем растет в 1.5 раза до status_poll_max_seconds. Опрос останавливается на
+финальном статусе или если результат никто не читал status_poll_idle_seconds.
+
+PaymentStatusHub - рассылка изменений parking_payments по NOTIFY (триггер
+parking_payments_notify): одно LISTEN-соединение на процесс, WebSocket
+подписчики получают новый статус через свою очередь без запросов к БД.
+"""
+import asyncio
+import json
+import logging
+import time
+from ..config import BAKAI_CONFIG
+from ..db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentStatusPoller:
+    def __init__(self, checker=None):
+        self.checker = checker
+        self.operations = {}
+        self.counters = {"reads": 0, "checks": 0, "started": 0}
+
+    def set_checker(self, checker):
+        """checker(operation_id) -> dict с ключами payment_status и final"""
+        self.checker = checker
+
+    def _get_state(self, operation_id: str) -> dict:
+        state = self.operations.get(operation_id)
+        if state is None:
+            now = time.monotonic()
+            state = {
+                "result": None,
+                "error": None,
+                "version": 0,
+                "updated": asyncio.Event(),
+                "started_at": now,
+                "last_read": now
+            }
+            self.operations[operation_id] = state
+            self.counters["started"] += 1
+            state["task"] = asyncio.create_task(self._poll(operation_id, state))
+        state["last_read"] = time.monotonic()
+        return state
+
+    async def get(self, operation_id: str) -> dict:
+        """Последний результат проверки (первый читатель дожидается первой проверки)"""
+        self.counters["reads"] += 1
+        state = self._get_state(operation_id)
+        if state["version"] == 0:
+            await state["updated"].wait()
+        if state["error"] is not None:
+            raise state["error"]
+        return state["result"]
+
+    async def wait_update(self, operation_id: str, version: int, timeout: float):
+        """
+        Ждет результат новее version (не дольше timeout).
+        Возвращает (version, result, error): error - исключение последней проверки
+        (result тогда None); result=None без error - проверок еще не было.
+        """
+        state = self._get_state(operation_id)
+        if state["version"] <= version:
+            try:
+                await asyncio.wait_for(state["updated"].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if state["error"] is not None:
+            return state["version"], None, state["error"]
+        return state["version"], state["result"], None
+
+    async def _poll(self, operation_id: str, state: dict):
+        interval = BAKAI_CONFIG["status_poll_fast_seconds"]
+        try:
+            while True:
+                try:
+                    state["result"] = await self.checker(operation_id)
+                    state["error"] = None
+                except Exception as e:
+                    state["error"] = e
+                self.counters["checks"] += 1
+                state["version"] += 1
+                updated, state["updated"] = state["updated"], asyncio.Event()
+                updated.set()
+
+                if state["error"] is None and state["result"].get("final"):
+                    # Финальный статус остается в кэше для опоздавших читателей
+                    await asyncio.sleep(BAKAI_CONFIG["status_poll_idle_seconds"])
+                    return
+
+                now = time.monotonic()
+                if now - state["last_read"] > BAKAI_CONFIG["status_poll_idle_seconds"]:
+                    return
+                if now - state["started_at"] > BAKAI_CONFIG["status_poll_fast_period_seconds"]:
+                    interval = min(interval * 1.5, BAKAI_CONFIG["status_poll_max_seconds"])
+                await asyncio.sleep(interval)
+        finally:
+            if self.operations.get(operation_id) is state:
+                del self.operations[operation_id]
+
+    def stop(self):
+        for state in self.operations.values():
+            state["task"].cancel()
+
+    def stats(self) -> dict:
+        return {"active": len(self.operations), **self.counters}
+
+
+payment_status_poller = PaymentStatusPoller()
+
+
+async def read_payment_status(operation_id: str):
+    """Текущий payment_status операции из БД или None, если платежа нет"""
+    async with get_db_connection() as conn:
+        return await conn.fetchval("""
+            SELECT payment_status FROM parking_payments
+            WHERE transaction_id = $1 OR bakai_operation_id = $1
+            ORDER BY id DESC LIMIT 1
+        """, operation_id)
+
+
+class PaymentStatusHub:
+    def __init__(self, queue_size: int = 16):
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.counters = {"notifications": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self, operation_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(operation_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, operation_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(operation_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[operation_id]
+
+    def _deliver(self, queue: asyncio.Queue, message: dict):
+        try:
+            queue.put_nowait(message)
+            self.counters["delivered"] += 1
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+
+    def on_notify(self, payload):
+        """Обработчик NOTIFY parking_payments; payload=None - переподключение, всем перечитать статус"""
+        if payload is None:
+            for queues in self.subscribers.values():
+                for queue in queues:
+                    self._deliver(queue, {"resync": True})
+            return
+        self.counters["notifications"] += 1
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Bad parking_payments notification: {payload}")
+            return
+        message = {"status": data.get("payment_status")}
+        for operation_id in {data.get("transaction_id"), data.get("bakai_operation_id")} - {None}:
+            for queue in self.subscribers.get(operation_id, ()):
+                self._deliver(queue, message)
+
+    def stats(self) -> dict:
+        return {
+            "operations": len(self.subscribers),
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            **self.counters
+        }
+
+
+payment_status_hub = PaymentStatusHub()
@@ -0,0 +1,132 @@
+"""
+Кэш ответов GET для часто опрашиваемых и редко меняющихся endpoint'ов
+(RESPONSE_CACHE_CONFIG["routes"]: путь или префикс на "/" -> ttl_seconds и версии данных).
+
+Ответ хранится уже сериализованным (байты) вместе с версиями данных на момент
+расчета. Запись действует, пока не истек ttl и не поднялась ни одна версия:
+версии поднимают endpoint'ы записи и NOTIFY (изменения из других воркеров).
+ETag - хэш тела, поэтому он одинаков во всех воркерах; If-None-Match -> 304
+без запроса к БД и без сериализации. Одновременные промахи по одному ключу
+ждут один расчет.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from fastapi import Request
+from fastapi.responses import Response
+from ..config import RESPONSE_CACHE_CONFIG
+from .admin_feed import ADMIN_FEED_TABLES, FEED_NAMES
+
+CACHED_HEADERS = ("content-type",)
+
+
+class DataVersions:
+    def __init__(self):
+        self.versions = {}
+
+    def bump(self, *names):
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def get(self, names) -> tuple:
+        return tuple(self.versions.get(name, 0) for name in names)
+
+    def notify_handler(self, *names):
+        """Обработчик NOTIFY: любое уведомление (и переподключение слушателя) поднимает версии names"""
+        return lambda payload: self.bump(*names)
+
+    def on_admin_change(self, payload):
+        """Обработчик NOTIFY admin_changes: версия ленты измененной таблицы, None - все ленты"""
+        if payload is None:
+            self.bump(*ADMIN_FEED_TABLES)
+            return
+        try:
+            table = json.loads(payload).get("table")
+        except ValueError:
+            return
+        self.bump(FEED_NAMES.get(table, table))
+
+
+data_versions = DataVersions()
+
+
+class ResponseCache:
+    def __init__(self, routes: dict, max_entries: int):
+        self.exact = {path: rule for path, rule in routes.items() if not path.endswith("/")}
+        self.prefixes = [(path, rule) for path, rule in routes.items() if path.endswith("/")]
+        self.max_entries = max_entries
+        self.entries = {}
+        self.inflight = {}
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "not_modified": 0}
+
+    def rule_for(self, path: str):
+        rule = self.exact.get(path)
+        if rule is not None:
+            return rule
+        for prefix, rule in self.prefixes:
+            if path.startswith(prefix):
+                return rule
+        return None
+
+    async def _compute(self, request: Request, call_next, versions: tuple, ttl: float):
+        response = await call_next(request)
+        if response.status_code != 200:
+            return None, response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        entry = {
+            "body": body,
+            "headers": {key: value for key, value in response.headers.items() if key in CACHED_HEADERS},
+            "etag": f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"',
+            "versions": versions,
+            "expires": time.monotonic() + ttl
+        }
+        return entry, None
+
+    async def middleware(self, request: Request, call_next):
+        rule = self.rule_for(request.url.path) if request.method == "GET" else None
+        # Дельты ленты админки (?since=) зависят от курсора клиента - не кэшируются
+        if rule is None or "since" in request.query_params:
+            return await call_next(request)
+
+        key = f"{request.url.path}?{'&'.join(sorted(str(request.query_params).split('&')))}"
+        # Версии берутся до расчета: изменение во время расчета сделает запись устаревшей
+        versions = data_versions.get(rule["versions"])
+        entry = self.entries.get(key)
+        if entry is not None and entry["versions"] == versions and entry["expires"] > time.monotonic():
+            self.counters["hits"] += 1
+        else:
+            inflight = self.inflight.get(key)
+            if inflight is not None:
+                self.counters["coalesced"] += 1
+                entry = await asyncio.shield(inflight)
+                if entry is None:
+                    return await call_next(request)
+            else:
+                self.counters["misses"] += 1
+                future = asyncio.get_running_loop().create_future()
+                self.inflight[key] = future
+                entry = response = None
+                try:
+                    entry, response = await self._compute(request, call_next, versions, rule["ttl_seconds"])
+                finally:
+                    self.inflight.pop(key, None)
+                    future.set_result(entry)
+                if entry is None:
+                    return response
+                self.entries.pop(key, None)
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    del self.entries[next(iter(self.entries))]
+
+        headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+        if entry["etag"] in request.headers.get("if-none-match", ""):
+            self.counters["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry["body"], headers={**entry["headers"], **headers})
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), **self.counters}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_CONFIG["routes"], RESPONSE_CACHE_CONFIG["max_entries"])
@@ -0,0 +1,160 @@
+"""
+Общее состояние между воркерами uvicorn (--workers N): дедупликация событий,
+отложенные UNKNOWN-события, последний номер для оплаты на экране.
+
+SHARED_STATE_BACKEND:
+- memory   - в памяти процесса (один воркер, без обращений к БД);
+- postgres - UNLOGGED таблица shared_state, общая для всех воркеров.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from ..config import SHARED_STATE_CONFIG
+from ..db import get_db_connection
+
+
+class MemoryStateBackend:
+    """
+    Ограниченное хранилище ключ -> (значение, срок) в памяти процесса.
+    Ключи с TTL (окна дедупликации) вытесняются по LRU сверх max_size;
+    ключи без срока (номер на экране оплаты и т.п.) хранятся отдельно и не вытесняются.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.persistent = {}
+
+    def _alive(self, key, now: float):
+        entry = self.persistent.get(key)
+        if entry is not None:
+            return entry
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self.entries[key]
+            return None
+        return entry
+
+    def _put(self, key, value, ttl_seconds, now: float):
+        if not ttl_seconds:
+            self.entries.pop(key, None)
+            self.persistent[key] = (value, None)
+            return
+        self.persistent.pop(key, None)
+        self.entries[key] = (value, now + ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def seen_recently(self, key: str, window_seconds: float) -> bool:
+        """True - ключ уже отмечен в пределах окна; иначе отмечает ключ и возвращает False"""
+        now = time.monotonic()
+        if self._alive(key, now) is not None:
+            return True
+        self._put(key, "", window_seconds, now)
+        return False
+
+    async def get(self, key: str):
+        entry = self._alive(key, time.monotonic())
+        return entry[0] if entry else None
+
+    async def set(self, key: str, value: str, ttl_seconds: float = None):
+        self._put(key, value, ttl_seconds, time.monotonic())
+
+    async def delete(self, key: str):
+        self.entries.pop(key, None)
+        self.persistent.pop(key, None)
+
+    async def pop_if_equals(self, key: str, value: str) -> bool:
+        """Удаляет ключ, если его значение равно value (атомарно); True - если удален"""
+        entry = self._alive(key, time.monotonic())
+        if entry is None or entry[0] != value:
+            return False
+        self.entries.pop(key, None)
+        self.persistent.pop(key, None)
+        return True
+
+    async def cleanup(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "keys": len(self.entries) + len(self.persistent), "persistent_keys": len(self.persistent)}
+
+
+class PostgresStateBackend:
+    """Общее состояние в UNLOGGED таблице shared_state (одна операция - один запрос)"""
+
+    name = "postgres"
+
+    async def seen_recently(self, key: str, window_seconds: float) -> bool:
+        async with get_db_connection() as conn:
+            marked = await conn.fetchval("""
+                INSERT INTO shared_state (key, value, expires_at)
+                VALUES ($1, '', NOW() + make_interval(secs => $2))
+                ON CONFLICT (key) DO UPDATE
+                    SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                    WHERE shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= NOW()
+                RETURNING key
+            """, key, float(window_seconds))
+        return marked is None
+
+    async def get(self, key: str):
+        async with get_db_connection() as conn:
+            return await conn.fetchval("""
+                SELECT value FROM shared_state
+                WHERE key = $1 AND (expires_at IS NULL OR expires_at > NOW())
+            """, key)
+
+    async def set(self, key: str, value: str, ttl_seconds: float = None):
+        async with get_db_connection() as conn:
+            await conn.execute("""
+                INSERT INTO shared_state (key, value, expires_at)
+                VALUES ($1, $2, CASE WHEN $3::float8 IS NULL THEN NULL ELSE NOW() + make_interval(secs => $3::float8) END)
+                ON CONFLICT (key) DO UPDATE
+                    SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            """, key, value, float(ttl_seconds) if ttl_seconds else None)
+
+    async def delete(self, key: str):
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM shared_state WHERE key = $1", key)
+
+    async def pop_if_equals(self, key: str, value: str) -> bool:
+        async with get_db_connection() as conn:
+            deleted = await conn.fetchval("""
+                DELETE FROM shared_state
+                WHERE key = $1 AND value = $2 AND (expires_at IS NULL OR expires_at > NOW())
+                RETURNING key
+            """, key, value)
+        return deleted is not None
+
+    async def cleanup(self):
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM shared_state WHERE expires_at <= NOW()")
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+def create_state_backend():
+    if SHARED_STATE_CONFIG["backend"] == "postgres":
+        return PostgresStateBackend()
+    return MemoryStateBackend(SHARED_STATE_CONFIG["memory_max_keys"])
+
+
+shared_state = create_state_backend()
+
+
+async def shared_state_cleanup_task():
+    """Периодическое удаление просроченных ключей (запускается из lifespan)"""
+    while True:
+        await asyncio.sleep(SHARED_STATE_CONFIG["cleanup_interval_seconds"])
+        try:
+            await shared_state.cleanup()
+        except Exception as e:
+            print(f"❌ Shared state cleanup error: {e}")
@@ -0,0 +1,153 @@
+"""
+Тарифный движок: активный тариф + tariff_schedules компилируются в недельную
+таблицу ставок с поминутным разрешением и префиксными суммами.
+
+Строки tariff_schedules (day_of_week 0=Пн..6=Вс, start_time, end_time) задают окна
+ночного тарифа; end_time <= start_time означает переход через полночь.
+day_of_week NULL - окно действует каждый день; окно без start_time/end_time пропускается.
+Если у тарифа нет расписания - ночь каждый день с 22:00 до 07:00.
+
+Стоимость любого интервала (в т.ч. многодневного) считается за O(1):
+sum(a, b) = S(b) - S(a), S(x) = (x // WEEK) * P[WEEK] + P[x % WEEK].
+"""
+import logging
+from datetime import datetime, time
+from ..config import KYRGYZSTAN_TZ
+
+logger = logging.getLogger(__name__)
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+
+# Понедельник 00:00 - начало отсчета минут (в Кыргызстане нет перехода на летнее время)
+EPOCH_MONDAY = datetime(2024, 1, 1)
+
+DEFAULT_NIGHT_WINDOWS = [(day, time(22, 0), time(7, 0)) for day in range(7)]
+
+
+def to_week_minute(moment: datetime) -> int:
+    """Абсолютный номер минуты (местное время) от EPOCH_MONDAY"""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(KYRGYZSTAN_TZ).replace(tzinfo=None)
+    return int((moment - EPOCH_MONDAY).total_seconds() // 60)
+
+
+class TariffTable:
+    def __init__(self, hourly_rate, night_rate, free_minutes, max_hours, name, night_windows=None):
+        self.hourly_rate = float(hourly_rate)
+        self.night_rate = float(night_rate)
+        self.free_minutes = int(free_minutes)
+        self.max_hours = int(max_hours)
+        self.name = name
+
+        night = [False] * WEEK_MINUTES
+        for day_of_week, start_time, end_time in night_windows or DEFAULT_NIGHT_WINDOWS:
+            if start_time is None or end_time is None:
+                logger.warning(f"Tariff '{name}': night window without start/end time skipped (day_of_week={day_of_week})")
+                continue
+            length = (end_time.hour * 60 + end_time.minute) - (start_time.hour * 60 + start_time.minute)
+            if length <= 0:
+                length += DAY_MINUTES
+            for day in range(7) if day_of_week is None else (day_of_week,):
+                start = day * DAY_MINUTES + start_time.hour * 60 + start_time.minute
+                for minute in range(start, start + length):
+                    night[minute % WEEK_MINUTES] = True
+
+        # cost_prefix[m] - стоимость минут [0, m) недели, night_prefix[m] - число ночных минут
+        self.cost_prefix = [0.0] * (WEEK_MINUTES + 1)
+        self.night_prefix = [0] * (WEEK_MINUTES + 1)
+        day_rate_minute = self.hourly_rate / 60
+        night_rate_minute = self.night_rate / 60
+        for minute in range(WEEK_MINUTES):
+            is_night = night[minute]
+            self.cost_prefix[minute + 1] = self.cost_prefix[minute] + (night_rate_minute if is_night else day_rate_minute)
+            self.night_prefix[minute + 1] = self.night_prefix[minute] + (1 if is_night else 0)
+
+    @staticmethod
+    def _prefix_at(prefix, minute: int):
+        weeks, rest = divmod(minute, WEEK_MINUTES)
+        return weeks * prefix[WEEK_MINUTES] + prefix[rest]
+
+    def interval_cost(self, start_minute: int, end_minute: int) -> float:
+        """Стоимость минут [start_minute, end_minute) по абсолютным номерам минут"""
+        return self._prefix_at(self.cost_prefix, end_minute) - self._prefix_at(self.cost_prefix, start_minute)
+
+    def night_minutes(self, start_minute: int, end_minute: int) -> int:
+        return self._prefix_at(self.night_prefix, end_minute) - self._prefix_at(self.night_prefix, start_minute)
+
+    def cost(self, entry_time: datetime, exit_time: datetime) -> dict:
+        """
+        Стоимость стоянки: первые free_minutes бесплатно, далее неполный час
+        округляется вверх (не более max_hours), каждая минута оплачивается
+        по ставке своего времени суток.
+        """
+        total_minutes = int((exit_time - entry_time).total_seconds() / 60)
+
+        if total_minutes <= self.free_minutes:
+            return {
+                "duration_minutes": total_minutes,
+                "total_cost": 0.0,
+                "free_time": True,
+                "description": f"Бесплатно ({total_minutes} мин)",
+                "tariff_used": self.name
+            }
+
+        billable_minutes = total_minutes - self.free_minutes
+        billable_hours = max(1, billable_minutes // 60 + (1 if billable_minutes % 60 > 0 else 0))
+        if billable_hours > self.max_hours:
+            billable_hours = self.max_hours
+
+        start = to_week_minute(entry_time) + self.free_minutes
+        end = start + billable_hours * 60
+        total_cost = round(self.interval_cost(start, end), 2)
+        night_minutes = self.night_minutes(start, end)
+
+        if night_minutes == billable_hours * 60:
+            rate, rate_type = self.night_rate, "ночной"
+        elif night_minutes == 0:
+            rate, rate_type = self.hourly_rate, "дневной"
+        else:
+            rate, rate_type = round(total_cost / billable_hours, 2), "смешанный"
+
+        if rate_type == "смешанный":
+            description = (
+                f"{billable_hours} ч: {round(night_minutes / 60, 1)} ч × {self.night_rate} сом (ночной) + "
+                f"{round(billable_hours - night_minutes / 60, 1)} ч × {self.hourly_rate} сом (дневной)"
+            )
+        else:
+            description = f"{billable_hours} ч × {rate} сом ({rate_type} тариф)"
+
+        return {
+            "duration_minutes": total_minutes,
+            "billable_hours": billable_hours,
+            "total_cost": total_cost,
+            "rate": rate,
+            "rate_type": rate_type,
+            "free_time": False,
+            "description": description,
+            "tariff_used": self.name
+        }
+
+    def cost_many(self, intervals):
+        """
+        Пакетный расчет: intervals - итерируемое (entry_time, exit_time),
+        выдает (duration_minutes, billable_hours, total_cost) для каждой пары.
+        Тот же алгоритм, что cost(), без построения словарей описаний.
+        """
+        cost_prefix = self.cost_prefix
+        week_cost = cost_prefix[WEEK_MINUTES]
+        free_minutes = self.free_minutes
+        max_hours = self.max_hours
+        for entry_time, exit_time in intervals:
+            total_minutes = int((exit_time - entry_time).total_seconds() / 60)
+            if total_minutes <= free_minutes:
+                yield total_minutes, 0, 0.0
+                continue
+            billable_minutes = total_minutes - free_minutes
+            billable_hours = min(max_hours, max(1, -(-billable_minutes // 60)))
+            start = to_week_minute(entry_time) + free_minutes
+            end = start + billable_hours * 60
+            start_weeks, start_rest = divmod(start, WEEK_MINUTES)
+            end_weeks, end_rest = divmod(end, WEEK_MINUTES)
+            total_cost = (end_weeks - start_weeks) * week_cost + cost_prefix[end_rest] - cost_prefix[start_rest]
+            yield total_minutes, billable_hours, round(total_cost, 2)
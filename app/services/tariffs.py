@@ -0,0 +1,132 @@
+"""
+Кэш активного тарифа в памяти процесса.
+Сбрасывается эндпоинтами /tariffs/* после изменений и по NOTIFY parking_tariffs
+(изменения из других воркеров). version растет при каждой перезагрузке.
+Вместе с тарифом компилируется TariffTable (тарифный движок, см. tariff_engine).
+Перезагрузка одна на процесс (lock); сброс во время загрузки (generation)
+оставляет кэш устаревшим - загруженный до изменения тариф не закрепляется на ttl.
+"""
+import asyncio
+import time
+from datetime import datetime
+from ..config import KYRGYZSTAN_TZ, PARKING_CONFIG
+from ..db import get_db_connection
+from .tariff_engine import TariffTable
+
+
+async def compile_tariff(conn, tariff: dict) -> TariffTable:
+    """Собирает TariffTable из строки parking_tariffs и ее tariff_schedules"""
+    schedules = await conn.fetch("""
+        SELECT day_of_week, start_time, end_time
+        FROM tariff_schedules
+        WHERE tariff_id = $1 AND is_active = true
+        ORDER BY day_of_week, start_time
+    """, tariff["id"])
+    return TariffTable(
+        tariff["hourly_rate"],
+        tariff["night_rate"],
+        tariff["free_minutes"],
+        tariff["max_hours"],
+        tariff["name"],
+        [tuple(schedule) for schedule in schedules]
+    )
+
+
+async def load_tariff_table(conn, tariff_id: int):
+    """TariffTable любого тарифа по id (для симуляций), None - если тарифа нет"""
+    row = await conn.fetchrow("""
+        SELECT id, hourly_rate, night_rate, free_minutes, max_hours, name, description
+        FROM parking_tariffs WHERE id = $1
+    """, tariff_id)
+    return await compile_tariff(conn, dict(row)) if row else None
+
+
+class TariffCache:
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.active = None
+        self.table = None
+        self.version = 0
+        self.loaded_at = None
+        self.loaded_date = None
+        self.stale = True
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    def _is_stale(self) -> bool:
+        if self.stale or self.loaded_at is None:
+            return True
+        if self.loaded_date != datetime.now(KYRGYZSTAN_TZ).date():
+            return True
+        return time.monotonic() - self.loaded_at > self.ttl_seconds
+
+    async def load(self, conn=None):
+        """Перечитывает активный тариф из БД"""
+        if conn is None:
+            async with get_db_connection() as conn:
+                return await self.load(conn)
+        generation = self.generation
+        row = await conn.fetchrow("""
+            SELECT id, hourly_rate, night_rate, free_minutes, max_hours, name, description
+            FROM parking_tariffs
+            WHERE is_active = true
+            AND (valid_until IS NULL OR valid_until >= CURRENT_DATE)
+            ORDER BY created_at DESC
+            LIMIT 1
+        """)
+        self.active = dict(row) if row else None
+        self.table = await compile_tariff(conn, self.active) if self.active else self.default_table()
+        self.loaded_at = time.monotonic()
+        self.loaded_date = datetime.now(KYRGYZSTAN_TZ).date()
+        # invalidate() во время загрузки: прочитанное могло не включать изменение
+        self.stale = self.generation != generation
+        self.version += 1
+        return self.active
+
+    async def get(self, conn=None):
+        """Активный тариф (dict) или None, если в БД активного тарифа нет"""
+        if self._is_stale():
+            async with self.lock:
+                # Одновременные промахи ждут одну загрузку
+                if self._is_stale():
+                    await self.load(conn)
+        return self.active
+
+    @staticmethod
+    def default_table() -> TariffTable:
+        return TariffTable(
+            PARKING_CONFIG["hourly_rate"],
+            PARKING_CONFIG["night_rate"],
+            PARKING_CONFIG["free_minutes"],
+            PARKING_CONFIG["max_hours"],
+            "default"
+        )
+
+    async def get_table(self, conn=None) -> TariffTable:
+        """Скомпилированная таблица активного тарифа, при ошибке БД - последняя загруженная или по умолчанию"""
+        try:
+            await self.get(conn)
+        except Exception as e:
+            print(f"Error getting tariff from DB: {e}")
+        if self.table is None:
+            self.table = self.default_table()
+        return self.table
+
+    def invalidate(self):
+        """Сбросить кэш - следующий запрос перечитает тариф из БД"""
+        self.generation += 1
+        self.stale = True
+
+    def on_notify(self, payload):
+        """Обработчик NOTIFY parking_tariffs"""
+        self.invalidate()
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "name": self.active["name"] if self.active else None,
+            "stale": self._is_stale()
+        }
+
+
+tariff_cache = TariffCache(PARKING_CONFIG["tariff_cache_ttl_seconds"])
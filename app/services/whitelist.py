@@ -0,0 +1,102 @@
+"""
+Индекс белого списка в памяти процесса: нормализованный номер -> интервалы действия.
+Загружается при старте, обновляется точечно после изменений и по NOTIFY parking_whitelist
+(изменения из других воркеров).
+"""
+from datetime import datetime
+from ..config import KYRGYZSTAN_TZ
+from ..db import get_db_connection
+
+
+def normalize_plate(plate: str) -> str:
+    return (plate or "").strip().upper()
+
+
+class WhitelistIndex:
+    def __init__(self):
+        self.by_plate = {}
+        self.by_id = {}
+        self.loaded = False
+        self.last_loaded = None
+
+    def _put(self, entry_id, plate_number, valid_from, valid_until):
+        plate = normalize_plate(plate_number)
+        self.by_id[entry_id] = plate
+        self.by_plate.setdefault(plate, {})[entry_id] = (valid_from, valid_until)
+
+    def _drop(self, entry_id):
+        plate = self.by_id.pop(entry_id, None)
+        if plate is None:
+            return
+        intervals = self.by_plate.get(plate)
+        if intervals is not None:
+            intervals.pop(entry_id, None)
+            if not intervals:
+                del self.by_plate[plate]
+
+    async def load(self, conn=None):
+        """Полная загрузка белого списка из БД"""
+        if conn is None:
+            async with get_db_connection() as conn:
+                return await self.load(conn)
+        rows = await conn.fetch("""
+            SELECT id, plate_number, valid_from, valid_until
+            FROM parking_whitelist
+            WHERE valid_until IS NULL OR valid_until >= NOW()
+        """)
+        self.by_plate = {}
+        self.by_id = {}
+        for row in rows:
+            self._put(*row)
+        self.loaded = True
+        self.last_loaded = datetime.now(KYRGYZSTAN_TZ).isoformat()
+        print(f"📋 Whitelist index loaded: {len(self.by_id)} entries")
+        return len(self.by_id)
+
+    async def refresh_entry(self, entry_id: int, conn=None):
+        """Перечитывает одну запись (после добавления/изменения/удаления)"""
+        if conn is None:
+            async with get_db_connection() as conn:
+                return await self.refresh_entry(entry_id, conn)
+        row = await conn.fetchrow("""
+            SELECT id, plate_number, valid_from, valid_until
+            FROM parking_whitelist WHERE id = $1
+        """, entry_id)
+        self._drop(entry_id)
+        if row:
+            self._put(*row)
+
+    async def on_notify(self, payload):
+        """Обработчик NOTIFY parking_whitelist: payload - id записи, None - перечитать все"""
+        try:
+            if payload:
+                await self.refresh_entry(int(payload))
+            else:
+                await self.load()
+        except Exception as e:
+            print(f"❌ Whitelist index refresh failed: {e}")
+
+    def contains(self, plate: str, at: datetime = None) -> bool:
+        """Номер действует в белом списке на момент at (по умолчанию - сейчас)"""
+        intervals = self.by_plate.get(normalize_plate(plate))
+        if not intervals:
+            return False
+        now = at or datetime.now(KYRGYZSTAN_TZ)
+        for valid_from, valid_until in intervals.values():
+            if valid_from and now < valid_from:
+                continue
+            if valid_until and now > valid_until:
+                continue
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "entries": len(self.by_id),
+            "plates": len(self.by_plate),
+            "last_loaded": self.last_loaded
+        }
+
+
+whitelist_index = WhitelistIndex()
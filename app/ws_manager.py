@@ -1,29 +1,150 @@
-from fastapi import WebSocket
-from typing import List
+"""
+WebSocket-хаб экранов: подключения разложены по каналам (канал экрана полосы
+из реестра полос или "all"), у каждого подключения своя ограниченная очередь
+отправки (при переполнении вытесняется самое старое сообщение) и отдельная
+задача-отправитель с таймаутом. Сообщение сериализуется один раз на рассылку.
+Зависший планшет отключается по таймауту и не задерживает остальные экраны.
+"""
+import asyncio
+from collections import deque
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+from app.config import SCREEN_WS_CONFIG
+from app.services.shared_state import shared_state
+
+LAST_PAYMENT_PLATE_KEY = "screen:last_payment_plate"
+ALL_CHANNEL = "all"
+HEARTBEAT_TEXT = orjson.dumps({"type": "ping"}).decode()
+PONG_TEXT = orjson.dumps({"type": "pong"}).decode()
+
+
+class ScreenConnection:
+    def __init__(self, websocket: WebSocket, channel: str):
+        self.websocket = websocket
+        self.channel = channel
+        self.queue = deque(maxlen=SCREEN_WS_CONFIG["queue_size"])
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def push(self, text: str):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(text)
+        self.ready.set()
+
+    async def sender(self):
+        """Отправляет очередь; при простое - heartbeat. Таймаут отправки закрывает соединение"""
+        while True:
+            try:
+                await asyncio.wait_for(self.ready.wait(), SCREEN_WS_CONFIG["heartbeat_seconds"])
+            except asyncio.TimeoutError:
+                self.queue.append(HEARTBEAT_TEXT)
+            self.ready.clear()
+            while self.queue:
+                text = self.queue.popleft()
+                await asyncio.wait_for(self.websocket.send_text(text), SCREEN_WS_CONFIG["send_timeout_seconds"])
+
 
 class ScreenWebSocketManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.last_payment_plate: str = None
+        self.channels = {}
+        self.counters = {"messages": 0, "dropped": 0, "timeouts": 0}
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    @staticmethod
+    def _payment_plate_key(channel: str = None) -> str:
+        return f"{LAST_PAYMENT_PLATE_KEY}:{channel}" if channel else LAST_PAYMENT_PLATE_KEY
+
+    async def get_last_payment_plate(self, channel: str = None):
+        """Последний номер, ожидающий оплаты (общий для всех воркеров); channel - экран полосы"""
+        return await shared_state.get(self._payment_plate_key(channel))
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    async def set_last_payment_plate(self, plate, channel: str = None):
+        """
+        Номер для оплаты экрана полосы channel; общий ключ (экраны без канала)
+        обновляется тоже. Сброс по каналу снимает общий номер, только если он этой полосы.
+        """
+        if plate is not None:
+            if channel:
+                await shared_state.set(self._payment_plate_key(channel), plate)
+            await shared_state.set(LAST_PAYMENT_PLATE_KEY, plate)
+        elif channel:
+            previous = await shared_state.get(self._payment_plate_key(channel))
+            await shared_state.delete(self._payment_plate_key(channel))
+            if previous is not None:
+                await shared_state.pop_if_equals(LAST_PAYMENT_PLATE_KEY, previous)
+        else:
+            await shared_state.delete(LAST_PAYMENT_PLATE_KEY)
 
-    async def broadcast(self, message: dict):
-        import asyncio
-        to_remove = []
-        async def send_safe(connection):
+    def _register(self, connection: ScreenConnection):
+        self.channels.setdefault(connection.channel, set()).add(connection)
+
+    def _unregister(self, connection: ScreenConnection):
+        connections = self.channels.get(connection.channel)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.channels[connection.channel]
+        self.counters["dropped"] += connection.dropped
+
+    async def serve(self, websocket: WebSocket, channel: str = None, initial_messages=()):
+        """Обслуживает подключение экрана до отключения: прием (ping -> pong) и отправка через очередь"""
+        await websocket.accept()
+        connection = ScreenConnection(websocket, channel or ALL_CHANNEL)
+        self._register(connection)
+        for message in initial_messages:
+            connection.push(orjson.dumps(message).decode())
+        sender = asyncio.create_task(connection.sender())
+        receiver = asyncio.create_task(self._receive(connection))
+        try:
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done and isinstance(sender.exception(), asyncio.TimeoutError):
+                self.counters["timeouts"] += 1
+                print(f"⏱️ Screen WS send timeout ({connection.channel}) - disconnecting")
+        finally:
+            sender.cancel()
+            receiver.cancel()
+            self._unregister(connection)
             try:
-                await connection.send_json(message)
+                await websocket.close()
             except Exception:
-                to_remove.append(connection)
-        await asyncio.gather(*(send_safe(conn) for conn in self.active_connections))
-        for conn in to_remove:
-            self.disconnect(conn)
+                pass
+
+    async def _receive(self, connection: ScreenConnection):
+        try:
+            while True:
+                message = await connection.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("text") == "ping":
+                    connection.push(PONG_TEXT)
+        except WebSocketDisconnect:
+            return
+
+    async def broadcast(self, message: dict, channel: str = None):
+        """
+        Рассылка без ожидания отправки: channel=None - всем экранам,
+        иначе - экранам канала и экранам без канала ("all")
+        """
+        text = orjson.dumps(message).decode()
+        self.counters["messages"] += 1
+        if channel is None:
+            targets = [connection for connections in self.channels.values() for connection in connections]
+        else:
+            targets = [*self.channels.get(channel, ()), *self.channels.get(ALL_CHANNEL, ())]
+        for connection in targets:
+            connection.push(text)
+
+    def stats(self) -> dict:
+        return {
+            "connections": {channel: len(connections) for channel, connections in self.channels.items()},
+            **self.counters
+        }
+
 
 screen_ws_manager = ScreenWebSocketManager()
+
+# Подписчики изменений состояния шлагбаумов (админка)
+barrier_ws_manager = ScreenWebSocketManager()
+
+# Лента изменений админки (/ws/admin-feed)
+admin_ws_manager = ScreenWebSocketManager()
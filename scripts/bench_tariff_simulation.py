@@ -0,0 +1,88 @@
+"""
+Замер пересчета года визитов тарифным движком (как в /admin/tariffs/simulate).
+
+Генерирует случайные визиты за год (по умолчанию ~300 в день), считает их
+по одному через TariffTable.cost() и пачками через cost_many(), сверяет
+результаты и печатает время. Без БД: только CPU-часть симуляции,
+включая сериализацию строк NDJSON.
+
+    python scripts/bench_tariff_simulation.py [--visits 110000] [--seed 8]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import KYRGYZSTAN_TZ
+from app.services.tariff_engine import TariffTable
+
+CHUNK_SIZE = 1000
+
+
+def random_visits(count: int, seed: int):
+    """Визиты за год: въезд в случайную минуту, стоянка от нескольких минут до суток"""
+    rng = random.Random(seed)
+    year_start = datetime(2024, 1, 1, tzinfo=KYRGYZSTAN_TZ)
+    visits = []
+    for _ in range(count):
+        entry_time = year_start + timedelta(minutes=rng.randrange(365 * 24 * 60))
+        minutes = int(rng.expovariate(1 / 150)) if rng.random() < 0.95 else rng.randrange(24 * 60)
+        visits.append((entry_time, entry_time + timedelta(minutes=minutes)))
+    return visits
+
+
+def timed(label: str, func):
+    started = time.perf_counter()
+    result = func()
+    print(f"{label:<34} {time.perf_counter() - started:7.3f} s")
+    return result
+
+
+def stream_lines(table: TariffTable, visits):
+    """Та же сборка ответа, что в api_tariff_simulate: cost_many по пачкам + строка JSON на визит"""
+    size = 0
+    for i in range(0, len(visits), CHUNK_SIZE):
+        batch = visits[i:i + CHUNK_SIZE]
+        lines = []
+        for (entry_time, exit_time), (minutes, hours, cost) in zip(batch, table.cost_many(batch)):
+            lines.append(json.dumps({
+                "entry_time": entry_time.isoformat(),
+                "exit_time": exit_time.isoformat(),
+                "duration_minutes": minutes,
+                "billable_hours": hours,
+                "total_cost": cost
+            }, ensure_ascii=False))
+        size += len("\n".join(lines)) + 1
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--visits", type=int, default=110_000)
+    parser.add_argument("--seed", type=int, default=8)
+    args = parser.parse_args()
+
+    table = timed("compile TariffTable", lambda: TariffTable(100, 50, 15, 24, "bench"))
+    visits = random_visits(args.visits, args.seed)
+    print(f"visits: {len(visits)}")
+
+    single = timed("cost() per visit", lambda: [table.cost(*visit) for visit in visits])
+    batch = timed("cost_many()", lambda: list(table.cost_many(visits)))
+    size = timed("cost_many() + NDJSON lines", lambda: stream_lines(table, visits))
+    print(f"NDJSON size: {size / 1024 / 1024:.1f} MiB")
+
+    mismatches = sum(
+        1 for one, (minutes, hours, cost) in zip(single, batch)
+        if (one["duration_minutes"], one.get("billable_hours", 0), one["total_cost"]) != (minutes, hours, cost)
+    )
+    print(f"mismatches with cost(): {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Параллельные въезды по одному номеру: сотни process_entry через настоящий
+plate_locks.hold на подставном соединении. Подставная БД повторяет то, на что
+опирается обработка: pg_advisory_xact_lock держится до конца транзакции,
+вставки видны другим соединениям только после COMMIT.
+"""
+import asyncio
+import random
+from contextlib import asynccontextmanager
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("httpx")
+pytest.importorskip("fastapi")
+
+from app.services import parking
+
+PLATES = ["01KG123ABC", "01KG456DEF", "02KG789GHI", "03KG321JKL", "04KG654MNO"]
+WHITELISTED = {"03KG321JKL"}
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.visits = {}
+        self.next_id = 1
+        self.advisory_locks = {}
+
+    def active_visits(self, plate: str):
+        return [visit for visit in self.visits.values() if visit["plate_number"] == plate and visit["visit_status"] == "active"]
+
+
+class FakeConnection:
+    def __init__(self, db: FakeDatabase):
+        self.db = db
+        self.pending = None
+        self.held = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.pending = {}
+        try:
+            yield
+            self.db.visits.update(self.pending)
+        finally:
+            self.pending = None
+            for lock in self.held:
+                lock.release()
+            self.held = []
+
+    async def _yield(self):
+        # Точка переключения задач между запросами, как при обращении к БД
+        await asyncio.sleep(random.random() / 1000)
+
+    def _insert(self, plate: str, entry_time, camera_ip: str, event_id: int) -> int:
+        visit_id = self.db.next_id
+        self.db.next_id += 1
+        self.pending[visit_id] = {
+            "id": visit_id,
+            "plate_number": plate,
+            "entry_time": entry_time,
+            "entry_camera_ip": camera_ip,
+            "entry_event_id": event_id,
+            "visit_status": "active"
+        }
+        return visit_id
+
+    async def execute(self, query: str, *args):
+        await self._yield()
+        if "pg_advisory_xact_lock" in query:
+            assert self.pending is not None, "advisory lock вне транзакции"
+            lock = self.db.advisory_locks.setdefault(args[0], asyncio.Lock())
+            await lock.acquire()
+            self.held.append(lock)
+            return "SELECT 1"
+        if "SET entry_barrier_opened = true" in query:
+            self.db.visits[args[0]]["entry_barrier_opened"] = True
+            return "UPDATE 1"
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+    async def fetchrow(self, query: str, *args):
+        await self._yield()
+        if "SELECT id, entry_time FROM parking_visits" in query:
+            active = self.db.active_visits(args[0])
+            if not active:
+                return None
+            latest = max(active, key=lambda visit: visit["entry_time"])
+            return latest["id"], latest["entry_time"]
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+    async def fetchval(self, query: str, *args):
+        await self._yield()
+        if "WITH existing AS" in query:
+            active = self.db.active_visits(args[0])
+            if active:
+                return active[0]["id"]
+            return self._insert(*args)
+        if "INSERT INTO parking_visits" in query:
+            return self._insert(*args)
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDatabase()
+
+    @asynccontextmanager
+    async def get_db_connection():
+        await asyncio.sleep(0)
+        yield FakeConnection(db)
+
+    async def open_barrier(camera_ip):
+        await asyncio.sleep(random.random() / 1000)
+        return True
+
+    async def is_plate_in_whitelist(plate, conn=None):
+        return plate in WHITELISTED
+
+    monkeypatch.setattr(parking, "get_db_connection", get_db_connection)
+    monkeypatch.setattr(parking, "open_barrier", open_barrier)
+    monkeypatch.setattr(parking, "is_plate_in_whitelist", is_plate_in_whitelist)
+    monkeypatch.setattr(parking, "plate_locks", parking.KeyedLocks())
+    return db
+
+
+def assert_one_active_visit_per_plate(db: FakeDatabase):
+    for plate in PLATES:
+        assert len(db.active_visits(plate)) == 1, plate
+    assert len(db.visits) == len(PLATES)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_entries_create_one_active_visit_per_plate(fake_db):
+    random.seed(14)
+    events = [random.choice(PLATES) for _ in range(400)]
+    results = await asyncio.gather(*(
+        parking.process_entry(f"192.168.1.{index % 4}", plate, index)
+        for index, plate in enumerate(events)
+    ))
+
+    assert_one_active_visit_per_plate(fake_db)
+    actions = [result["action"] for result in results]
+    assert set(actions) <= {"entry", "entry_whitelist", "duplicate_entry"}
+    # Новая сессия - ровно одна на номер не из белого списка, остальные въезды - повторные
+    assert actions.count("entry") == len(PLATES) - len(WHITELISTED)
+    whitelist_sessions = {result["session_id"] for result in results if result["action"] == "entry_whitelist"}
+    assert len(whitelist_sessions) == len(WHITELISTED)
+    assert all(result["barrier_opened"] for result in results)
+    # Очередь по номеру действительно работала, и локи номеров не утекают
+    assert parking.plate_locks.contended > 0
+    assert parking.plate_locks.locks == {}
+
+
+@pytest.mark.asyncio
+async def test_advisory_lock_serializes_entries_without_process_locks(fake_db):
+    """Другой воркер (без общего plate_locks) упирается в pg_advisory_xact_lock"""
+    random.seed(15)
+    events = [random.choice(PLATES) for _ in range(300)]
+    await asyncio.gather(*(
+        parking._process_entry("192.168.1.10", plate, index)
+        for index, plate in enumerate(events)
+    ))
+
+    assert_one_active_visit_per_plate(fake_db)